@@ -0,0 +1,635 @@
+"""Load test for tg_kod.py against a local fake Telegram Bot API.
+
+The bot runs unchanged as a subprocess (`python tg_kod.py`) with
+TELEGRAM_API_BASE pointing at a fake Bot API server in this process. The
+fake server answers every method with a plausible result after a
+configurable delay and records each call. Synthetic webhook updates are
+posted at a target rate. Each step of a user session ends when the fake API
+has received that step's replies, which gives end-to-end latency and the
+outbound calls per update.
+
+    python bench_kod.py --movies 1000 --rate 100 --duration 20
+    python bench_kod.py --movies 1000000 --rate 500 --workers 4 --label reuseport
+    python bench_kod.py --compare bench_results/a.json bench_results/b.json
+    python bench_kod.py --dispatch
+
+Results are written to bench_results/<time>_<label>.json.
+"""
+import os
+import sys
+import json
+import time
+import random
+import signal
+import asyncio
+import argparse
+import tempfile
+import platform
+import itertools
+import subprocess
+import collections
+from typing import Optional
+
+import aiohttp
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BOT_TOKEN = "123456:bench"
+ADMIN_ID = 999000001
+REPLY_METHODS = {"sendMessage", "sendVideo", "copyMessage", "editMessageText", "sendPhoto", "answerInlineQuery"}
+MULTIPART_EVERY = 5  # every 5th movie code has several parts
+DEFAULT_MIX = "lookup=55,part=20,stats=5,recommend=15,admin=5"
+
+# Shared by the warm-up and measured runs: a reused update_id would be dropped
+# by the bot's dedupe middleware.
+update_ids = itertools.count(1)
+user_ids = itertools.count(10_000_000)
+
+# --- Fake Bot API ---
+class FakeBotAPI:
+    """Answers /bot<token>/<method> like api.telegram.org would.
+
+    Calls are counted per method and pushed to the inbox of the user they
+    concern (user_id, else chat_id), so a session can await its replies.
+    Calls the bot returned in a webhook response are counted apart, in
+    `webhook_calls`: they cost the bot no outbound request.
+    With `flood_rate`/`flood_chat` set, sends above that many per rolling
+    second (overall/per chat) get a 429 with retry_after, like Telegram.
+    """
+
+    def __init__(self, latency_ms: float, jitter_ms: float, flood_rate: float = 0, flood_chat: float = 0):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.flood_rate = flood_rate
+        self.flood_chat = flood_chat
+        self._sent: collections.deque = collections.deque()
+        self._sent_chat: dict[str, collections.deque] = collections.defaultdict(collections.deque)
+        self.calls: collections.Counter = collections.Counter()
+        self.webhook_calls: collections.Counter = collections.Counter()
+        self._inbox: dict[int, asyncio.Queue] = {}
+        self._message_ids = itertools.count(1)
+        self.runner: Optional[web.AppRunner] = None
+        self.port = 0
+
+    def watch(self, user_id: int) -> asyncio.Queue:
+        q = self._inbox[user_id] = asyncio.Queue()
+        return q
+
+    def unwatch(self, user_id: int):
+        self._inbox.pop(user_id, None)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = self.runner.addresses[0][1]
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = dict(await request.post()) if request.can_read_body else {}
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.random() * self.jitter)
+        # Inline queries are sent with the user id as their id.
+        target = str(data.get("user_id") or data.get("chat_id") or data.get("inline_query_id") or "")
+        if method in REPLY_METHODS and self.flooded(target):
+            self.calls["429"] += 1
+            return web.json_response({
+                "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            }, status=429)
+        self.calls[method] += 1
+        self._deliver(method, target, outbound=True)
+        return web.json_response({"ok": True, "result": self.result(method, data)})
+
+    def webhook_reply(self, method: str, data: dict):
+        """A call the bot returned in its webhook response: Telegram runs it
+        without the bot waiting on a round trip, so no latency is added."""
+        self.webhook_calls[method] += 1
+        self._deliver(method, str(data.get("user_id") or data.get("chat_id") or ""), outbound=False)
+
+    def _deliver(self, method: str, target: str, outbound: bool):
+        if target.lstrip("-").isdigit():
+            q = self._inbox.get(int(target))
+            if q is not None:
+                q.put_nowait((method, time.perf_counter(), outbound))
+
+    def flooded(self, chat: str) -> bool:
+        now = time.monotonic()
+        for window, limit in ((self._sent, self.flood_rate), (self._sent_chat[chat], self.flood_chat)):
+            while window and now - window[0] > 1:
+                window.popleft()
+            if limit and len(window) >= limit:
+                return True
+        self._sent.append(now)
+        self._sent_chat[chat].append(now)
+        return False
+
+    def result(self, method: str, data: dict):
+        chat_id = data.get("chat_id", "0")
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id) if str(chat_id).lstrip("-").isdigit() else 0, "type": "private"},
+        }
+        if method in ("sendMessage", "editMessageText"):
+            return {**message, "text": data.get("text", "")}
+        if method == "sendVideo":
+            video = {"file_id": str(data.get("video", "")), "file_unique_id": "u", "width": 1, "height": 1, "duration": 1}
+            return {**message, "video": video, "caption": data.get("caption", "")}
+        if method == "copyMessage":
+            return {"message_id": message["message_id"]}
+        if method == "getChatMember":
+            return {"status": "member", "user": {"id": int(data.get("user_id", 0)), "is_bot": False, "first_name": "u"}}
+        if method == "getWebhookInfo":
+            return {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        return True
+
+# --- Catalog seeding ---
+def seed_catalog(conn, storage, movies: int, channels: int):
+    """Bulk-insert `movies` codes ("1".."N"); every MULTIPART_EVERY-th has 3 parts."""
+    storage.set_setting(conn, "migrated", "1")
+    storage.set_setting(conn, "channels", json.dumps([f"@bench_channel_{i}" for i in range(channels)]))
+    batch = 20000
+    rng = random.Random(7)
+    for start in range(1, movies + 1, batch):
+        codes = range(start, min(start + batch, movies + 1))
+        storage._exec_many(
+            conn, "INSERT INTO movies (code, title, views) VALUES (?, ?, ?)",
+            [(str(i), f"Kino {i}", int(rng.paretovariate(1.2))) for i in codes]
+        )
+        parts = []
+        for i in codes:
+            for n in range(1, (3 if i % MULTIPART_EVERY == 0 else 1) + 1):
+                parts.append((str(i), n, f"Kino {i} {n}-qism", "bench", f"video_{i}_{n}"))
+        storage._exec_many(
+            conn, "INSERT INTO parts (movie_code, ordinal, title, description, video) VALUES (?, ?, ?, ?, ?)", parts
+        )
+        conn.commit()
+
+def prepare_database(env: dict, movies: int, channels: int) -> float:
+    """Create the schema and seed it through tg_kod's own storage layer."""
+    os.environ.update(env)
+    sys.path.insert(0, ROOT)
+    import tg_kod
+
+    async def run():
+        tg_kod.storage.open()
+        try:
+            await tg_kod.init_db()
+            await tg_kod.storage.pool.run(seed_catalog, tg_kod.storage, movies, channels)
+        finally:
+            tg_kod.storage.close()
+
+    started = time.perf_counter()
+    asyncio.run(run())
+    return time.perf_counter() - started
+
+# --- Bot process ---
+async def start_bot(env: dict, port: int, log_path: str) -> subprocess.Popen:
+    log = open(log_path, "w")
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, "tg_kod.py")], env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 60
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if proc.poll() is not None:
+                raise RuntimeError(f"bot exited with code {proc.returncode}, see {log_path}")
+            try:
+                async with session.get(f"http://127.0.0.1:{port}/metrics") as r:
+                    if r.status == 200:
+                        return proc
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError(f"bot did not start within 60s, see {log_path}")
+
+def stop_bot(proc: subprocess.Popen):
+    proc.send_signal(signal.SIGTERM)
+    try:
+        proc.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+# --- Load generator ---
+class LoadGenerator:
+    def __init__(self, args, api: FakeBotAPI, port: int):
+        self.args = args
+        self.api = api
+        self.url = f"http://127.0.0.1:{port}/webhook"
+        self.latencies: dict[str, list[float]] = collections.defaultdict(list)
+        self.errors: collections.Counter = collections.Counter()
+        self.calls_per_update: list[int] = []  # outbound Bot API requests
+        self.webhook_replies_per_update: list[int] = []
+        self.admin_lock = asyncio.Lock()
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.rng = random.Random(args.seed)
+        names, weights = [], []
+        for item in args.mix.split(","):
+            name, weight = item.split("=")
+            names.append(name.strip())
+            weights.append(float(weight))
+        self.scenarios, self.weights = names, weights
+
+    def pick_code(self, multipart: bool) -> str:
+        n = self.args.movies
+        # Skewed towards low codes so caches see a realistic hot set.
+        i = 1 + int((n - 1) * self.rng.random() ** self.args.skew)
+        if multipart:
+            i = max(MULTIPART_EVERY, i - i % MULTIPART_EVERY)
+        elif i % MULTIPART_EVERY == 0:
+            i += 1 if i < n else -1
+        return str(i)
+
+    def steps(self, scenario: str) -> list[tuple[str, dict, int]]:
+        """(step name, message fields, expected replies) for one session."""
+        if scenario == "lookup":
+            if self.rng.random() < self.args.miss_ratio:
+                return [("search", {"text": "🎬 Kino topish"}, 1), ("code_miss", {"text": f"x{self.rng.randrange(10**9)}"}, 1)]
+            return [("search", {"text": "🎬 Kino topish"}, 1), ("code", {"text": self.pick_code(False)}, 2)]
+        if scenario == "part":
+            return [
+                ("search", {"text": "🎬 Kino topish"}, 1),
+                ("code_parts", {"text": self.pick_code(True)}, 1),
+                ("part", {"text": "2-qism"}, 2),
+            ]
+        if scenario == "inline":
+            query = {"query": f"kino {self.pick_code(False)}", "offset": ""}
+            # The repeat is answered from the bot's inline cache.
+            return [("inline", {"inline_query": query}, 1), ("inline_repeat", {"inline_query": query}, 1)]
+        if scenario == "stats":
+            return [("stats", {"text": "📊 Statistika"}, 1)]
+        if scenario == "recommend":
+            return [("recommend", {"text": "📽 Kino tavsiyasi"}, 1)]
+        if scenario == "admin":
+            n = next(update_ids)
+            video = {"file_id": f"bench_upload_{n}", "file_unique_id": f"bu{n}", "width": 1, "height": 1, "duration": 1}
+            return [
+                ("admin_video", {"video": video}, 1),
+                # A new code, so uploads never turn a single-part lookup target into a multi-part one.
+                ("admin_info", {"text": f"new{n} | Bench {n} | yuklash"}, 2),
+            ]
+        raise ValueError(f"unknown scenario {scenario!r}")
+
+    def update(self, user_id: int, fields: dict) -> dict:
+        update_id = next(update_ids)
+        if "inline_query" in fields:
+            inline_query = {"id": str(user_id), "from": {"id": user_id, "is_bot": False, "first_name": "bench"},
+                            **fields["inline_query"]}
+            return {"update_id": update_id, "inline_query": inline_query}
+        message = {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "bench"},
+            **fields,
+        }
+        return {"update_id": update_id, "message": message}
+
+    async def run_session(self, scenario: str):
+        if scenario == "admin":
+            async with self.admin_lock:
+                await self._run_steps(ADMIN_ID, self.steps(scenario))
+        else:
+            await self._run_steps(next(user_ids), self.steps(scenario))
+
+    async def _run_steps(self, user_id: int, steps: list):
+        inbox = self.api.watch(user_id)
+        try:
+            for name, fields, replies in steps:
+                while not inbox.empty():
+                    inbox.get_nowait()
+                started = time.perf_counter()
+                try:
+                    async with self.session.post(self.url, json=self.update(user_id, fields)) as r:
+                        if r.status != 200:
+                            self.errors[f"{name}:http_{r.status}"] += 1
+                            return
+                        await self._webhook_reply(r)
+                    finished, calls, webhook_replies = await self._await_replies(inbox, replies)
+                except asyncio.TimeoutError:
+                    self.errors[f"{name}:timeout"] += 1
+                    return
+                except aiohttp.ClientError as e:
+                    self.errors[f"{name}:{type(e).__name__}"] += 1
+                    return
+                self.latencies[name].append(finished - started)
+                self.calls_per_update.append(calls)
+                self.webhook_replies_per_update.append(webhook_replies)
+        finally:
+            self.api.unwatch(user_id)
+
+    async def _webhook_reply(self, r: aiohttp.ClientResponse):
+        if not r.content_type.startswith("multipart/"):
+            return
+        data = {}
+        async for part in aiohttp.MultipartReader.from_response(r):
+            data[part.name] = await part.text()
+        if "method" in data:
+            self.api.webhook_reply(data.pop("method"), data)
+
+    async def _await_replies(self, inbox: asyncio.Queue, replies: int) -> tuple[float, int, int]:
+        deadline = time.perf_counter() + self.args.step_timeout
+        calls = webhook_replies = got = 0
+        finished = time.perf_counter()
+        while got < replies:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise asyncio.TimeoutError
+            method, finished, outbound = await asyncio.wait_for(inbox.get(), remaining)
+            if outbound:
+                calls += 1
+            else:
+                webhook_replies += 1
+            if method in REPLY_METHODS:
+                got += 1
+        return finished, calls, webhook_replies
+
+    async def run(self) -> float:
+        connector = aiohttp.TCPConnector(limit=self.args.connections)
+        async with aiohttp.ClientSession(connector=connector) as self.session:
+            tasks = set()
+            interval = 1 / self.args.rate
+            started = time.perf_counter()
+            next_at = started
+            while time.perf_counter() - started < self.args.duration:
+                scenario = self.rng.choices(self.scenarios, self.weights)[0]
+                task = asyncio.create_task(self.run_session(scenario))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                next_at += interval
+                delay = next_at - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if tasks:
+                await asyncio.wait(tasks, timeout=self.args.step_timeout * 3)
+            return time.perf_counter() - started
+
+# --- Reporting ---
+def percentile(sorted_values: list[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+def summarize(values: list[float]) -> dict:
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 50) * 1000, 2),
+        "p95_ms": round(percentile(values, 95) * 1000, 2),
+        "p99_ms": round(percentile(values, 99) * 1000, 2),
+        "max_ms": round(values[-1] * 1000, 2) if values else 0.0,
+    }
+
+def scrape_metrics(text: str) -> dict:
+    """Keep the bot's own counters and histogram sums, without buckets."""
+    kept = {}
+    for line in text.splitlines():
+        if line.startswith("#") or "_bucket{" in line or not line.strip():
+            continue
+        name, _, value = line.rpartition(" ")
+        kept[name] = float(value)
+    return kept
+
+def git_revision() -> str:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, timeout=10)
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                               capture_output=True, text=True, timeout=10).stdout.strip()
+        return out.stdout.strip() + ("-dirty" if dirty else "")
+    except Exception:
+        return "unknown"
+
+def print_report(result: dict):
+    cfg = result["config"]
+    print(f"\nmovies={cfg['movies']} rate={cfg['rate']}/s duration={cfg['duration']}s "
+          f"workers={cfg['workers']} api_latency={cfg['api_latency_ms']}ms rev={result['revision']}")
+    print(f"{'step':<14}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, s in [*result["steps"].items(), ("ALL", result["overall"])]:
+        print(f"{name:<14}{s['count']:>8}{s['p50_ms']:>10}{s['p95_ms']:>10}{s['p99_ms']:>10}{s['max_ms']:>10}")
+    print(f"throughput: {result['throughput_ups']} updates/s, "
+          f"API calls/update: {result['api_calls_per_update']} "
+          f"(+{result['webhook_replies_per_update']} in webhook responses), errors: {sum(result['errors'].values())}")
+    if result["errors"]:
+        print("errors:", dict(result["errors"]))
+    print("API calls:", dict(result["api_calls"]))
+    if result["webhook_replies"]:
+        print("webhook replies:", dict(result["webhook_replies"]))
+
+def compare(old_path: str, new_path: str):
+    with open(old_path, encoding="utf-8") as f:
+        old = json.load(f)
+    with open(new_path, encoding="utf-8") as f:
+        new = json.load(f)
+
+    def delta(a: float, b: float) -> str:
+        return f"{b:>9}  ({(b - a) / a * 100:+.1f}%)" if a else f"{b:>9}"
+
+    print(f"{old_path} ({old['revision']}) -> {new_path} ({new['revision']})")
+    print(f"throughput: {old['throughput_ups']} -> {delta(old['throughput_ups'], new['throughput_ups'])}")
+    print(f"API calls/update: {old['api_calls_per_update']} -> "
+          f"{delta(old['api_calls_per_update'], new['api_calls_per_update'])}")
+    for name in sorted(set(old["steps"]) | set(new["steps"])) + ["overall"]:
+        a = old["overall"] if name == "overall" else old["steps"].get(name)
+        b = new["overall"] if name == "overall" else new["steps"].get(name)
+        if not a or not b:
+            continue
+        cols = "  ".join(f"{p}: {a[p]} -> {delta(a[p], b[p])}" for p in ("p50_ms", "p95_ms", "p99_ms"))
+        print(f"  {name:<12} {cols}")
+
+# --- Main ---
+async def run_benchmark(args) -> dict:
+    api = FakeBotAPI(args.api_latency_ms, args.api_jitter_ms, args.api_flood_rate, args.api_flood_chat)
+    await api.start()
+    workdir = tempfile.mkdtemp(prefix="bench_kod_")
+    port = args.port or _free_port()
+    env = {
+        **os.environ,
+        "BOT_TOKEN": BOT_TOKEN,
+        "ADMIN_ID": str(ADMIN_ID),
+        "TELEGRAM_API_BASE": f"http://127.0.0.1:{api.port}",
+        "WEBHOOK_HOST": f"http://127.0.0.1:{port}",
+        "PORT": str(port),
+        "WEB_WORKERS": str(args.workers),
+        # --send-rate 0 turns the bot's send pacing off entirely; the admin
+        # sessions alone would exceed Telegram's per-chat rate.
+        "SEND_RATE_GLOBAL": str(args.send_rate),
+        **({} if args.send_rate else {"SEND_RATE_CHAT": "0", "SEND_RATE_GROUP": "0"}),
+        "WEBHOOK_REPLY": "1" if args.webhook_reply else "0",
+        "DB_FILE": args.db or os.path.join(workdir, "bench.db"),
+        "LOG_LEVEL": os.environ.get("LOG_LEVEL", "WARNING"),
+    }
+    seed_seconds = None
+    if not args.db or not os.path.exists(args.db):
+        print(f"seeding {args.movies} movies ...")
+        seed_seconds = await asyncio.to_thread(prepare_database, env, args.movies, args.channels)
+        print(f"seeded in {seed_seconds:.1f}s")
+    log_path = os.path.join(workdir, "bot.log")
+    proc = await start_bot(env, port, log_path)
+    try:
+        gen = LoadGenerator(args, api, port)
+        if args.warmup:
+            warm = argparse.Namespace(**{**vars(args), "duration": args.warmup})
+            await LoadGenerator(warm, api, port).run()
+            api.calls.clear()
+            api.webhook_calls.clear()
+        elapsed = await gen.run()
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"http://127.0.0.1:{port}/metrics") as r:
+                bot_metrics = scrape_metrics(await r.text())
+    finally:
+        stop_bot(proc)
+        await api.stop()
+    everything = [v for values in gen.latencies.values() for v in values]
+    return {
+        "label": args.label,
+        "revision": git_revision(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "config": {k: v for k, v in vars(args).items() if k not in ("compare", "out")},
+        "seed_seconds": seed_seconds,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_ups": round(len(everything) / elapsed, 1) if elapsed else 0.0,
+        "steps": {name: summarize(values) for name, values in sorted(gen.latencies.items())},
+        "overall": summarize(everything),
+        "api_calls_per_update": round(sum(gen.calls_per_update) / len(gen.calls_per_update), 2) if gen.calls_per_update else 0.0,
+        "webhook_replies_per_update": round(
+            sum(gen.webhook_replies_per_update) / len(gen.webhook_replies_per_update), 2
+        ) if gen.webhook_replies_per_update else 0.0,
+        "api_calls": dict(api.calls),
+        "webhook_replies": dict(api.webhook_calls),
+        "errors": dict(gen.errors),
+        "bot_metrics": bot_metrics,
+        "bot_log": log_path,
+    }
+
+# --- Dispatch micro-benchmark ---
+def dispatch_benchmark(sizes=(10, 30, 100, 300, 1000), budget: float = 1.0):
+    """In-process cost of routing one message through N text routes.
+
+    `linear` registers one aiogram handler per button with a lambda filter,
+    the layout tg_kod.py used to have; `router` registers the same buttons in
+    tg_kod.Router behind a single handler. Handlers do nothing and no request
+    leaves the process, so the numbers are pure dispatch cost. aiogram runs
+    plain (non-async) filters in its executor, which is most of the linear cost.
+    """
+    os.environ.setdefault("BOT_TOKEN", BOT_TOKEN)
+    os.environ.setdefault("ADMIN_ID", str(ADMIN_ID))
+    sys.path.insert(0, ROOT)
+    import tg_kod
+    from aiogram import Bot, Dispatcher
+    from aiogram.types import Update
+
+    async def noop(message):
+        pass
+
+    async def routed(message, route):
+        await route(message)
+
+    def linear(n: int) -> Dispatcher:
+        dp = Dispatcher()
+        for i in range(n):
+            dp.message.register(noop, lambda m, t=f"button {i}": m.text == t)
+        dp.message.register(noop, lambda m: bool(m.text))
+        return dp
+
+    def hashed(n: int) -> Dispatcher:
+        dp = Dispatcher()
+        router = tg_kod.Router()
+        for i in range(n):
+            router.text(f"button {i}")(noop)
+        router.default(noop)
+        dp.message.register(routed, router.match_message)
+        return dp
+
+    def update(text: str) -> Update:
+        return Update.model_validate({"update_id": 1, "message": {
+            "message_id": 1, "date": 0, "text": text,
+            "chat": {"id": 1, "type": "private"}, "from": {"id": 1, "is_bot": False, "first_name": "b"},
+        }}, context={"bot": bot})
+
+    async def per_update_us(dp: Dispatcher, upd: Update) -> float:
+        await dp.feed_update(bot, upd)
+        rounds = 0
+        started = time.perf_counter()
+        while rounds < 20 or time.perf_counter() - started < budget:
+            await dp.feed_update(bot, upd)
+            rounds += 1
+        return (time.perf_counter() - started) / rounds * 1e6
+
+    async def run():
+        print(f"{'routes':>8}{'linear text':>14}{'router text':>14}{'linear btn':>13}{'router btn':>13}   (us/update)")
+        for n in sizes:
+            text, button = update("12345"), update(f"button {n - 1}")
+            lin, hsh = linear(n), hashed(n)
+            row = [await per_update_us(lin, text), await per_update_us(hsh, text),
+                   await per_update_us(lin, button), await per_update_us(hsh, button)]
+            print(f"{n:>8}" + "".join(f"{v:>{w}.1f}" for v, w in zip(row, (14, 14, 13, 13))))
+
+    bot = Bot(BOT_TOKEN)
+    try:
+        asyncio.run(run())
+    finally:
+        asyncio.run(bot.session.close())
+
+def _free_port() -> int:
+    import socket
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    p.add_argument("--movies", type=int, default=1000, help="catalog size to seed (100 .. 1000000)")
+    p.add_argument("--rate", type=float, default=100, help="new user sessions per second")
+    p.add_argument("--duration", type=float, default=20, help="seconds of load")
+    p.add_argument("--warmup", type=float, default=3, help="seconds of unmeasured load first")
+    p.add_argument("--mix", default=DEFAULT_MIX, help="scenario weights")
+    p.add_argument("--skew", type=float, default=3.0, help="popularity skew; 1 = uniform codes")
+    p.add_argument("--miss-ratio", type=float, default=0.05, help="share of lookups for unknown codes")
+    p.add_argument("--channels", type=int, default=0, help="required channels (adds getChatMember calls)")
+    p.add_argument("--workers", type=int, default=1, help="WEB_WORKERS for the bot")
+    p.add_argument("--api-latency-ms", type=float, default=20, help="fake Bot API response delay")
+    p.add_argument("--api-jitter-ms", type=float, default=10, help="extra random delay up to this value")
+    p.add_argument("--api-flood-rate", type=float, default=0, help="fake API answers 429 above this many sends/s")
+    p.add_argument("--api-flood-chat", type=float, default=0, help="fake API answers 429 above this many sends/s per chat")
+    p.add_argument("--send-rate", type=float, default=0, help="bot's SEND_RATE_GLOBAL; 0 also disables per-chat pacing")
+    p.add_argument("--webhook-reply", action="store_true", help="bot answers with its first reply in the webhook response")
+    p.add_argument("--connections", type=int, default=256, help="max concurrent webhook connections")
+    p.add_argument("--step-timeout", type=float, default=10, help="seconds to wait for a step's replies")
+    p.add_argument("--port", type=int, default=0, help="bot port (default: a free one)")
+    p.add_argument("--db", help="reuse/keep this SQLite file (seeded only if missing)")
+    p.add_argument("--seed", type=int, default=1, help="random seed for the load mix")
+    p.add_argument("--label", default="run", help="name stored with the results")
+    p.add_argument("--out", default=os.path.join(ROOT, "bench_results"), help="results directory")
+    p.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two saved result files")
+    p.add_argument("--dispatch", action="store_true", help="only measure in-process routing cost per update")
+    return p.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.dispatch:
+        dispatch_benchmark()
+        return
+    result = asyncio.run(run_benchmark(args))
+    print_report(result)
+    os.makedirs(args.out, exist_ok=True)
+    path = os.path.join(args.out, f"{time.strftime('%Y%m%d-%H%M%S')}_{args.label}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"saved {path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""Storage backends against one suite.
+
+SQLite always runs; PostgreSQL runs when DATABASE_URL points at a database
+the tests may wipe (its public schema is dropped before every test).
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tg_kod  # noqa: E402
+
+PG_URL = os.getenv("DATABASE_URL", "")
+
+
+def _reset_postgres(url: str):
+    conn = tg_kod.psycopg2.connect(url)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public;")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+@pytest.fixture(params=[
+    "sqlite",
+    pytest.param("postgres", marks=pytest.mark.skipif(not PG_URL, reason="DATABASE_URL is not set")),
+])
+def storage(request, tmp_path):
+    if request.param == "sqlite":
+        st = tg_kod.SQLiteStorage(str(tmp_path / "test.db"), 2)
+    else:
+        _reset_postgres(PG_URL)
+        st = tg_kod.PostgresStorage(PG_URL, 2)
+    st.open()
+    st.call = lambda op, *args: asyncio.run(st.run(op, *args))
+    st.call("init_db")
+    yield st
+    st.close()
+
+
+def test_settings_roundtrip(storage):
+    assert storage.call("get_setting", "channels") is None
+    storage.call("set_setting", "channels", '["@a"]')
+    storage.call("set_setting", "channels", '["@a", "@b"]')
+    assert storage.call("get_setting", "channels") == '["@a", "@b"]'
+    storage.call("del_setting", "channels")
+    assert storage.call("get_setting", "channels") is None
+
+
+def test_movie_parts(storage):
+    assert storage.call("get_movie", "101") is None
+    storage.call("add_movie_part", "101", "Film", "first", "vid-1")
+    storage.call("add_movie_part", "101", "Film 2", "second", "vid-2")
+    storage.call("add_movie_part", "101", "Film 2", "again", "vid-2")  # same video: skipped
+    movie = storage.call("get_movie", "101")
+    assert movie["title"] == "Film"
+    assert [p["video"] for p in movie["parts"]] == ["vid-1", "vid-2"]
+    assert storage.call("update_part_video", "101", 0, "vid-9")
+    storage.call("delete_movie_part", "101", 1)
+    assert [p["video"] for p in storage.call("get_movie", "101")["parts"]] == ["vid-9"]
+    storage.call("delete_movie", "101")
+    assert storage.call("get_movie", "101") is None
+
+
+def test_import_movies_skips_existing(storage):
+    storage.call("add_movie_part", "7", "Seven", "", "v7")
+    entries = [
+        ("7", {"title": "Seven", "parts": [
+            {"title": "Seven", "video": "v7"},
+            {"title": "Seven 2", "video": "v7b"},
+            {"title": "Seven 3", "description": "soon"},
+        ]}),
+        ("8", {"title": "Eight", "video": "v8", "description": "d"}),
+    ]
+    assert storage.call("import_movies", entries) == (1, 3)
+    assert storage.call("import_movies", entries) == (0, 0)
+    seven = storage.call("get_movie", "7")
+    assert [p["title"] for p in seven["parts"]] == ["Seven", "Seven 2", "Seven 3"]
+    assert storage.call("get_movie", "8")["parts"][0]["description"] == "d"
+
+
+def test_import_movies_dedupes_video_less_parts(storage):
+    # Goes through the untyped "SELECT ? AS code ..." insert, which PostgreSQL
+    # has to PREPARE without parameter types.
+    entries = [
+        ("9", {"title": "Nine", "parts": [{"title": "a"}, {"title": "a"}]}),
+        ("9", {"title": "Nine", "parts": [{"title": "a"}, {"title": "b", "description": "x"}]}),
+    ]
+    assert storage.call("import_movies", entries) == (1, 2)
+    assert storage.call("import_movies", entries) == (0, 0)
+    assert [p["title"] for p in storage.call("get_movie", "9")["parts"]] == ["a", "b"]
+
+
+def test_catalog_page(storage):
+    codes = [f"{i:03d}" for i in range(25)]
+    storage.call("import_movies", [(code, {"title": f"M{code}", "video": f"v{code}"}) for code in codes])
+    first = storage.call("catalog_page", None, None, 10)
+    assert [row[0] for row in first] == codes[:10]
+    assert all(row[2] == 1 for row in first)
+    second = storage.call("catalog_page", first[-1][0], None, 10)
+    assert [row[0] for row in second] == codes[10:20]
+    back = storage.call("catalog_page", None, second[0][0], 10)
+    assert back == first
+    last = storage.call("catalog_page", codes[19], None, 10)
+    assert [row[0] for row in last] == codes[20:]
+
+
+def test_delete_part_renumbers(storage):
+    for n in range(1, 4):
+        storage.call("add_movie_part", "12", "Twelve", f"p{n}", f"v{n}")
+    assert storage.call("delete_movie_part", "12", 0) == {"title": "Twelve"}
+    assert storage.call("delete_movie_part", "12", 5) is None
+    storage.call("add_movie_part", "12", "Twelve", "p4", "v4")
+    assert [p["video"] for p in storage.call("get_movie", "12")["parts"]] == ["v2", "v3", "v4"]
+    # Ordinals are 1..n again, so a positional update hits the right part.
+    assert storage.call("update_part_video", "12", 1, "v3b")
+    assert not storage.call("update_part_video", "12", 0, "v4")  # that video is already another part's
+    assert not storage.call("update_part_video", "12", 7, "v9")
+    assert [p["video"] for p in storage.call("get_movie", "12")["parts"]] == ["v2", "v3b", "v4"]
+
+
+def test_update_last_part_video(storage):
+    storage.call("add_movie_part", "13", "Thirteen", "", "a")
+    storage.call("add_movie_part", "13", "Thirteen 2", "", "b")
+    assert storage.call("update_part_video", "13", None, "b2")
+    assert [p["video"] for p in storage.call("get_movie", "13")["parts"]] == ["a", "b2"]
+    # Without any part yet, repair creates the movie with one part.
+    assert storage.call("update_part_video", "14", None, "c")
+    assert storage.call("get_movie", "14")["parts"][0]["video"] == "c"
+
+
+def test_views_top_and_trending(storage):
+    for code in ("a", "b", "c"):
+        storage.call("add_movie_part", code, code.upper(), "", f"v{code}")
+    storage.call("add_views", {"a": 5, "b": 2}, 100)
+    storage.call("add_views", {"b": 10}, 110)
+    storage.call("add_views", {"c": 1}, 111, 105)  # prunes buckets before 105
+    assert storage.call("top_views", 2, [])[:2] == [("b", "B", 12), ("a", "A", 5)]
+    assert ("c", "C", 1) in storage.call("top_views", 1, ["c"])
+    assert storage.call("trending", 105, 10, []) == [("b", "B", 10), ("c", "C", 1)]
+    assert storage.call("trending", 0, 10, []) == [("b", "B", 10), ("c", "C", 1)]
+    assert ("a", "A", 0) in storage.call("trending", 105, 1, ["a"])
+    storage.call("delete_movie", "b")
+    assert [row[0] for row in storage.call("trending", 0, 10, [])] == ["c"]
+
+
+def test_recommend_rows_and_video_parts(storage):
+    storage.call("import_movies", [
+        ("r1", {"title": "R1", "parts": [{"title": "x", "video": "v1"}, {"title": "y"}]}),
+        ("r2", {"title": "R2", "parts": [{"title": "z", "description": "d", "video": "v2"}]}),
+    ])
+    assert [(code, views) for code, _, views in storage.call("recommend_rows")] == [("r1", 0), ("r2", 0)]
+    assert len(storage.call("recommend_rows", "r2")) == 1
+    rows = storage.call("video_parts", ["r2", "r1"])
+    assert [(code, title, video) for code, _, _, title, _, video in rows] == [("r1", "x", "v1"), ("r2", "z", "v2")]
+    assert storage.call("video_parts", []) == []
+
+
+def test_search(storage):
+    storage.call("add_movie_part", "s1", "O‘zbek jangchi", "Tarixiy film", "v1")
+    storage.call("add_movie_part", "s2", "Jangchi qaytishi", "Davomi", "v2")
+    storage.call("add_movie_part", "s3", "Café", "Komediya", "v3")
+    assert {code for code, _ in storage.call("search", "jangchi", 10)} == {"s1", "s2"}
+    assert [code for code, _ in storage.call("search", "ozbek", 10)] == ["s1"]
+    assert [code for code, _ in storage.call("search", "o'zbek", 10)] == ["s1"]
+    assert [code for code, _ in storage.call("search", "cafe", 10)] == ["s3"]
+    assert [code for code, _ in storage.call("search", "tarixiy", 10)] == ["s1"]
+    assert len(storage.call("search", "jangchi", 1)) == 1
+    assert len(storage.call("search", "jangchi", 10, 1)) == 1
+    assert storage.call("search", "   ", 10) == []
+    storage.call("delete_movie", "s1")
+    assert [code for code, _ in storage.call("search", "jangchi", 10)] == ["s2"]
+    assert storage.call("rebuild_search") == 2
+    assert [code for code, _ in storage.call("search", "davomi", 10)] == ["s2"]
+
+
+def test_user_state(storage):
+    storage.call("state_set", 1, "code", "123", 200.0)
+    storage.call("state_set", 1, "part", {"idx": 2}, 50.0)
+    storage.call("state_set", 1, "code", "456", 200.0)
+    storage.call("state_set", 2, "code", "9", 300.0)
+    assert storage.call("state_get", 1, ("code", "part"), 10.0) == {"code": "456", "part": {"idx": 2}}
+    assert storage.call("state_get", 1, ("code", "part"), 100.0) == {"code": "456"}
+    assert storage.call("state_pop", 1, "part", 100.0) is None  # expired, but removed all the same
+    assert storage.call("state_pop", 1, "code", 100.0) == "456"
+    assert storage.call("state_pop", 1, "code", 100.0) is None
+    storage.call("state_set", 1, "a", 1, 400.0)
+    storage.call("state_set", 1, "b", 2, 500.0)
+    storage.call("state_delete", 1, ("a",))
+    assert storage.call("state_get", 1, ("a", "b"), 0.0) == {"b": 2}
+    assert storage.call("state_count") == 2
+    assert storage.call("state_purge", 0.0, 1) == 1  # over the cap: the soonest to expire goes
+    assert storage.call("state_get", 1, ("b",), 0.0) == {"b": 2}
+    assert storage.call("state_purge", 1000.0, 10) == 1
+    assert storage.call("state_count") == 0
+
+
+def test_update_claims_and_catalog_changes(storage):
+    assert storage.call("claim_update", 77, 10.0)
+    assert not storage.call("claim_update", 77, 11.0)
+    assert storage.call("claim_update", 78, 20.0)
+    assert storage.call("purge_updates", 15.0) == 1
+    assert storage.call("claim_update", 77, 30.0)
+
+    assert storage.call("last_catalog_change") == 0
+    first = storage.call("log_catalog_change", "a", 10.0)
+    storage.call("log_catalog_changes", ["b", "c"], 20.0)
+    assert [code for _, code in storage.call("catalog_changes", first, 10)] == ["b", "c"]
+    assert [code for _, code in storage.call("catalog_changes", 0, 1)] == ["a"]
+    last = storage.call("last_catalog_change")
+    assert last > first
+    assert storage.call("purge_catalog_changes", 15.0) == 1
+    assert storage.call("last_catalog_change") == last
+
+
+def test_users_and_broadcasts(storage):
+    storage.call("upsert_users", [(3, "C", None, 1.0), (1, "A", "a", 1.0), (2, "B", "b", 1.0)])
+    storage.call("mark_users_blocked", [2], 5.0)
+    assert storage.call("user_counts") == (3, 1)
+    assert storage.call("users_after", 0, 10) == [1, 3]
+    assert storage.call("users_after", 1, 1) == [3]
+    storage.call("upsert_users", [(2, "B", "b", 6.0)])  # writing again unblocks
+    assert storage.call("user_counts") == (3, 0)
+
+    job = storage.call("create_broadcast", 500, 42, 10.0)
+    assert job["status"] == "running" and job["total"] == 3 and job["message_id"] == 42
+    assert storage.call("create_broadcast", 500, 43, 11.0) is None  # one running job at a time
+    job.update(last_user_id=2, sent=2, blocked=0, failed=0)
+    assert storage.call("save_broadcast", job, "running", 12.0)
+    storage.call("heartbeat_broadcast", job["id"], 20.0)
+    assert storage.call("claim_broadcast", 25.0, 15.0) is None  # heartbeat is fresh
+    claimed = storage.call("claim_broadcast", 40.0, 30.0)
+    assert claimed["id"] == job["id"] and claimed["last_user_id"] == 2
+    assert storage.call("cancel_broadcast", 41.0) == job["id"]
+    assert storage.call("cancel_broadcast", 42.0) is None
+    assert not storage.call("save_broadcast", job, "done", 43.0, 43.0)  # cancelled elsewhere
+    assert storage.call("last_broadcast")["status"] == "cancelled"
+    assert storage.call("create_broadcast", 500, 44, 50.0) is not None
+
+
+def test_sqlite_v2_logs_removed_duplicate_parts(monkeypatch):
+    import sqlite3
+    events = []
+    monkeypatch.setattr(tg_kod, "log_event", lambda event, *args, **fields: events.append((event, fields)))
+    conn = sqlite3.connect(":memory:")
+    cur = conn.cursor()
+    tg_kod._sqlite_schema_v1(cur)
+    cur.executemany("INSERT INTO parts (movie_code, title, description, video) VALUES (?, ?, ?, ?)", [
+        ("101", "a", "", "vid-1"), ("101", "b", "", "vid-1"), ("101", "c", "", "vid-1"),
+        ("102", "a", "", "vid-2"), ("102", "b", "", "vid-3"),
+        ("103", "a", "", None), ("103", "b", "", None),
+    ])
+    tg_kod._sqlite_schema_v2(cur)
+    assert [f for e, f in events if e == "MIGRATION_DUPLICATE_PARTS_REMOVED"] == [{"code": "101", "removed": 2}]
+    assert ("MIGRATION_DUPLICATE_PARTS_TOTAL", {"movies": 1, "removed": 2}) in events
+    assert cur.execute("SELECT COUNT(*) FROM parts").fetchone()[0] == 5
+    conn.close()
@@ -1,19 +1,51 @@
 # tg_kod.py
 import os
+import sys
 import json
+import gzip
+import time
+import atexit
+import logging
+import logging.handlers
+import queue
+import re
 import sqlite3
+import heapq
+import bisect
 import random
+import signal
+import socket
+import asyncio
+import functools
+import contextvars
+import itertools
+import threading
+import unicodedata
+import codecs
+import collections
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 from aiohttp import web
-from aiogram import Bot, Dispatcher
+from aiogram import Bot, Dispatcher, BaseMiddleware
 from aiogram.types import (
-    Message, ReplyKeyboardMarkup, KeyboardButton,
-    InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+    FSInputFile, Message, ReplyKeyboardMarkup, KeyboardButton,
+    InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, Update,
+    InlineQuery, InlineQueryResultCachedVideo, InlineQueryResultsButton
 )
-from aiogram.filters import Command
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 
+try:
+    import psycopg2
+    import psycopg2.extras
+except ImportError:  # only needed for STORAGE_BACKEND=postgres
+    psycopg2 = None
+
 # --- Configuration ---
 BOT_TOKEN = os.getenv("BOT_TOKEN", "PUT_YOUR_TOKEN_HERE")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "1629210003"))
@@ -22,20 +54,1295 @@ WEBHOOK_PATH = "/webhook"
 WEBHOOK_URL = f"{WEBHOOK_HOST}{WEBHOOK_PATH}"
 WEB_SERVER_HOST = "0.0.0.0"
 WEB_SERVER_PORT = int(os.getenv("PORT", "8080"))
+# >1 forks that many worker processes sharing the port via SO_REUSEPORT
+WEB_WORKERS = max(1, int(os.getenv("WEB_WORKERS", "1")))
+WORKER_ID = 0
+# Alternative Bot API server, e.g. a self-hosted telegram-bot-api or the fake
+# server in bench_kod.py; empty means api.telegram.org
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "").rstrip("/")
+
+def create_bot() -> Bot:
+    if not TELEGRAM_API_BASE:
+        return Bot(token=BOT_TOKEN)
+    session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_BASE))
+    return Bot(token=BOT_TOKEN, session=session)
 
-bot = Bot(token=BOT_TOKEN)
+bot = create_bot()
 dp = Dispatcher()
 
-# --- Database file path ---
+# --- Logging ---
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()  # text | json
+# Share of high-volume per-request events that are written (1 = all)
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.1"))
+
+log = logging.getLogger("kino")
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {"ts": round(record.created, 3), "level": record.levelname, "logger": record.name}
+        data["event"] = record.getMessage()
+        data.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+class TextLogFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        fields = getattr(record, "fields", None)
+        if fields is None:
+            line = f"{record.name}: {record.getMessage()}"
+        else:
+            line = f"[{record.getMessage()}] " + " ".join(f"{k}={v}" for k, v in fields.items())
+        line = f"{self.formatTime(record)} {record.levelname} {line.rstrip()}"
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+class _LocalQueueHandler(logging.handlers.QueueHandler):
+    # The listener runs in this process, so records are passed as-is and all
+    # formatting (including tracebacks) happens on its thread, not the loop.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Route every logger through a queue to one stdout writer thread."""
+    out = logging.StreamHandler(sys.stdout)
+    out.setFormatter(JsonLogFormatter() if LOG_FORMAT == "json" else TextLogFormatter())
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers[:] = [_LocalQueueHandler(records)]
+    root.setLevel(logging.WARNING)  # aiogram/aiohttp log every update at INFO
+    log.setLevel(LOG_LEVEL)
+    listener = logging.handlers.QueueListener(records, out)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+def log_event(event: str, level: int = logging.INFO, sample: float = 1.0, **fields):
+    """Log `event` with structured fields; `sample` < 1 keeps only that share."""
+    if not log.isEnabledFor(level):
+        return
+    if sample < 1.0:
+        if random.random() >= sample:
+            return
+        fields["sampled"] = sample
+    log.log(level, event, extra={"fields": fields})
+
+log_listener = setup_logging()
+
+# --- Metrics ---
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 8, 13, 21)
+
+def _label_str(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, n: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + n
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = list(self._values.items())
+        for values, v in items:
+            lines.append(f"{self.name}{_label_str(self.labels, values)} {v}")
+        return lines
+
+class Histogram:
+    """Cumulative-bucket histogram; observe() is a bisect and three additions."""
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series: dict[tuple, list] = {}  # labels -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            series[i] += 1
+            series[-1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(values, list(series)) for values, series in self._series.items()]
+        names = self.labels + ("le",)
+        for values, series in items:
+            total = 0
+            for bound, n in zip(self.buckets + ("+Inf",), series):
+                total += n
+                lines.append(f"{self.name}_bucket{_label_str(names, values + (bound,))} {total}")
+            lines.append(f"{self.name}_sum{_label_str(self.labels, values)} {series[-1]}")
+            lines.append(f"{self.name}_count{_label_str(self.labels, values)} {total}")
+        return lines
+
+class Gauge:
+    """Read at scrape time from `collect()`, which returns {label values: value}.
+
+    `kind="counter"` exposes totals that other components already keep.
+    """
+
+    def __init__(self, name: str, help: str, labels: tuple, collect, kind: str = "gauge"):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+        self.kind = kind
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, v in self.collect().items():
+            lines.append(f"{self.name}{_label_str(self.labels, values)} {v}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: list = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name: str, help: str, labels: tuple, collect, kind: str = "gauge") -> Gauge:
+        return self.register(Gauge(name, help, labels, collect, kind))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                log_event("METRICS_RENDER_ERROR", logging.WARNING, metric=metric.name, error=e)
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+m_updates = metrics.counter("bot_updates_total", "Webhook updates received", ("type",))
+m_update_seconds = metrics.histogram("bot_update_seconds", "Time to process one update", ("type",))
+m_handler_calls = metrics.counter("bot_handler_calls_total", "Handler invocations", ("handler", "status"))
+m_handler_seconds = metrics.histogram("bot_handler_seconds", "Handler latency", ("handler",))
+m_fn_seconds = metrics.histogram("bot_function_seconds", "Latency of instrumented helpers", ("fn",))
+m_db_queries = metrics.counter("db_queries_total", "Storage operations", ("op", "status"))
+m_db_query_seconds = metrics.histogram("db_query_seconds", "Storage operation run time", ("op",))
+m_db_wait_seconds = metrics.histogram("db_pool_wait_seconds", "Time waiting for a pooled connection")
+m_api_calls = metrics.counter("bot_api_calls_total", "Bot API requests", ("method",))
+m_api_errors = metrics.counter("bot_api_errors_total", "Failed Bot API requests", ("method", "error"))
+m_api_seconds = metrics.histogram("bot_api_seconds", "Bot API request latency", ("method",))
+m_api_per_update = metrics.histogram(
+    "bot_api_calls_per_update", "Bot API requests made while handling one update", buckets=COUNT_BUCKETS
+)
+
+# Per-update Bot API call counter; set by UpdateMetrics, bumped by ApiMetrics.
+_update_api_calls: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar("update_api_calls", default=None)
+
+def timed(fn):
+    """Record an async function's latency under bot_function_seconds{fn=...}."""
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            m_fn_seconds.observe(time.perf_counter() - started, name)
+    return wrapper
+
+class UpdateMetrics(BaseMiddleware):
+    """Outer update middleware: throughput, latency and API calls per update."""
+
+    async def __call__(self, handler, event: Update, data: dict):
+        kind = event.event_type
+        m_updates.inc(kind)
+        calls = [0]
+        token = _update_api_calls.set(calls)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            m_update_seconds.observe(time.perf_counter() - started, kind)
+            m_api_per_update.observe(calls[0])
+            _update_api_calls.reset(token)
+
+class HandlerMetrics(BaseMiddleware):
+    """Inner middleware: runs only once a handler matched, labelled by its (routed) name."""
+
+    async def __call__(self, handler, event, data: dict):
+        name = data.get("route", data["handler"].callback).__name__
+        status = "ok"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            m_handler_seconds.observe(time.perf_counter() - started, name)
+            m_handler_calls.inc(name, status)
+
+class ApiMetrics(BaseRequestMiddleware):
+    """Bot session middleware counting outgoing requests, errors and 429s."""
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        calls = _update_api_calls.get()
+        if calls is not None:
+            calls[0] += 1
+        m_api_calls.inc(name)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            m_api_errors.inc(name, "429")
+            raise
+        except Exception as e:
+            m_api_errors.inc(name, type(e).__name__)
+            raise
+        finally:
+            m_api_seconds.observe(time.perf_counter() - started, name)
+
+dp.update.outer_middleware(UpdateMetrics())
+dp.message.middleware(HandlerMetrics())
+dp.callback_query.middleware(HandlerMetrics())
+dp.inline_query.middleware(HandlerMetrics())
+
+# --- Outbound sends ---
+# Telegram allows roughly 30 messages/s overall, about one per second per
+# chat with short bursts, and 20/min in groups. rate + burst is the most that
+# can go out in any one second. 0 disables a limit.
+SEND_RATE_GLOBAL = float(os.getenv("SEND_RATE_GLOBAL", "25"))
+SEND_BURST_GLOBAL = int(os.getenv("SEND_BURST_GLOBAL", "5"))
+SEND_RATE_CHAT = float(os.getenv("SEND_RATE_CHAT", "1"))
+SEND_RATE_GROUP = float(os.getenv("SEND_RATE_GROUP", str(20 / 60)))
+SEND_BURST_CHAT = int(os.getenv("SEND_BURST_CHAT", "5"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+SEND_CHAT_BUCKETS = int(os.getenv("SEND_CHAT_BUCKETS", "100000"))
+# Methods that count against the message limits
+SEND_METHODS = frozenset({
+    "sendMessage", "sendVideo", "sendPhoto", "sendDocument", "sendAnimation", "sendAudio",
+    "sendMediaGroup", "copyMessage", "forwardMessage", "editMessageText", "editMessageCaption",
+})
+LANE_INTERACTIVE, LANE_BULK = 0, 1
+LANES = ("interactive", "bulk")
+# Bulk jobs (broadcasts) set this inside their own task
+send_lane: contextvars.ContextVar[int] = contextvars.ContextVar("send_lane", default=LANE_INTERACTIVE)
+
+m_send_wait_seconds = metrics.histogram("send_queue_wait_seconds", "Time a send waited for rate limit tokens", ("lane",))
+m_send_retries = metrics.counter("send_retry_after_total", "Sends that hit 429 Too Many Requests", ("method", "outcome"))
+
+class TokenBucket:
+    """Reservation bucket: reserve() always takes a token and returns how long
+    the caller has to wait for it, so callers queue up in arrival order."""
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def ready_in(self, now: float) -> float:
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def reserve(self, now: float) -> float:
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def penalize(self, now: float, seconds: float):
+        """Nothing goes out for `seconds` (Telegram's retry_after)."""
+        self._refill(now)
+        self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+class SendScheduler(BaseRequestMiddleware):
+    """Bot session middleware pacing sends under Telegram's flood limits.
+
+    Each send first waits for its chat's bucket (FIFO per chat), then for a
+    global token. Global tokens go to waiting interactive sends before bulk
+    ones. A 429 pauses that chat (or everything, without a chat) for
+    retry_after and the send is retried up to SEND_MAX_RETRIES times.
+    Registered before ApiMetrics, which then counts every actual attempt.
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(SEND_RATE_GLOBAL, SEND_BURST_GLOBAL) if SEND_RATE_GLOBAL > 0 else None
+        self.chats: OrderedDict = OrderedDict()
+        self._waiters: list = []
+        self._seq = itertools.count()
+        self._pump_task: Optional[asyncio.Task] = None
+        self.depth = [0, 0]
+        self.retried = 0
+        self.gave_up = 0
+
+    def _chat_bucket(self, chat_id) -> Optional[TokenBucket]:
+        if isinstance(chat_id, str) or chat_id < 0:
+            rate = SEND_RATE_GROUP
+        else:
+            rate = SEND_RATE_CHAT
+        if rate <= 0:
+            return None
+        b = self.chats.get(chat_id)
+        if b is None:
+            b = self.chats[chat_id] = TokenBucket(rate, SEND_BURST_CHAT)
+            if len(self.chats) > SEND_CHAT_BUCKETS:
+                self.chats.popitem(last=False)
+        else:
+            self.chats.move_to_end(chat_id)
+        return b
+
+    async def _acquire(self, chat_id, lane: int):
+        if chat_id is not None:
+            b = self._chat_bucket(chat_id)
+            delay = b.reserve(time.monotonic()) if b else 0.0
+            if delay:
+                await asyncio.sleep(delay)
+        gb = self.global_bucket
+        if gb is None:
+            return
+        if not self._waiters and not gb.ready_in(time.monotonic()):
+            gb.reserve(time.monotonic())
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (lane, next(self._seq), fut))
+        if self._pump_task is None:
+            self._pump_task = asyncio.create_task(self._pump())
+        await fut
+
+    async def _pump(self):
+        gb = self.global_bucket
+        while self._waiters:
+            wait = gb.ready_in(time.monotonic())
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+            _lane, _seq, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                gb.reserve(time.monotonic())
+                fut.set_result(None)
+        self._pump_task = None
+
+    def _penalize(self, chat_id, seconds: float):
+        b = self._chat_bucket(chat_id) if chat_id is not None else None
+        b = b or self.global_bucket
+        if b is not None:
+            b.penalize(time.monotonic(), seconds)
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        if name not in SEND_METHODS:
+            return await make_request(bot, method)
+        lane = send_lane.get()
+        chat_id = getattr(method, "chat_id", None)
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            self.depth[lane] += 1
+            try:
+                await self._acquire(chat_id, lane)
+            finally:
+                self.depth[lane] -= 1
+            m_send_wait_seconds.observe(time.monotonic() - started, LANES[lane])
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                self._penalize(chat_id, e.retry_after)
+                if attempt > SEND_MAX_RETRIES:
+                    self.gave_up += 1
+                    m_send_retries.inc(name, "gave_up")
+                    log_event("SEND_GAVE_UP", logging.WARNING, method=name, chat_id=chat_id, retry_after=e.retry_after)
+                    raise
+                self.retried += 1
+                m_send_retries.inc(name, "retried")
+                log_event("SEND_RETRY_AFTER", logging.INFO, method=name, chat_id=chat_id, retry_after=e.retry_after, attempt=attempt)
+
+    def stats(self) -> dict:
+        return {
+            "interactive": self.depth[LANE_INTERACTIVE], "bulk": self.depth[LANE_BULK],
+            "chats": len(self.chats), "retried": self.retried, "gave_up": self.gave_up,
+        }
+
+send_scheduler = SendScheduler()
+metrics.gauge(
+    "send_queue_depth", "Sends waiting for rate limit tokens", ("lane",),
+    lambda: {(lane,): send_scheduler.depth[i] for i, lane in enumerate(LANES)}
+)
+
+# Telegram accepts one Bot API call as the body of the webhook response and
+# runs it itself, which saves the bot an outbound round trip. Updates are
+# then handled before the webhook is answered instead of in the background.
+WEBHOOK_REPLY = os.getenv("WEBHOOK_REPLY", "0") == "1"
+WEBHOOK_REPLY_METHODS = frozenset(
+    m.strip() for m in os.getenv("WEBHOOK_REPLY_METHODS", "sendMessage,sendVideo").split(",") if m.strip()
+)
+# A reply held longer than this (the handler is still busy) is sent normally
+WEBHOOK_REPLY_MAX_HOLD = float(os.getenv("WEBHOOK_REPLY_MAX_HOLD", "1"))
+
+m_webhook_replies = metrics.counter(
+    "bot_webhook_replies_total", "Replies held back for the webhook response", ("method", "outcome")
+)
+
+class _PendingReply:
+    __slots__ = ("task", "call", "timer", "sending", "closed")
+
+    def __init__(self):
+        self.task = asyncio.current_task()
+        self.call = None  # (make_request, bot, method) held back
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.sending: Optional[asyncio.Future] = None
+        self.closed = False  # past the first call: everything else goes out as usual
+
+_pending_reply: contextvars.ContextVar[Optional[_PendingReply]] = contextvars.ContextVar("pending_reply", default=None)
+
+class WebhookReplies(BaseRequestMiddleware):
+    """Returns an update's first reply as the webhook response.
+
+    `wrap_update` (an outer update middleware) opens a slot per update. If
+    the first call made by the update's own task is an eligible send, it is
+    held back and answered with None; handlers here never use what a send
+    returns. Every later call goes out as usual, after sending the held one
+    first so replies keep their order. A reply still held when the handler
+    returns becomes the response body.
+
+    Errors of the held call never reach the handler: Telegram does not
+    report them for a call in the response, and when it is sent later they
+    are only logged. So the TelegramBadRequest fallbacks around a first
+    answer_video cannot fire in this mode. Later calls are unaffected.
+    Registered before SendScheduler, so a held call sent later is still
+    paced and retried on 429; the one in the response skips pacing.
+    """
+
+    def __init__(self):
+        self.held = 0
+        self.responded = 0
+        self.flushed = 0
+        self._tasks: set = set()
+
+    async def _send(self, make_request, bot, method, outcome: str):
+        self.flushed += 1
+        m_webhook_replies.inc(method.__api_method__, outcome)
+        try:
+            await make_request(bot, method)
+        except Exception as e:
+            log_event("WEBHOOK_REPLY_SEND_ERROR", logging.WARNING, method=method.__api_method__, error=e)
+
+    def _release(self, pending: _PendingReply, outcome: str):
+        """Start sending the held call; later calls wait for it (`sending`)."""
+        call, pending.call = pending.call, None
+        if pending.timer is not None:
+            pending.timer.cancel()
+            pending.timer = None
+        if call is not None:
+            pending.sending = asyncio.ensure_future(self._send(*call, outcome))
+            self._tasks.add(pending.sending)
+            pending.sending.add_done_callback(self._tasks.discard)
+
+    async def __call__(self, make_request, bot, method):
+        pending = _pending_reply.get()
+        if pending is None or pending.task is not asyncio.current_task():
+            return await make_request(bot, method)
+        if not pending.closed:
+            pending.closed = True
+            if method.__api_method__ in WEBHOOK_REPLY_METHODS:
+                pending.call = (make_request, bot, method)
+                pending.timer = asyncio.get_running_loop().call_later(
+                    WEBHOOK_REPLY_MAX_HOLD, self._release, pending, "timeout"
+                )
+                self.held += 1
+                return None
+        self._release(pending, "sent")
+        if pending.sending is not None:
+            await pending.sending
+            pending.sending = None
+        return await make_request(bot, method)
+
+    async def wrap_update(self, handler, event: Update, data: dict):
+        pending = _PendingReply()
+        token = _pending_reply.set(pending)
+        try:
+            await handler(event, data)
+        except Exception as e:
+            # Raising would answer the webhook with a 500 and Telegram would
+            # redeliver the update; background handling only logs it too.
+            log_event("UPDATE_ERROR", logging.ERROR, update_id=event.update_id, error=e)
+        finally:
+            _pending_reply.reset(token)
+            if pending.timer is not None:
+                pending.timer.cancel()
+        if pending.call is None:
+            return None
+        _, _, method = pending.call
+        self.responded += 1
+        m_webhook_replies.inc(method.__api_method__, "response")
+        return method
+
+    def stats(self) -> dict:
+        return {"enabled": WEBHOOK_REPLY, "held": self.held, "responded": self.responded, "flushed": self.flushed}
+
+webhook_replies = WebhookReplies()
+if WEBHOOK_REPLY:
+    bot.session.middleware(webhook_replies)
+    dp.update.outer_middleware(webhook_replies.wrap_update)
+bot.session.middleware(send_scheduler)
+bot.session.middleware(ApiMetrics())
+
+# --- Storage ---
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite").lower()
+DATABASE_URL = os.getenv("DATABASE_URL", "")
 DB_FILE = os.getenv("DB_FILE", "movies.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "200"))
+DB_CACHE_KB = int(os.getenv("DB_CACHE_KB", "16384"))
+DB_MMAP_MB = int(os.getenv("DB_MMAP_MB", "256"))
+# Server-side prepared statements kept per PostgreSQL connection
+PG_PREPARED_MAX = int(os.getenv("PG_PREPARED_MAX", "200"))
+
+class DBPool:
+    """Long-lived database connections served by a dedicated thread pool.
+
+    Each query function receives a pooled connection and runs on a pool
+    thread, so the event loop never blocks on file I/O or fsync. The pool
+    commits on success and rolls back on error.
+    """
+
+    def __init__(self, size: int, connect, label: str):
+        self.size = max(1, size)
+        self.label = label
+        self._connect = connect
+        self._idle: queue.SimpleQueue = queue.SimpleQueue()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.query_total = 0.0
+        self.query_max = 0.0
+
+    def open(self):
+        if self._executor is not None:
+            return
+        for _ in range(self.size):
+            self._idle.put(self._connect())
+        self._executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="db")
+        log_event("DB_POOL_OPENED", size=self.size, target=self.label)
+
+    def close(self):
+        if self._executor is None:
+            return
+        self._executor.shutdown(wait=True)
+        self._executor = None
+        while not self._idle.empty():
+            self._idle.get().close()
+        log_event("DB_POOL_CLOSED")
+
+    def _execute(self, submitted: float, fn, args, kwargs):
+        started = time.perf_counter()
+        conn = self._idle.get()
+        ok = False
+        try:
+            result = fn(conn, *args, **kwargs)
+            conn.commit()
+            ok = True
+            return result
+        except Exception:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            # A dropped server connection is replaced instead of being handed out again.
+            if getattr(conn, "closed", 0):
+                log_event("DB_POOL_RECONNECT", logging.WARNING, fn=fn.__name__)
+                conn = self._connect()
+            raise
+        finally:
+            self._idle.put(conn)
+            self._record(fn.__name__, started - submitted, time.perf_counter() - started, ok)
+
+    def _record(self, name: str, wait: float, query: float, ok: bool):
+        with self._lock:
+            self.calls += 1
+            if not ok:
+                self.errors += 1
+            self.wait_total += wait
+            self.query_total += query
+            self.wait_max = max(self.wait_max, wait)
+            self.query_max = max(self.query_max, query)
+        m_db_queries.inc(name, "ok" if ok else "error")
+        m_db_query_seconds.observe(query, name)
+        m_db_wait_seconds.observe(wait)
+        if (wait + query) * 1000 >= DB_SLOW_QUERY_MS:
+            log_event("DB_SLOW", logging.WARNING, fn=name, wait_ms=round(wait * 1000, 1), query_ms=round(query * 1000, 1))
+
+    async def run(self, fn, *args, **kwargs):
+        if self._executor is None:
+            self.open()
+        loop = asyncio.get_running_loop()
+        submitted = time.perf_counter()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(self._execute, submitted, fn, args, kwargs)
+        )
+
+    def stats(self) -> dict:
+        with self._lock:
+            calls = self.calls or 1
+            return {
+                "calls": self.calls,
+                "errors": self.errors,
+                "wait_avg_ms": self.wait_total / calls * 1000,
+                "wait_max_ms": self.wait_max * 1000,
+                "query_avg_ms": self.query_total / calls * 1000,
+                "query_max_ms": self.query_max * 1000,
+            }
+
+def _keyset_where(after_code: Optional[str]) -> tuple[str, tuple]:
+    # The first page starts at '' inclusive so an empty-string code is not skipped.
+    if after_code is None:
+        return "code >= ''", ()
+    return "code > ?", (after_code,)
+
+# Every apostrophe people type in Uzbek Latin (o‘, o', oʻ, o`, o’)
+_SEARCH_APOSTROPHES = str.maketrans("", "", "'‘’ʻʼ`´")
+_SEARCH_TOKEN = re.compile(r"[^\W_]+")
+
+def normalize_search_text(text: Optional[str]) -> str:
+    """Case-, diacritic- and apostrophe-folded text for the search index and
+    for queries alike, so "O‘zbek", "o'zbek" and "ozbek" all match."""
+    text = unicodedata.normalize("NFKD", (text or "").translate(_SEARCH_APOSTROPHES).casefold())
+    return "".join(ch for ch in text if not unicodedata.combining(ch))
+
+def search_terms(query: str, limit: int = 6) -> list[str]:
+    """Normalized query tokens; single letters are dropped unless they are all there is."""
+    tokens = _SEARCH_TOKEN.findall(normalize_search_text(query))
+    return ([t for t in tokens if len(t) > 1] or tokens)[:limit]
+
+class Storage:
+    """Movies, parts and settings behind one interface for every backend.
+
+    Each operation is a method `op(conn, ...)` that runs on a pooled
+    connection in a worker thread; call it with `await storage.run("op", ...)`.
+    Queries use `?` placeholders and stick to SQL that SQLite and PostgreSQL
+    both accept, so a backend only overrides connection handling, schema
+    migrations and the few statements that really differ.
+    """
+
+    name = "base"
+    migrations: list = []
+    supports_backup = False  # whether backup() is implemented; PostgreSQL has pg_dump for that
 
-def get_conn():
-    return sqlite3.connect(DB_FILE, check_same_thread=False)
+    def __init__(self, pool_size: int):
+        self.pool = DBPool(pool_size, self.connect, self.describe())
 
-def init_db():
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("PRAGMA foreign_keys = ON;")
+    # Connection and pool plumbing
+    def connect(self):
+        raise NotImplementedError
+
+    def describe(self) -> str:
+        return self.name
+
+    def open(self):
+        self.pool.open()
+
+    def close(self):
+        self.pool.close()
+
+    def stats(self) -> dict:
+        return {"backend": self.name, **self.pool.stats()}
+
+    async def run(self, op: str, *args, **kwargs):
+        return await self.pool.run(getattr(self, op), *args, **kwargs)
+
+    def _exec(self, conn, sql: str, params: tuple = ()):
+        raise NotImplementedError
+
+    def _exec_many(self, conn, sql: str, seq: list):
+        raise NotImplementedError
+
+    def _rows(self, conn, sql: str, params: tuple = ()) -> list:
+        return self._exec(conn, sql, params).fetchall()
+
+    def _one(self, conn, sql: str, params: tuple = ()):
+        return self._exec(conn, sql, params).fetchone()
+
+    def _begin(self, conn):
+        raise NotImplementedError
+
+    def _schema_version(self, conn) -> int:
+        raise NotImplementedError
+
+    def _set_schema_version(self, conn, version: int):
+        raise NotImplementedError
+
+    def _prepare_schema(self, conn) -> str:
+        return ""
+
+    def _lock_movie(self, conn, code: str):
+        """Serialize writers of one movie's parts (ordinals are MAX()+1)."""
+
+    # Full-text index over movie and part titles and descriptions; each
+    # backend has its own index and query syntax.
+    def _index_parts(self, conn, docs: list[tuple]):
+        """docs: (part_id, movie_code, title_text, description_text), normalized."""
+        raise NotImplementedError
+
+    def _unindex_part(self, conn, part_id: int):
+        raise NotImplementedError
+
+    def _unindex_movie(self, conn, code: str):
+        raise NotImplementedError
+
+    def _clear_search(self, conn):
+        raise NotImplementedError
+
+    def _search_rows(self, conn, terms: list[str], limit: int, offset: int, window: int) -> list[tuple]:
+        raise NotImplementedError
+
+    @staticmethod
+    def _search_doc(part_id: int, code: str, movie_title: Optional[str], part_title: Optional[str],
+                    description: Optional[str]) -> tuple:
+        title = part_title or ""
+        if movie_title and movie_title != part_title:
+            title = f"{movie_title} {title}"
+        return part_id, code, normalize_search_text(title), normalize_search_text(description)
+
+    # Schema
+    def init_db(self, conn):
+        info = self._prepare_schema(conn)
+        version = self._schema_version(conn)
+        while version < len(self.migrations):
+            self._begin(conn)
+            version = self._schema_version(conn)  # re-read under the writer lock
+            if version >= len(self.migrations):
+                conn.rollback()
+                break
+            self.migrations[version](conn.cursor())
+            version += 1
+            self._set_schema_version(conn, version)
+            conn.commit()
+            log_event("INIT_DB_MIGRATED", version=version)
+        log_event("INIT_DB", backend=self.name, version=version, info=info)
+
+    # Settings
+    def get_setting(self, conn, key: str) -> Optional[str]:
+        row = self._one(conn, "SELECT value FROM settings WHERE key=?", (key,))
+        return row[0] if row else None
+
+    def set_setting(self, conn, key: str, value: str):
+        self._exec(
+            conn,
+            "INSERT INTO settings (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, value)
+        )
+
+    def del_setting(self, conn, key: str):
+        self._exec(conn, "DELETE FROM settings WHERE key=?", (key,))
+
+    # Movies and parts
+    def _ensure_movie(self, conn, code: str, title: str, views: int = 0):
+        self._exec(
+            conn,
+            "INSERT INTO movies (code, title, views) VALUES (?, ?, ?) ON CONFLICT DO NOTHING",
+            (code, title, views)
+        )
+
+    def _insert_part(self, conn, code: str, title: str, description: str, video: str) -> Optional[int]:
+        # Duplicate (movie_code, video) pairs are dropped by idx_parts_code_video.
+        row = self._one(
+            conn,
+            "INSERT INTO parts (movie_code, ordinal, title, description, video) "
+            "VALUES (?, (SELECT COALESCE(MAX(ordinal), 0) + 1 FROM parts WHERE movie_code = ?), ?, ?, ?) "
+            "ON CONFLICT DO NOTHING RETURNING id",
+            (code, code, title, description, video)
+        )
+        if not row:
+            return None
+        movie_title = self._one(conn, "SELECT title FROM movies WHERE code = ?", (code,))[0]
+        self._index_parts(conn, [self._search_doc(row[0], code, movie_title, title, description)])
+        return row[0]
+
+    def add_movie_part(self, conn, code: str, title: str, description: str, video: str):
+        log_event("DB_ADD_PART", code=code, title=title, video_present=bool(video))
+        if not video:
+            log_event("DB_ADD_PART_ERROR", logging.WARNING, code=code, reason="no_video_provided")
+            return
+        self._ensure_movie(conn, code, title)
+        self._exec(conn, "UPDATE movies SET title = ? WHERE code = ? AND (title IS NULL OR title = '')", (title, code))
+        self._lock_movie(conn, code)
+        part_id = self._insert_part(conn, code, title, description, video)
+        if part_id is None:
+            log_event("DB_ADD_PART_SKIP", code=code, reason="duplicate_video")
+        else:
+            log_event("DB_ADD_PART_AFTER", code=code, part_id=part_id)
+
+    def get_movie(self, conn, code: str) -> Optional[dict]:
+        row = self._one(conn, "SELECT title, views FROM movies WHERE code=?", (code,))
+        if not row:
+            log_event("DB_GET_MOVIE", logging.DEBUG, code=code, found=False)
+            return None
+        title, views = row
+        parts_raw = self._rows(
+            conn, "SELECT id, title, description, video FROM parts WHERE movie_code=? ORDER BY ordinal", (code,)
+        )
+        parts = [{"id": p[0], "title": p[1], "description": p[2], "video": p[3]} for p in parts_raw]
+        if log.isEnabledFor(logging.DEBUG):
+            log_event(
+                "DB_GET_MOVIE", logging.DEBUG, code=code, title=title, views=views,
+                parts_count=len(parts), parts_videos=[p.get("video") for p in parts]
+            )
+        return {"title": title, "views": views, "parts": parts}
+
+    def add_views(self, conn, deltas: dict[str, int], bucket: int, prune_before: Optional[int] = None):
+        self._exec_many(
+            conn,
+            "UPDATE movies SET views = views + ? WHERE code=?",
+            [(delta, code) for code, delta in deltas.items()]
+        )
+        self._exec_many(
+            conn,
+            "INSERT INTO view_buckets (bucket, code, views) VALUES (?, ?, ?) "
+            "ON CONFLICT(bucket, code) DO UPDATE SET views = view_buckets.views + excluded.views",
+            [(bucket, code, delta) for code, delta in deltas.items()]
+        )
+        if prune_before is not None:
+            self._exec(conn, "DELETE FROM view_buckets WHERE bucket < ?", (prune_before,))
+
+    def delete_movie(self, conn, code: str):
+        self._unindex_movie(conn, code)
+        self._exec(conn, "DELETE FROM parts WHERE movie_code=?", (code,))
+        self._exec(conn, "DELETE FROM movies WHERE code=?", (code,))
+        self._exec(conn, "DELETE FROM view_buckets WHERE code=?", (code,))
+        log_event("DELETE_MOVIE", code=code)
+
+    def delete_movie_part(self, conn, code: str, part_index: int) -> Optional[dict]:
+        self._lock_movie(conn, code)
+        ordinal = part_index + 1
+        row = self._one(conn, "SELECT id, title FROM parts WHERE movie_code=? AND ordinal=?", (code, ordinal))
+        if part_index < 0 or not row:
+            log_event("DELETE_PART_FAIL", logging.WARNING, code=code, part_index=part_index, reason="out_of_range")
+            return None
+        part_id, part_title = row
+        self._unindex_part(conn, part_id)
+        self._exec(conn, "DELETE FROM parts WHERE id=?", (part_id,))
+        # Shift later parts down by one; going through negatives keeps the unique index happy.
+        self._exec(conn, "UPDATE parts SET ordinal = -(ordinal - 1) WHERE movie_code=? AND ordinal > ?", (code, ordinal))
+        self._exec(conn, "UPDATE parts SET ordinal = -ordinal WHERE movie_code=? AND ordinal < 0", (code,))
+        log_event("DELETE_PART", code=code, part_index=part_index, title=part_title)
+        return {"title": part_title}
+
+    def update_part_video(self, conn, code: str, part_index: Optional[int], video_file_id: str) -> bool:
+        self._lock_movie(conn, code)
+        if part_index is None:
+            row = self._one(conn, "SELECT id FROM parts WHERE movie_code=? ORDER BY ordinal DESC LIMIT 1", (code,))
+        else:
+            row = self._one(conn, "SELECT id FROM parts WHERE movie_code=? AND ordinal=?", (code, part_index + 1))
+        if part_index is None and not row:
+            self._ensure_movie(conn, code, code)
+            self._insert_part(conn, code, code, "", video_file_id)
+            log_event("UPDATE_PART_VIDEO", code=code, created_part=True)
+            return True
+        if not row:
+            log_event("UPDATE_PART_VIDEO_FAIL", logging.WARNING, code=code, part_index=part_index, reason="out_of_range")
+            return False
+        if self._one(conn, "SELECT 1 FROM parts WHERE movie_code=? AND video=? AND id != ?", (code, video_file_id, row[0])):
+            log_event("UPDATE_PART_VIDEO_FAIL", logging.WARNING, code=code, part_index=part_index, reason="duplicate_video")
+            return False
+        self._exec(conn, "UPDATE parts SET video=? WHERE id=?", (video_file_id, row[0]))
+        log_event("UPDATE_PART_VIDEO", code=code, part_index=part_index, part_id=row[0])
+        return True
+
+    # JSON migration
+    def import_movies(self, conn, entries: list[tuple[str, dict]]) -> tuple[int, int]:
+        """Insert a batch of movies.json entries; returns (new movies, new parts).
+
+        Existing movies and (movie_code, video) pairs are skipped by their
+        unique constraints rather than looked up first. A part without a
+        video has no such key, so it is skipped when the movie already has
+        a video-less part with the same title and description, in the
+        database or earlier in the batch. New parts go in without an
+        ordinal and are numbered after each movie's last part.
+        """
+        movies, parts = [], []
+        for code, info in entries:
+            title = info.get("title", code)
+            movies.append((code, title, info.get("views", 0)))
+            entry_parts = info.get("parts") or []
+            if not entry_parts and info.get("video"):
+                entry_parts = [{"title": title, "description": info.get("description", ""), "video": info["video"]}]
+            for part in entry_parts:
+                parts.append((code, part.get("title", title), part.get("description", ""), part.get("video", "")))
+        codes = list(dict.fromkeys(code for code, _, _ in movies))
+        if not codes:
+            return 0, 0
+        marks = ",".join("?" * len(codes))
+        known = {row[0] for row in self._rows(conn, f"SELECT code FROM movies WHERE code IN ({marks})", tuple(codes))}
+        self._exec_many(conn, "INSERT INTO movies (code, title, views) VALUES (?, ?, ?) ON CONFLICT DO NOTHING", movies)
+        self._exec_many(
+            conn,
+            "INSERT INTO parts (movie_code, title, description, video) VALUES (?, ?, ?, ?) ON CONFLICT DO NOTHING",
+            [p for p in parts if p[3]]
+        )
+        self._exec_many(conn, """
+            INSERT INTO parts (movie_code, title, description, video)
+            SELECT code, title, description, '' FROM (SELECT ? AS code, ? AS title, ? AS description) AS p
+            WHERE NOT EXISTS (
+                SELECT 1 FROM parts WHERE movie_code = p.code AND video = ''
+                    AND COALESCE(title, '') = COALESCE(p.title, '') AND COALESCE(description, '') = COALESCE(p.description, '')
+            )
+        """, list(dict.fromkeys(p[:3] for p in parts if not p[3])))
+        new_parts = self._rows(conn, f"""
+            SELECT p.id, p.movie_code, m.title, p.title, p.description
+            FROM parts AS p JOIN movies AS m ON m.code = p.movie_code
+            WHERE p.movie_code IN ({marks}) AND p.ordinal IS NULL
+        """, tuple(codes))
+        if new_parts:
+            self._exec(conn, f"""
+                UPDATE parts SET ordinal = r.rn
+                FROM (
+                    SELECT id, COALESCE(MAX(ordinal) OVER (PARTITION BY movie_code), 0)
+                        + ROW_NUMBER() OVER (PARTITION BY movie_code, ordinal IS NULL ORDER BY id) AS rn
+                    FROM parts WHERE movie_code IN ({marks})
+                ) AS r
+                WHERE r.id = parts.id AND parts.ordinal IS NULL
+            """, tuple(codes))
+            self._index_parts(conn, [self._search_doc(*row) for row in new_parts])
+        return len(codes) - len(known), len(new_parts)
+
+    # Catalog readers
+    def catalog_batch(self, conn, after_code: Optional[str], limit: int) -> list[tuple]:
+        where, params = _keyset_where(after_code)
+        return self._rows(conn, f"""
+            SELECT m.code, m.title, m.views, p.id, p.title, p.description, p.video
+            FROM (SELECT code, title, views FROM movies WHERE {where} ORDER BY code LIMIT ?) AS m
+            LEFT JOIN parts AS p ON p.movie_code = m.code
+            ORDER BY m.code, p.ordinal
+        """, (*params, limit))
+
+    def catalog_page(self, conn, after_code: Optional[str], before_code: Optional[str], limit: int) -> list[tuple]:
+        """(code, title, part count) of `limit` movies after `after_code`, or
+        of the `limit` movies just before `before_code`; ascending either way."""
+        # Part counts come from the (movie_code, ordinal) index, one range per row.
+        select = "SELECT code, title, (SELECT COUNT(*) FROM parts WHERE parts.movie_code = movies.code) FROM movies"
+        if before_code is not None:
+            rows = self._rows(conn, f"{select} WHERE code < ? ORDER BY code DESC LIMIT ?", (before_code, limit))
+            return rows[::-1]
+        where, params = _keyset_where(after_code)
+        return self._rows(conn, f"{select} WHERE {where} ORDER BY code LIMIT ?", (*params, limit))
+
+    # Statistics
+    def top_views(self, conn, limit: int, extra_codes: list[str]) -> list[tuple]:
+        rows = self._rows(conn, "SELECT code, title, views FROM movies ORDER BY views DESC LIMIT ?", (limit,))
+        if extra_codes:
+            marks = ",".join("?" * len(extra_codes))
+            rows += self._rows(conn, f"SELECT code, title, views FROM movies WHERE code IN ({marks})", tuple(extra_codes))
+        return rows
+
+    def trending(self, conn, since_bucket: int, limit: int, extra_codes: list[str]) -> list[tuple]:
+        sql = """
+            SELECT b.code, m.title, CAST(SUM(b.views) AS BIGINT) AS v
+            FROM view_buckets AS b JOIN movies AS m ON m.code = b.code
+            WHERE b.bucket >= ? {extra}
+            GROUP BY b.code, m.title
+        """
+        rows = self._rows(conn, sql.format(extra="") + " ORDER BY v DESC LIMIT ?", (since_bucket, limit))
+        if extra_codes:
+            marks = ",".join("?" * len(extra_codes))
+            rows += self._rows(conn, sql.format(extra=f"AND b.code IN ({marks})"), (since_bucket, *extra_codes))
+            rows += self._rows(conn, f"SELECT code, title, 0 FROM movies WHERE code IN ({marks})", tuple(extra_codes))
+        return rows
+
+    # Recommendations
+    def recommend_rows(self, conn, code: Optional[str] = None) -> list[tuple]:
+        sql = """
+            SELECT p.movie_code, p.id, m.views
+            FROM parts AS p JOIN movies AS m ON m.code = p.movie_code
+            WHERE p.video IS NOT NULL AND p.video != '' {where}
+            ORDER BY p.movie_code, p.ordinal
+        """
+        if code is None:
+            return self._rows(conn, sql.format(where=""))
+        return self._rows(conn, sql.format(where="AND p.movie_code = ?"), (code,))
+
+    # Conversation state (values are JSON, expires_at is unix time)
+    def state_get(self, conn, user_id: int, namespaces: tuple, now: float) -> dict:
+        marks = ",".join("?" * len(namespaces))
+        rows = self._rows(
+            conn,
+            f"SELECT ns, value FROM user_state WHERE user_id = ? AND ns IN ({marks}) AND expires_at > ?",
+            (user_id, *namespaces, now)
+        )
+        return {ns: json.loads(value) for ns, value in rows}
+
+    def state_set(self, conn, user_id: int, ns: str, value, expires_at: float):
+        self._exec(
+            conn,
+            "INSERT INTO user_state (user_id, ns, value, expires_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(user_id, ns) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+            (user_id, ns, json.dumps(value, ensure_ascii=False), expires_at)
+        )
+
+    def state_pop(self, conn, user_id: int, ns: str, now: float):
+        row = self._one(
+            conn,
+            "DELETE FROM user_state WHERE user_id = ? AND ns = ? RETURNING value, expires_at",
+            (user_id, ns)
+        )
+        if row is None or row[1] <= now:
+            return None
+        return json.loads(row[0])
+
+    def state_delete(self, conn, user_id: int, namespaces: tuple):
+        marks = ",".join("?" * len(namespaces))
+        self._exec(conn, f"DELETE FROM user_state WHERE user_id = ? AND ns IN ({marks})", (user_id, *namespaces))
+
+    def state_purge(self, conn, now: float, max_entries: int) -> int:
+        removed = self._exec(conn, "DELETE FROM user_state WHERE expires_at <= ?", (now,)).rowcount
+        excess = self._one(conn, "SELECT COUNT(*) FROM user_state")[0] - max_entries
+        if excess > 0:
+            removed += self._exec(
+                conn,
+                "DELETE FROM user_state WHERE (user_id, ns) IN "
+                "(SELECT user_id, ns FROM user_state ORDER BY expires_at LIMIT ?)",
+                (excess,)
+            ).rowcount
+        return removed
+
+    def state_count(self, conn) -> int:
+        return self._one(conn, "SELECT COUNT(*) FROM user_state")[0]
+
+    # Multi-worker coordination
+    def claim_update(self, conn, update_id: int, now: float) -> bool:
+        """True for the first worker to see `update_id`, False for retries."""
+        row = self._one(
+            conn,
+            "INSERT INTO processed_updates (update_id, seen_at) VALUES (?, ?) "
+            "ON CONFLICT(update_id) DO NOTHING RETURNING update_id",
+            (update_id, now)
+        )
+        return row is not None
+
+    def purge_updates(self, conn, before: float) -> int:
+        return self._exec(conn, "DELETE FROM processed_updates WHERE seen_at < ?", (before,)).rowcount
+
+    def log_catalog_change(self, conn, code: str, now: float) -> int:
+        return self._one(
+            conn, "INSERT INTO catalog_changes (code, changed_at) VALUES (?, ?) RETURNING id", (code, now)
+        )[0]
+
+    def log_catalog_changes(self, conn, codes: list[str], now: float):
+        self._exec_many(conn, "INSERT INTO catalog_changes (code, changed_at) VALUES (?, ?)", [(c, now) for c in codes])
+
+    def catalog_changes(self, conn, after_id: int, limit: int) -> list[tuple]:
+        return self._rows(
+            conn, "SELECT id, code FROM catalog_changes WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit)
+        )
+
+    def last_catalog_change(self, conn) -> int:
+        return self._one(conn, "SELECT COALESCE(MAX(id), 0) FROM catalog_changes")[0]
+
+    def purge_catalog_changes(self, conn, before: float) -> int:
+        return self._exec(conn, "DELETE FROM catalog_changes WHERE changed_at < ?", (before,)).rowcount
+
+    # Search
+    def search(self, conn, query: str, limit: int, offset: int = 0, window: int = 2000) -> list[tuple]:
+        """(code, title) of the best matching movies, best first.
+
+        Only the newest `window` matching parts are ranked: a term that hits
+        half the catalog would otherwise score every one of those rows.
+        """
+        terms = search_terms(query)
+        if not terms:
+            return []
+        return self._search_rows(conn, terms, limit, offset, window)
+
+    def video_parts(self, conn, codes: list[str]) -> list[tuple]:
+        """(code, movie title, part id, part title, description, video) of every part with a video."""
+        if not codes:
+            return []
+        marks = ",".join("?" * len(codes))
+        return self._rows(conn, f"""
+            SELECT p.movie_code, m.title, p.id, p.title, p.description, p.video
+            FROM parts AS p JOIN movies AS m ON m.code = p.movie_code
+            WHERE p.movie_code IN ({marks}) AND p.video <> ''
+            ORDER BY p.movie_code, p.ordinal
+        """, tuple(codes))
+
+    def rebuild_search(self, conn, batch: int = 5000) -> int:
+        """Re-index every part; used once after the search tables appear."""
+        self._clear_search(conn)
+        after, total = 0, 0
+        while True:
+            rows = self._rows(
+                conn,
+                "SELECT p.id, p.movie_code, m.title, p.title, p.description FROM parts AS p "
+                "JOIN movies AS m ON m.code = p.movie_code WHERE p.id > ? ORDER BY p.id LIMIT ?",
+                (after, batch)
+            )
+            if not rows:
+                break
+            self._index_parts(conn, [self._search_doc(*r) for r in rows])
+            after = rows[-1][0]
+            total += len(rows)
+        self.set_setting(conn, "search_indexed", "1")
+        log_event("SEARCH_REBUILT", parts=total)
+        return total
+
+    # Backups: these open their own connection and run on a worker thread
+    # outside the pool, so a long copy never holds a pooled connection.
+    def _snapshot(self, conn):
+        """Start a read-only transaction that sees one consistent state."""
+        raise NotImplementedError
+
+    def backup(self, path: str, progress, step_pages: int):
+        """Write a gzipped copy of the whole database to `path`."""
+        raise NotImplementedError
+
+    def export_catalog(self, path: str, progress, batch: int = 5000) -> int:
+        """Write the catalog as gzipped JSONL (the /migrate format); returns the movie count.
+
+        `progress(stage, done, total)` is called after every batch.
+        """
+        conn = self.connect()
+        tmp = path + ".part"
+        try:
+            self._snapshot(conn)
+            total = self._one(conn, "SELECT COUNT(*) FROM movies")[0]
+            done, after = 0, None
+            with gzip.open(tmp, "wt", encoding="utf-8", compresslevel=6) as out:
+                while True:
+                    rows = self.catalog_batch(conn, after, batch)
+                    if not rows:
+                        break
+                    for code, group in itertools.groupby(rows, key=lambda r: r[0]):
+                        group = list(group)
+                        _, title, views = group[0][:3]
+                        parts = [{"title": r[4], "description": r[5], "video": r[6]} for r in group if r[3] is not None]
+                        out.write(json.dumps(
+                            {"code": code, "title": title, "views": views or 0, "parts": parts}, ensure_ascii=False
+                        ) + "\n")
+                        done += 1
+                    after = rows[-1][0]
+                    progress("export", done, total)
+            os.replace(tmp, path)
+            return done
+        finally:
+            conn.close()
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    # Users and broadcasts
+    def upsert_users(self, conn, rows: list[tuple]):
+        """rows: (user_id, first_name, username, seen_at). Writing to the bot
+        again means the user unblocked it."""
+        self._exec_many(
+            conn,
+            "INSERT INTO users (user_id, first_name, username, first_seen, last_seen) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET first_name = excluded.first_name, "
+            "username = excluded.username, last_seen = excluded.last_seen, blocked_at = NULL",
+            [(uid, first_name, username, seen_at, seen_at) for uid, first_name, username, seen_at in rows]
+        )
+
+    def user_counts(self, conn) -> tuple[int, int]:
+        total, blocked = self._one(conn, "SELECT COUNT(*), COUNT(blocked_at) FROM users")
+        return total, blocked
+
+    def users_after(self, conn, after_id: int, limit: int) -> list[int]:
+        rows = self._rows(
+            conn,
+            "SELECT user_id FROM users WHERE user_id > ? AND blocked_at IS NULL ORDER BY user_id LIMIT ?",
+            (after_id, limit)
+        )
+        return [r[0] for r in rows]
+
+    def mark_users_blocked(self, conn, user_ids: list[int], now: float):
+        self._exec_many(conn, "UPDATE users SET blocked_at = ? WHERE user_id = ?", [(now, uid) for uid in user_ids])
+
+    BROADCAST_FIELDS = ("id", "from_chat_id", "message_id", "status", "last_user_id", "total", "sent", "blocked", "failed")
+
+    def _broadcast_row(self, row) -> Optional[dict]:
+        return dict(zip(self.BROADCAST_FIELDS, row)) if row else None
+
+    def create_broadcast(self, conn, from_chat_id: int, message_id: int, now: float) -> Optional[dict]:
+        """Start a job; None while another one is running (idx_broadcasts_running)."""
+        total = self._one(conn, "SELECT COUNT(*) FROM users WHERE blocked_at IS NULL")[0]
+        row = self._one(
+            conn,
+            "INSERT INTO broadcasts (from_chat_id, message_id, status, total, started_at, updated_at) "
+            "VALUES (?, ?, 'running', ?, ?, ?) ON CONFLICT DO NOTHING RETURNING " + ", ".join(self.BROADCAST_FIELDS),
+            (from_chat_id, message_id, total, now, now)
+        )
+        return self._broadcast_row(row)
+
+    def claim_broadcast(self, conn, now: float, stale_before: float) -> Optional[dict]:
+        """Take over the running job if nobody heartbeated it since `stale_before`."""
+        row = self._one(
+            conn,
+            "UPDATE broadcasts SET updated_at = ? WHERE status = 'running' AND updated_at < ? "
+            "RETURNING " + ", ".join(self.BROADCAST_FIELDS),
+            (now, stale_before)
+        )
+        return self._broadcast_row(row)
+
+    def save_broadcast(self, conn, job: dict, status: str, updated_at: float, finished_at: Optional[float] = None) -> bool:
+        """Store progress; False once the job was cancelled (or finished) elsewhere."""
+        cur = self._exec(
+            conn,
+            "UPDATE broadcasts SET status = ?, last_user_id = ?, sent = ?, blocked = ?, failed = ?, "
+            "updated_at = ?, finished_at = ? WHERE id = ? AND status = 'running'",
+            (status, job["last_user_id"], job["sent"], job["blocked"], job["failed"], updated_at, finished_at, job["id"])
+        )
+        return cur.rowcount > 0
+
+    def heartbeat_broadcast(self, conn, broadcast_id: int, now: float):
+        self._exec(conn, "UPDATE broadcasts SET updated_at = ? WHERE id = ? AND status = 'running'", (now, broadcast_id))
+
+    def cancel_broadcast(self, conn, now: float) -> Optional[int]:
+        row = self._one(
+            conn,
+            "UPDATE broadcasts SET status = 'cancelled', finished_at = ? WHERE status = 'running' RETURNING id",
+            (now,)
+        )
+        return row[0] if row else None
+
+    def last_broadcast(self, conn) -> Optional[dict]:
+        return self._broadcast_row(self._one(
+            conn, "SELECT " + ", ".join(self.BROADCAST_FIELDS) + " FROM broadcasts ORDER BY id DESC LIMIT 1"
+        ))
+
+def _sqlite_schema_v1(cur):
     cur.execute("""
     CREATE TABLE IF NOT EXISTS movies (
         code TEXT PRIMARY KEY,
@@ -56,228 +1363,1358 @@ def init_db():
         key TEXT PRIMARY KEY,
         value TEXT
     )""")
-    conn.commit()
-    conn.close()
-    print("[INIT_DB] Database initialized or already exists.")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_movies_views ON movies(views DESC)")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS view_buckets (
+        bucket INTEGER NOT NULL,
+        code TEXT NOT NULL,
+        views INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (bucket, code)
+    ) WITHOUT ROWID""")
+
+def _sqlite_schema_v2(cur):
+    # Per-movie part ordinals (1..n) replace "fetch every id, pick by position".
+    cur.execute("ALTER TABLE parts ADD COLUMN ordinal INTEGER")
+    # The (movie_code, video) index below needs duplicate uploads gone; say
+    # which movies lost rows so an admin can check them afterwards.
+    cur.execute("""
+        SELECT movie_code, COUNT(*) - COUNT(DISTINCT video) FROM parts
+        WHERE video IS NOT NULL AND video != ''
+        GROUP BY movie_code
+        HAVING COUNT(*) > COUNT(DISTINCT video)
+    """)
+    removed = cur.fetchall()
+    for code, count in removed:
+        log_event("MIGRATION_DUPLICATE_PARTS_REMOVED", logging.WARNING, code=code, removed=count)
+    if removed:
+        log_event("MIGRATION_DUPLICATE_PARTS_TOTAL", logging.WARNING,
+                  movies=len(removed), removed=sum(count for _, count in removed))
+    cur.execute("""
+        DELETE FROM parts
+        WHERE video IS NOT NULL AND video != ''
+          AND id NOT IN (
+            SELECT MIN(id) FROM parts
+            WHERE video IS NOT NULL AND video != ''
+            GROUP BY movie_code, video
+          )
+    """)
+    cur.execute("""
+        UPDATE parts SET ordinal = r.rn
+        FROM (SELECT id, ROW_NUMBER() OVER (PARTITION BY movie_code ORDER BY id) AS rn FROM parts) AS r
+        WHERE r.id = parts.id
+    """)
+    cur.execute("CREATE UNIQUE INDEX idx_parts_code_ordinal ON parts(movie_code, ordinal)")
+    cur.execute(
+        "CREATE UNIQUE INDEX idx_parts_code_video ON parts(movie_code, video) "
+        "WHERE video IS NOT NULL AND video != ''"
+    )
+
+def _sqlite_schema_v3(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS user_state (
+        user_id INTEGER NOT NULL,
+        ns TEXT NOT NULL,
+        value TEXT,
+        expires_at REAL NOT NULL,
+        PRIMARY KEY (user_id, ns)
+    ) WITHOUT ROWID""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_state_expires ON user_state(expires_at)")
+
+def _sqlite_schema_v4(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS processed_updates (
+        update_id INTEGER PRIMARY KEY,
+        seen_at REAL NOT NULL
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_processed_updates_seen ON processed_updates(seen_at)")
+
+def _sqlite_schema_v5(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS catalog_changes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        code TEXT NOT NULL,
+        changed_at REAL NOT NULL
+    )""")
+
+def _sqlite_schema_v6(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        first_name TEXT,
+        username TEXT,
+        first_seen REAL NOT NULL,
+        last_seen REAL NOT NULL,
+        blocked_at REAL
+    )""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        from_chat_id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        last_user_id INTEGER NOT NULL DEFAULT 0,
+        total INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        blocked INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        started_at REAL NOT NULL,
+        updated_at REAL NOT NULL,
+        finished_at REAL
+    )""")
+    # At most one running job
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_broadcasts_running ON broadcasts(status) WHERE status = 'running'")
+
+def _sqlite_schema_v7(cur):
+    # rowid = parts.id; filled by rebuild_search() on the next start
+    cur.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS parts_fts USING fts5(
+        title, description, movie_code UNINDEXED,
+        tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+    )""")
+
+class SQLiteStorage(Storage):
+    name = "sqlite"
+    supports_backup = True
+    migrations = [
+        _sqlite_schema_v1, _sqlite_schema_v2, _sqlite_schema_v3, _sqlite_schema_v4, _sqlite_schema_v5,
+        _sqlite_schema_v6, _sqlite_schema_v7,
+    ]
+
+    def __init__(self, path: str, pool_size: int):
+        self.path = path
+        super().__init__(pool_size)
+
+    def describe(self) -> str:
+        return f"file={self.path}"
+
+    def _index_parts(self, conn, docs: list[tuple]):
+        self._exec_many(conn, "INSERT INTO parts_fts (rowid, movie_code, title, description) VALUES (?, ?, ?, ?)", docs)
+
+    def _unindex_part(self, conn, part_id: int):
+        self._exec(conn, "DELETE FROM parts_fts WHERE rowid = ?", (part_id,))
+
+    def _unindex_movie(self, conn, code: str):
+        # movie_code is UNINDEXED; go through the parts index instead of scanning.
+        self._exec(conn, "DELETE FROM parts_fts WHERE rowid IN (SELECT id FROM parts WHERE movie_code = ?)", (code,))
+
+    def _clear_search(self, conn):
+        self._exec(conn, "DELETE FROM parts_fts")
+
+    def _search_rows(self, conn, terms: list[str], limit: int, offset: int, window: int) -> list[tuple]:
+        # Terms are letters and digits only, so quoting them is enough; every
+        # term is a prefix and all must match. Title hits weigh 10x.
+        match = " ".join(f'"{t}"*' for t in terms)
+        # bm25() can't run inside an aggregate, hence the materialized CTE.
+        return self._rows(conn, """
+            WITH hits AS MATERIALIZED (
+                SELECT movie_code, bm25(parts_fts, 10.0, 1.0) AS score
+                FROM parts_fts WHERE parts_fts MATCH ? ORDER BY rowid DESC LIMIT ?
+            )
+            SELECT s.movie_code, m.title FROM (
+                SELECT movie_code, MIN(score) AS score FROM hits
+                GROUP BY movie_code ORDER BY score, movie_code LIMIT ? OFFSET ?
+            ) AS s JOIN movies AS m ON m.code = s.movie_code
+            ORDER BY s.score, s.movie_code
+        """, (match, window, limit, offset))
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        conn.execute("PRAGMA foreign_keys = ON;")
+        # WAL (set once in init_db) lets readers run alongside the writer; NORMAL
+        # sync is durable across app crashes and only fsyncs at checkpoints.
+        conn.execute("PRAGMA synchronous = NORMAL;")
+        conn.execute(f"PRAGMA cache_size = -{DB_CACHE_KB};")
+        conn.execute(f"PRAGMA mmap_size = {DB_MMAP_MB * 1024 * 1024};")
+        conn.execute("PRAGMA temp_store = MEMORY;")
+        return conn
+
+    def _exec(self, conn, sql: str, params: tuple = ()):
+        return conn.execute(sql, params)
+
+    def _exec_many(self, conn, sql: str, seq: list):
+        conn.executemany(sql, seq)
+
+    def _begin(self, conn):
+        conn.execute("BEGIN IMMEDIATE")
+
+    def _schema_version(self, conn) -> int:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def _set_schema_version(self, conn, version: int):
+        conn.execute(f"PRAGMA user_version = {int(version)}")
+
+    def _prepare_schema(self, conn) -> str:
+        mode = conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+        return f"journal_mode={mode}"
+
+    def _snapshot(self, conn):
+        conn.execute("BEGIN")
+        conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+
+    def backup(self, path: str, progress, step_pages: int):
+        """Online backup in `step_pages` steps, then gzip.
+
+        The source connection holds one read transaction for the whole copy:
+        under WAL writers carry on, and the copy is a single snapshot instead
+        of restarting every time a write lands between two steps.
+        """
+        copy, tmp = path + ".db", path + ".part"
+        src = self.connect()
+        try:
+            self._snapshot(src)
+            dst = sqlite3.connect(copy)
+            try:
+                src.backup(dst, pages=step_pages,
+                           progress=lambda _status, remaining, total: progress("copy", total - remaining, total))
+            finally:
+                dst.close()
+            src.rollback()
+            size = os.path.getsize(copy)
+            done = 0
+            with open(copy, "rb") as f, gzip.open(tmp, "wb", compresslevel=6) as out:
+                while chunk := f.read(1 << 22):
+                    out.write(chunk)
+                    done += len(chunk)
+                    progress("gzip", done, size)
+            os.replace(tmp, path)
+        finally:
+            src.close()
+            for leftover in (copy, tmp):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+def _pg_schema_v1(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS movies (
+        code TEXT PRIMARY KEY,
+        title TEXT,
+        views BIGINT NOT NULL DEFAULT 0
+    )""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS parts (
+        id BIGSERIAL PRIMARY KEY,
+        movie_code TEXT REFERENCES movies(code) ON DELETE CASCADE,
+        title TEXT,
+        description TEXT,
+        video TEXT
+    )""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS settings (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_movies_views ON movies(views DESC)")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS view_buckets (
+        bucket BIGINT NOT NULL,
+        code TEXT NOT NULL,
+        views BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (bucket, code)
+    )""")
+
+def _pg_schema_v2(cur):
+    cur.execute("ALTER TABLE parts ADD COLUMN IF NOT EXISTS ordinal INTEGER")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_parts_code_ordinal ON parts(movie_code, ordinal)")
+    cur.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_parts_code_video ON parts(movie_code, video) "
+        "WHERE video IS NOT NULL AND video != ''"
+    )
+
+def _pg_schema_v3(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS user_state (
+        user_id BIGINT NOT NULL,
+        ns TEXT NOT NULL,
+        value TEXT,
+        expires_at DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (user_id, ns)
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_state_expires ON user_state(expires_at)")
+
+def _pg_schema_v4(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS processed_updates (
+        update_id BIGINT PRIMARY KEY,
+        seen_at DOUBLE PRECISION NOT NULL
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_processed_updates_seen ON processed_updates(seen_at)")
+
+def _pg_schema_v5(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS catalog_changes (
+        id BIGSERIAL PRIMARY KEY,
+        code TEXT NOT NULL,
+        changed_at DOUBLE PRECISION NOT NULL
+    )""")
+
+def _pg_schema_v6(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT PRIMARY KEY,
+        first_name TEXT,
+        username TEXT,
+        first_seen DOUBLE PRECISION NOT NULL,
+        last_seen DOUBLE PRECISION NOT NULL,
+        blocked_at DOUBLE PRECISION
+    )""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id BIGSERIAL PRIMARY KEY,
+        from_chat_id BIGINT NOT NULL,
+        message_id BIGINT NOT NULL,
+        status TEXT NOT NULL,
+        last_user_id BIGINT NOT NULL DEFAULT 0,
+        total BIGINT NOT NULL DEFAULT 0,
+        sent BIGINT NOT NULL DEFAULT 0,
+        blocked BIGINT NOT NULL DEFAULT 0,
+        failed BIGINT NOT NULL DEFAULT 0,
+        started_at DOUBLE PRECISION NOT NULL,
+        updated_at DOUBLE PRECISION NOT NULL,
+        finished_at DOUBLE PRECISION
+    )""")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_broadcasts_running ON broadcasts(status) WHERE status = 'running'")
+
+def _pg_schema_v7(cur):
+    # Filled by rebuild_search() on the next start; rows go with their part.
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS part_search (
+        part_id BIGINT PRIMARY KEY REFERENCES parts(id) ON DELETE CASCADE,
+        movie_code TEXT NOT NULL,
+        document TSVECTOR NOT NULL
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_part_search_document ON part_search USING GIN (document)")
+
+if psycopg2 is not None:
+    class PgConnection(psycopg2.extensions.connection):
+        """Remembers the statements prepared in its session, so they go away with it."""
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.prepared: OrderedDict = OrderedDict()  # sql -> statement name, LRU order
+            self.prepared_ids = itertools.count(1)
+
+class PostgresStorage(Storage):
+    """PostgreSQL backend; each pooled connection prepares statements on first use."""
+
+    name = "postgres"
+    migrations = [
+        _pg_schema_v1, _pg_schema_v2, _pg_schema_v3, _pg_schema_v4, _pg_schema_v5, _pg_schema_v6,
+        _pg_schema_v7,
+    ]
+
+    def __init__(self, url: str, pool_size: int):
+        if psycopg2 is None:
+            raise RuntimeError("STORAGE_BACKEND=postgres requires psycopg2 (pip install psycopg2-binary)")
+        if not url:
+            raise RuntimeError("STORAGE_BACKEND=postgres requires DATABASE_URL")
+        self.url = url
+        super().__init__(pool_size)
+
+    def describe(self) -> str:
+        return "url=" + re.sub(r"//[^@/]*@", "//***@", self.url)
+
+    def connect(self):
+        return psycopg2.connect(self.url, connection_factory=PgConnection)
+
+    def _snapshot(self, conn):
+        conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+
+    def _statement(self, conn, sql: str) -> str:
+        statements = conn.prepared
+        name = statements.get(sql)
+        if name is not None:
+            statements.move_to_end(sql)
+            return name
+        # IN (?,?,...) lists give a new statement per length; the least
+        # recently used ones are dropped from the session again.
+        name = f"q{next(conn.prepared_ids)}"
+        counter = itertools.count(1)
+        pg_sql = re.sub(r"\?", lambda _m: f"${next(counter)}", sql)
+        with conn.cursor() as cur:
+            if len(statements) >= PG_PREPARED_MAX:
+                _, evicted = statements.popitem(last=False)
+                cur.execute(f"DEALLOCATE {evicted}")
+            cur.execute(f"PREPARE {name} AS {pg_sql}")
+        statements[sql] = name
+        return name
+
+    @staticmethod
+    def _execute_sql(name: str, n_params: int) -> str:
+        if not n_params:
+            return f"EXECUTE {name}"
+        return f"EXECUTE {name} ({', '.join(['%s'] * n_params)})"
+
+    def _exec(self, conn, sql: str, params: tuple = ()):
+        name = self._statement(conn, sql)
+        cur = conn.cursor()
+        cur.execute(self._execute_sql(name, len(params)), params)
+        return cur
+
+    def _exec_many(self, conn, sql: str, seq: list):
+        if not seq:
+            return
+        name = self._statement(conn, sql)
+        with conn.cursor() as cur:
+            psycopg2.extras.execute_batch(cur, self._execute_sql(name, len(seq[0])), seq, page_size=500)
+
+    def _begin(self, conn):
+        # psycopg2 opens the transaction implicitly; the advisory lock keeps
+        # concurrently starting workers from migrating at the same time.
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(72010001)")
+
+    def _schema_version(self, conn) -> int:
+        with conn.cursor() as cur:
+            cur.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+            cur.execute("SELECT MAX(version) FROM schema_version")
+            return cur.fetchone()[0] or 0
+
+    def _set_schema_version(self, conn, version: int):
+        with conn.cursor() as cur:
+            cur.execute("INSERT INTO schema_version (version) VALUES (%s)", (version,))
+
+    def _lock_movie(self, conn, code: str):
+        self._exec(conn, "SELECT 1 FROM movies WHERE code = ? FOR UPDATE", (code,))
+
+    def _index_parts(self, conn, docs: list[tuple]):
+        self._exec_many(
+            conn,
+            "INSERT INTO part_search (part_id, movie_code, document) VALUES (?, ?, "
+            "setweight(to_tsvector('simple', ?), 'A') || setweight(to_tsvector('simple', ?), 'B')) "
+            "ON CONFLICT (part_id) DO UPDATE SET movie_code = excluded.movie_code, document = excluded.document",
+            docs
+        )
+
+    def _unindex_part(self, conn, part_id: int):
+        """part_search rows are deleted with their part (ON DELETE CASCADE)."""
+
+    def _unindex_movie(self, conn, code: str):
+        """part_search rows are deleted with their parts (ON DELETE CASCADE)."""
+
+    def _clear_search(self, conn):
+        self._exec(conn, "DELETE FROM part_search")
+
+    def _search_rows(self, conn, terms: list[str], limit: int, offset: int, window: int) -> list[tuple]:
+        return self._rows(conn, """
+            WITH hits AS MATERIALIZED (
+                SELECT movie_code, ts_rank(document, q) AS score
+                FROM part_search, to_tsquery('simple', ?) AS q WHERE document @@ q
+                ORDER BY part_id DESC LIMIT ?
+            )
+            SELECT s.movie_code, m.title FROM (
+                SELECT movie_code, MAX(score) AS score FROM hits
+                GROUP BY movie_code ORDER BY score DESC, movie_code LIMIT ? OFFSET ?
+            ) AS s JOIN movies AS m ON m.code = s.movie_code
+            ORDER BY s.score DESC, s.movie_code
+        """, (" & ".join(f"{t}:*" for t in terms), window, limit, offset))
+
+def create_storage() -> Storage:
+    if STORAGE_BACKEND in ("postgres", "postgresql"):
+        return PostgresStorage(DATABASE_URL, DB_POOL_SIZE)
+    if STORAGE_BACKEND != "sqlite":
+        raise RuntimeError(f"Unknown STORAGE_BACKEND={STORAGE_BACKEND!r} (sqlite or postgres)")
+    return SQLiteStorage(DB_FILE, DB_POOL_SIZE)
+
+storage = create_storage()
+
+def storage_op(op: str):
+    """Module-level coroutine that runs `storage.<op>` on the pool."""
+    async def call(*args, **kwargs):
+        return await storage.run(op, *args, **kwargs)
+    call.__name__ = call.__qualname__ = op
+    return call
+
+init_db = storage_op("init_db")
+get_setting = storage_op("get_setting")
+set_setting = storage_op("set_setting")
+del_setting = storage_op("del_setting")
+db_add_movie_part = storage_op("add_movie_part")
+db_get_movie = storage_op("get_movie")
+db_add_views = storage_op("add_views")
+db_delete_movie = storage_op("delete_movie")
+db_delete_movie_part = storage_op("delete_movie_part")
+db_update_part_video = storage_op("update_part_video")
+db_import_movies = storage_op("import_movies")
+db_catalog_batch = storage_op("catalog_batch")
+db_catalog_page = storage_op("catalog_page")
+db_top_views = storage_op("top_views")
+db_trending = storage_op("trending")
+db_recommend_rows = storage_op("recommend_rows")
+db_state_get = storage_op("state_get")
+db_state_set = storage_op("state_set")
+db_state_pop = storage_op("state_pop")
+db_state_delete = storage_op("state_delete")
+db_state_purge = storage_op("state_purge")
+db_state_count = storage_op("state_count")
+db_claim_update = storage_op("claim_update")
+db_purge_updates = storage_op("purge_updates")
+db_log_catalog_change = storage_op("log_catalog_change")
+db_log_catalog_changes = storage_op("log_catalog_changes")
+db_catalog_changes = storage_op("catalog_changes")
+db_last_catalog_change = storage_op("last_catalog_change")
+db_purge_catalog_changes = storage_op("purge_catalog_changes")
+db_search = storage_op("search")
+db_rebuild_search = storage_op("rebuild_search")
+db_video_parts = storage_op("video_parts")
+db_upsert_users = storage_op("upsert_users")
+db_user_counts = storage_op("user_counts")
+db_users_after = storage_op("users_after")
+db_mark_users_blocked = storage_op("mark_users_blocked")
+db_create_broadcast = storage_op("create_broadcast")
+db_claim_broadcast = storage_op("claim_broadcast")
+db_save_broadcast = storage_op("save_broadcast")
+db_heartbeat_broadcast = storage_op("heartbeat_broadcast")
+db_cancel_broadcast = storage_op("cancel_broadcast")
+db_last_broadcast = storage_op("last_broadcast")
 
 # --- Settings helpers ---
-def get_setting(key: str) -> Optional[str]:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT value FROM settings WHERE key=?", (key,))
-    row = cur.fetchone()
-    conn.close()
-    return row[0] if row else None
-
-def set_setting(key: str, value: str):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
-    conn.commit()
-    conn.close()
-
-def del_setting(key: str):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM settings WHERE key=?", (key,))
-    conn.commit()
-    conn.close()
-
-def get_channels() -> list[str]:
-    v = get_setting("channels")
-    if not v:
-        return []
-    try:
-        return json.loads(v)
-    except Exception:
-        return []
+CHANNELS_CACHE_TTL = float(os.getenv("CHANNELS_CACHE_TTL", "30"))
+
+# Every gated update needs the channel list. A single worker sees every write
+# through save_channels_list, so it never re-reads; with several workers the
+# copy expires after CHANNELS_CACHE_TTL to pick up another worker's edit.
+_channels: Optional[tuple[str, ...]] = None
+_channels_loaded_at = 0.0
 
-def save_channels_list(channels: list[str]):
-    set_setting("channels", json.dumps(channels, ensure_ascii=False))
-    print(f"[SAVE_CHANNELS] channels_saved_count={len(channels)}")
+async def get_channels() -> list[str]:
+    global _channels, _channels_loaded_at
+    if _channels is None or (WEB_WORKERS > 1 and time.monotonic() - _channels_loaded_at > CHANNELS_CACHE_TTL):
+        v = await get_setting("channels")
+        try:
+            channels = json.loads(v) if v else []
+        except Exception:
+            channels = []
+        _channels, _channels_loaded_at = tuple(channels), time.monotonic()
+    return list(_channels)
+
+async def save_channels_list(channels: list[str]):
+    global _channels, _channels_loaded_at
+    await set_setting("channels", json.dumps(channels, ensure_ascii=False))
+    _channels, _channels_loaded_at = tuple(channels), time.monotonic()
+    log_event("SAVE_CHANNELS", channels_saved_count=len(channels))
 
-def set_temp_video(admin_id: int, file_id: str):
+async def set_temp_video(admin_id: int, file_id: str):
     key = f"temp_video:{admin_id}"
-    set_setting(key, file_id)
-    print(f"[SET_TEMP_VIDEO] admin_id={admin_id} file_id={file_id}")
+    await set_setting(key, file_id)
+    log_event("SET_TEMP_VIDEO", admin_id=admin_id, file_id=file_id)
 
-def get_temp_video(admin_id: int) -> Optional[str]:
+async def get_temp_video(admin_id: int) -> Optional[str]:
     key = f"temp_video:{admin_id}"
-    return get_setting(key)
+    return await get_setting(key)
 
-def del_temp_video(admin_id: int):
+async def del_temp_video(admin_id: int):
     key = f"temp_video:{admin_id}"
-    del_setting(key)
-    print(f"[DEL_TEMP_VIDEO] admin_id={admin_id}")
+    await del_setting(key)
+    log_event("DEL_TEMP_VIDEO", admin_id=admin_id)
+
+async def has_migrated() -> bool:
+    return await get_setting("migrated") == "1"
+
+async def set_migrated():
+    await set_setting("migrated", "1")
+    log_event("SET_MIGRATED")
+
+# --- Catalog readers ---
+CATALOG_PAGE_SIZE = int(os.getenv("CATALOG_PAGE_SIZE", "20"))
+
+async def catalog_page(after: Optional[str] = None, before: Optional[str] = None,
+                       size: int = CATALOG_PAGE_SIZE) -> tuple[list[tuple], bool, bool]:
+    """One page of (code, title, part count) by code, plus whether pages exist before and after it."""
+    if before is not None:
+        rows = await db_catalog_page(None, before, size + 1)
+        if len(rows) > size:
+            return rows[1:], True, True
+        # Fewer than a page before `before`: that is the first page, shown full.
+    rows = await db_catalog_page(after, None, size + 1)
+    return rows[:size], after is not None, len(rows) > size
+
+# --- Catalog cache ---
+CATALOG_CACHE_SIZE = int(os.getenv("CATALOG_CACHE_SIZE", "5000"))
+CATALOG_NEGATIVE_CACHE_SIZE = int(os.getenv("CATALOG_NEGATIVE_CACHE_SIZE", "20000"))
+
+CACHE_MISS = object()
+
+class LRUCache:
+    """Bounded mapping with least-recently-used eviction and hit/miss counters.
+
+    `generation` changes on every invalidation, so a reader that started a
+    DB load before a write can tell its result is stale and skip storing it.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = max(1, maxsize)
+        self._data: OrderedDict = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key, default=CACHE_MISS):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
 
-def has_migrated() -> bool:
-    return get_setting("migrated") == "1"
+    def peek(self, key, default=None):
+        return self._data.get(key, default)
 
-def set_migrated():
-    set_setting("migrated", "1")
-    print("[SET_MIGRATED] migration flag set")
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
 
-# --- Movie CRUD ---
-def add_movie_part(code: str, title: str, description: str, video: str):
-    print(f"[DB_ADD_PART] code={code} title={title} video_present={bool(video)}")
-    if not video:
-        print(f"[DB_ADD_PART_ERROR] code={code} no_video_provided")
+    def invalidate(self, key):
+        self._data.pop(key, None)
+        self.generation += 1
+
+    def clear(self):
+        self._data.clear()
+        self.generation += 1
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
+
+catalog_cache = LRUCache(CATALOG_CACHE_SIZE)
+missing_codes = LRUCache(CATALOG_NEGATIVE_CACHE_SIZE)
+
+def part_caption(title: Optional[str], description: Optional[str], suffix: str = "") -> str:
+    """Video caption, cut so that it and `suffix` fit Telegram's 1024 characters."""
+    return f"🎬 {title or ''}\n\n📝 {description or ''}"[:1024 - len(suffix)] + suffix
+
+def invalidate_movie(code: str):
+    catalog_cache.invalidate(code)
+    missing_codes.invalidate(code)
+    inline_results.clear()
+    invalidate_stats()
+
+def invalidate_catalog():
+    catalog_cache.clear()
+    missing_codes.clear()
+    inline_results.clear()
+    invalidate_stats()
+    log_event("CATALOG_CACHE_CLEARED")
+
+async def get_movie(code: str) -> Optional[dict]:
+    movie = catalog_cache.get(code)
+    if movie is CACHE_MISS:
+        if missing_codes.get(code) is not CACHE_MISS:
+            return None
+        generation = (catalog_cache.generation, missing_codes.generation)
+        movie = await db_get_movie(code)
+        if movie is not None:
+            # Rendered once per cache fill rather than once per send.
+            for part in movie["parts"]:
+                part["caption"] = part_caption(part["title"], part["description"])
+        if generation == (catalog_cache.generation, missing_codes.generation):
+            if movie is None:
+                missing_codes.put(code, True)
+            else:
+                catalog_cache.put(code, movie)
+        if movie is None:
+            return None
+    pending = view_counter.pending_for(code)
+    if pending:
+        return {**movie, "views": (movie["views"] or 0) + pending}
+    return movie
+
+async def add_movie_part(code: str, title: str, description: str, video: str):
+    try:
+        await db_add_movie_part(code, title, description, video)
+    finally:
+        invalidate_movie(code)
+    await recommender.refresh(code)
+    await cluster_sync.publish(code)
+
+async def update_part_video(code: str, part_index: Optional[int], video_file_id: str) -> bool:
+    try:
+        ok = await db_update_part_video(code, part_index, video_file_id)
+    finally:
+        invalidate_movie(code)
+    await recommender.refresh(code)
+    await cluster_sync.publish(code)
+    return ok
+
+async def delete_movie(code: str):
+    try:
+        await db_delete_movie(code)
+    finally:
+        invalidate_movie(code)
+    await recommender.refresh(code)
+    await cluster_sync.publish(code)
+
+async def delete_movie_part(code: str, part_index: int) -> Optional[dict]:
+    try:
+        res = await db_delete_movie_part(code, part_index)
+    finally:
+        invalidate_movie(code)
+    await recommender.refresh(code)
+    await cluster_sync.publish(code)
+    return res
+
+# --- Catalog import ---
+IMPORT_PATH = os.getenv("IMPORT_PATH", "movies.json")
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "1000"))
+IMPORT_REPORT_INTERVAL = float(os.getenv("IMPORT_REPORT_INTERVAL", "15"))
+
+class CatalogFile:
+    """Streams (code, entry) pairs out of a movies.json or JSONL catalog.
+
+    movies.json is one object mapping codes to entries; it is decoded an
+    entry at a time from a sliding buffer, so memory holds one entry plus a
+    read chunk. In a .jsonl/.ndjson file every line is an entry carrying its
+    own "code". Either may be gzipped (.gz). `position` counts the bytes
+    read from the file so far.
+    """
+
+    def __init__(self, path: str, chunk_size: int = 1 << 20):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.size = os.path.getsize(path)
+        self.position = 0
+
+    def __iter__(self):
+        if self.path.removesuffix(".gz").endswith((".jsonl", ".ndjson")):
+            return self._lines()
+        return self._mapping()
+
+    def _open(self):
+        raw = open(self.path, "rb")
+        return raw, gzip.GzipFile(fileobj=raw) if self.path.endswith(".gz") else raw
+
+    def _lines(self):
+        raw, f = self._open()
+        with raw, f:
+            for lineno, line in enumerate(f, start=1):
+                self.position = raw.tell()
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if not isinstance(entry, dict) or "code" not in entry:
+                    raise ValueError(f"{self.path}:{lineno}: entry without a code")
+                yield str(entry.pop("code")), entry
+
+    def _mapping(self):
+        decoder = json.JSONDecoder()
+        text = codecs.getincrementaldecoder("utf-8-sig")()
+        buf, i, eof = "", 0, False
+        raw, f = self._open()
+        with raw, f:
+            def more() -> bool:
+                nonlocal buf, i, eof
+                if eof:
+                    return False
+                chunk = f.read(self.chunk_size)
+                self.position = raw.tell()
+                eof = not chunk
+                buf, i = buf[i:] + text.decode(chunk, final=eof), 0
+                return True
+
+            def skip_ws():
+                nonlocal i
+                while True:
+                    while i < len(buf) and buf[i] in " \t\r\n":
+                        i += 1
+                    if i < len(buf) or not more():
+                        return
+
+            def expect(chars: str) -> str:
+                nonlocal i
+                skip_ws()
+                if i >= len(buf) or buf[i] not in chars:
+                    raise ValueError(f"{self.path}: expected one of {chars!r} near byte {self.position}")
+                i += 1
+                return buf[i - 1]
+
+            def value():
+                nonlocal i
+                skip_ws()
+                while True:
+                    try:
+                        obj, end = decoder.raw_decode(buf, i)
+                    except json.JSONDecodeError:
+                        if more():
+                            continue
+                        raise
+                    # A value ending at the buffer's edge may go on in the next chunk.
+                    if end == len(buf) and more():
+                        continue
+                    i = end
+                    return obj
+
+            expect("{")
+            skip_ws()
+            if i < len(buf) and buf[i] == "}":
+                return
+            while True:
+                code = value()
+                expect(":")
+                entry = value()
+                if isinstance(entry, dict):
+                    yield str(code), entry
+                if expect(",}") == "}":
+                    return
+
+def render_import(progress: dict, status: str) -> str:
+    label = {"running": "davom etmoqda", "done": "yakunlandi", "failed": "xato bilan to'xtadi"}.get(status, status)
+    share = progress["bytes"] / progress["size"] if progress["size"] else 1.0
+    return (
+        f"📥 Import ({os.path.basename(progress['path'])}) — {label}\n"
+        f"Jarayon: {share:.0%}, {progress['entries']} yozuv\n"
+        f"Yangi kinolar: {progress['movies']}, yangi qismlar: {progress['parts']}"
+    )
+
+class CatalogImporter:
+    """Loads a movies.json/JSONL catalog without holding up updates.
+
+    The file is parsed on a worker thread one batch at a time and each
+    batch is a single import_movies transaction, so memory stays at one
+    batch however large the file is. Entries already in the catalog are
+    skipped by the database, which makes re-running a failed or interrupted
+    import safe. Progress goes to the log and, when an admin started the
+    import, to their chat every `report_interval` seconds.
+    """
+
+    def __init__(self, batch_size: int, report_interval: float):
+        self.batch_size = batch_size
+        self.report_interval = report_interval
+        self.progress: Optional[dict] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, path: str, chat_id: Optional[int] = None, force: bool = False) -> bool:
+        """Run the import in the background; False if one is already running."""
+        if self.running:
+            return False
+        self._task = asyncio.create_task(self.run(path, chat_id, force))
+        return True
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _report(self, chat_id: Optional[int], text: str):
+        if chat_id is None:
+            return
+        try:
+            await bot.send_message(chat_id, text)
+        except TelegramAPIError as e:
+            log_event("MIGRATE_REPORT_ERROR", logging.WARNING, error=e)
+
+    async def run(self, path: str, chat_id: Optional[int] = None, force: bool = False) -> Optional[dict]:
+        if not force and await has_migrated():
+            log_event("MIGRATE_SKIP", reason="already_migrated")
+            return None
+        if not os.path.exists(path):
+            log_event("MIGRATE_SKIP", reason="file_not_found", path=path)
+            if not force:
+                await set_migrated()
+            await self._report(chat_id, f"📥 {path} topilmadi.")
+            return None
+        source = CatalogFile(path)
+        entries = iter(source)
+        progress = self.progress = {"path": path, "entries": 0, "movies": 0, "parts": 0, "bytes": 0, "size": source.size}
+        loop = asyncio.get_running_loop()
+        started = last_report = time.monotonic()
+        log_event("MIGRATE_START", path=path, size=source.size, force=force)
+        status, error = "done", ""
+        try:
+            while True:
+                batch = await loop.run_in_executor(None, list, itertools.islice(entries, self.batch_size))
+                if not batch:
+                    break
+                movies, parts = await db_import_movies(batch)
+                codes = [code for code, _ in batch]
+                for code in codes:
+                    invalidate_movie(code)
+                await cluster_sync.publish_many(codes)
+                progress["entries"] += len(batch)
+                progress["movies"] += movies
+                progress["parts"] += parts
+                progress["bytes"] = source.position
+                if time.monotonic() - last_report >= self.report_interval:
+                    last_report = time.monotonic()
+                    log_event("MIGRATE_PROGRESS", **progress)
+                    await self._report(chat_id, render_import(progress, "running"))
+        except Exception as e:
+            # Batches before the bad one stay committed; a re-run skips them.
+            status, error = "failed", f"\n{e}"
+            log_event("MIGRATE_ERROR", logging.ERROR, error=e, **progress)
+        if progress["parts"]:
+            await recommender.load()
+        if status == "done":
+            await set_migrated()
+            log_event("MIGRATE_DONE", seconds=round(time.monotonic() - started, 1), **progress)
+        await self._report(chat_id, render_import(progress, status) + error)
+        return progress
+
+catalog_importer = CatalogImporter(IMPORT_BATCH_SIZE, IMPORT_REPORT_INTERVAL)
+
+# --- Backups ---
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "5"))
+BACKUP_STEP_PAGES = int(os.getenv("BACKUP_STEP_PAGES", "4096"))
+BACKUP_REPORT_INTERVAL = float(os.getenv("BACKUP_REPORT_INTERVAL", "15"))
+BACKUP_SEND_MAX_MB = float(os.getenv("BACKUP_SEND_MAX_MB", "45"))  # bots may upload up to 50 MB
+
+BACKUP_KINDS = {
+    # kind: (file prefix, suffix, Storage method)
+    "backup": ("movies", ".db.gz", "backup"),
+    "export": ("catalog", ".jsonl.gz", "export_catalog"),
+}
+
+def render_backup_progress(job: dict) -> str:
+    stage = {"copy": "nusxa olinmoqda", "gzip": "siqilmoqda", "export": "eksport qilinmoqda"}.get(job["stage"], job["stage"])
+    share = job["done"] / job["total"] if job["total"] else 0.0
+    return f"💾 {job['kind']}: {stage}, {share:.0%} ({time.monotonic() - job['started']:.0f} s)"
+
+class BackupRunner:
+    """Runs one /backup or /export at a time on a worker thread.
+
+    The copy itself lives in Storage and reads from its own connection, so
+    pooled queries and updates are served as usual meanwhile; this side
+    only reports progress, keeps the newest BACKUP_KEEP files of each kind
+    and sends small artifacts straight to the admin.
+    """
+
+    def __init__(self, directory: str, keep: int, report_interval: float):
+        self.directory = directory
+        self.keep = keep
+        self.report_interval = report_interval
+        self.job: Optional[dict] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, kind: str, chat_id: int) -> bool:
+        if self.running:
+            return False
+        self.job = {"kind": kind, "stage": "", "done": 0, "total": 0, "started": time.monotonic()}
+        self._task = asyncio.create_task(self._run(self.job, chat_id))
+        return True
+
+    async def stop(self):
+        # The worker thread cannot be interrupted; shutdown waits for it.
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _say(self, chat_id: int, text: str):
+        try:
+            await bot.send_message(chat_id, text)
+        except TelegramAPIError as e:
+            log_event("BACKUP_REPORT_ERROR", logging.WARNING, error=e)
+
+    def _progress(self, job: dict, stage: str, done: int, total: int):
+        job["stage"], job["done"], job["total"] = stage, done, total
+
+    async def _run(self, job: dict, chat_id: int):
+        prefix, suffix, method = BACKUP_KINDS[job["kind"]]
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}{suffix}")
+        args = (path, functools.partial(self._progress, job))
+        if method == "backup":
+            args += (BACKUP_STEP_PAGES,)
+        future = asyncio.get_running_loop().run_in_executor(None, getattr(storage, method), *args)
+        log_event("BACKUP_START", kind=job["kind"], path=path)
+        while True:
+            done, _ = await asyncio.wait({future}, timeout=self.report_interval)
+            if done:
+                break
+            await self._say(chat_id, render_backup_progress(job))
+        seconds = time.monotonic() - job["started"]
+        try:
+            future.result()
+        except Exception as e:
+            log_event("BACKUP_ERROR", logging.ERROR, kind=job["kind"], path=path, error=e)
+            await self._say(chat_id, f"❌ {job['kind']} bajarilmadi: {e}")
+            return
+        size_mb = os.path.getsize(path) / 1024 / 1024
+        log_event("BACKUP_DONE", kind=job["kind"], path=path, size_mb=round(size_mb, 1), seconds=round(seconds, 1))
+        self._prune(prefix, suffix)
+        text = f"✅ {job['kind']}: {path} ({size_mb:.1f} MB, {seconds:.1f} s)"
+        if size_mb > BACKUP_SEND_MAX_MB:
+            await self._say(chat_id, text + "\nFayl Telegram orqali yuborish uchun juda katta, serverda saqlandi.")
+            return
+        try:
+            await bot.send_document(chat_id, FSInputFile(path), caption=text)
+        except TelegramAPIError as e:
+            log_event("BACKUP_SEND_ERROR", logging.WARNING, path=path, error=e)
+            await self._say(chat_id, text)
+
+    def _prune(self, prefix: str, suffix: str):
+        names = sorted(n for n in os.listdir(self.directory) if n.startswith(prefix + "-") and n.endswith(suffix))
+        for name in names[:-self.keep] if self.keep > 0 else []:
+            os.remove(os.path.join(self.directory, name))
+
+backup_runner = BackupRunner(BACKUP_DIR, BACKUP_KEEP, BACKUP_REPORT_INTERVAL)
+
+# --- Search ---
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "8"))
+SEARCH_WINDOW = int(os.getenv("SEARCH_WINDOW", "2000"))
+
+async def ensure_search_index():
+    """Index the existing catalog once, after the search tables were added."""
+    if await get_setting("search_indexed") == "1":
         return
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO movies (code, title, views) VALUES (?, ?, 0)", (code, title))
-    cur.execute("UPDATE movies SET title = ? WHERE code = ? AND (title IS NULL OR title = '')", (title, code))
-    cur.execute("SELECT 1 FROM parts WHERE movie_code=? AND video=? LIMIT 1", (code, video))
-    if cur.fetchone():
-        print(f"[DB_ADD_PART_SKIP] code={code} duplicate_video")
-    else:
-        cur.execute(
-            "INSERT INTO parts (movie_code, title, description, video) VALUES (?, ?, ?, ?)",
-            (code, title, description, video)
-        )
-        conn.commit()
-        cur.execute("SELECT id, movie_code, title, description, video FROM parts WHERE movie_code=? ORDER BY id", (code,))
-        rows = cur.fetchall()
-        print(f"[DB_ADD_PART_AFTER] code={code} parts_count={len(rows)} last_part={rows[-1] if rows else None}")
-    conn.close()
-
-def get_all_movies() -> dict:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT code, title, views FROM movies")
-    movies = {}
-    for code, title, views in cur.fetchall():
-        cur.execute("SELECT title, description, video FROM parts WHERE movie_code=? ORDER BY id", (code,))
-        parts = [{"title": p[0], "description": p[1], "video": p[2]} for p in cur.fetchall()]
-        movies[code] = {"title": title, "views": views, "parts": parts}
-    conn.close()
-    print(f"[DB_GET_ALL] total_movies={len(movies)}")
-    return movies
-
-def get_movie(code: str) -> Optional[dict]:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT title, views FROM movies WHERE code=?", (code,))
-    row = cur.fetchone()
-    if not row:
-        conn.close()
-        print(f"[DB_GET_MOVIE] code={code} not_found")
-        return None
-    title, views = row
-    cur.execute("SELECT title, description, video FROM parts WHERE movie_code=? ORDER BY id", (code,))
-    parts_raw = cur.fetchall()
-    parts = [{"title": p[0], "description": p[1], "video": p[2]} for p in parts_raw]
-    conn.close()
-    print(f"[DB_GET_MOVIE] code={code} title={title} views={views} parts_count={len(parts)} parts_videos={[p.get('video') for p in parts]}")
-    return {"title": title, "views": views, "parts": parts}
+    started = time.perf_counter()
+    parts = await db_rebuild_search()
+    log_event("SEARCH_INDEX_READY", parts=parts, seconds=round(time.perf_counter() - started, 2))
+
+@timed
+async def search_movies(query: str, page: int = 0) -> tuple[list[tuple], bool]:
+    """One page of (code, title) matches, best first, and whether more follow."""
+    rows = await db_search(query, SEARCH_PAGE_SIZE + 1, page * SEARCH_PAGE_SIZE, SEARCH_WINDOW)
+    return rows[:SEARCH_PAGE_SIZE], len(rows) > SEARCH_PAGE_SIZE
+
+# --- View counter ---
+VIEW_FLUSH_INTERVAL = float(os.getenv("VIEW_FLUSH_INTERVAL", "5"))
+VIEW_FLUSH_THRESHOLD = int(os.getenv("VIEW_FLUSH_THRESHOLD", "200"))
+VIEW_BUCKET_SECONDS = 3600
+VIEW_BUCKET_RETENTION = 8 * 24  # buckets; covers the 7-day trending window
+
+def current_view_bucket() -> int:
+    return int(time.time()) // VIEW_BUCKET_SECONDS
+
+class ViewCounter:
+    """Write-behind view counter.
+
+    Views are summed per code in memory and written with one executemany
+    every `interval` seconds, or sooner once `threshold` views are pending.
+    Deltas being flushed stay visible through pending_for() until the
+    transaction commits, so reads never lose a view. Each flush also adds
+    its deltas to the hourly view_buckets rollup used for trending.
+    """
+
+    def __init__(self, interval: float, threshold: int):
+        self.interval = interval
+        self.threshold = threshold
+        self._pending: dict[str, int] = {}
+        self._flushing: dict[str, int] = {}
+        self._pending_total = 0
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._pruned_bucket = 0
+        self.flushes = 0
+        self.flushed_views = 0
+
+    def add(self, code: str, n: int = 1):
+        self._pending[code] = self._pending.get(code, 0) + n
+        self._pending_total += n
+        if self._pending_total >= self.threshold:
+            self._wakeup.set()
+
+    def pending_for(self, code: str) -> int:
+        return self._pending.get(code, 0) + self._flushing.get(code, 0)
+
+    def pending_snapshot(self) -> dict[str, int]:
+        merged = dict(self._flushing)
+        for code, n in self._pending.items():
+            merged[code] = merged.get(code, 0) + n
+        return merged
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return
+            self._flushing, self._pending = self._pending, {}
+            total, self._pending_total = self._pending_total, 0
+            bucket = current_view_bucket()
+            prune_before = None
+            if bucket != self._pruned_bucket:
+                prune_before = bucket - VIEW_BUCKET_RETENTION
+            try:
+                await db_add_views(self._flushing, bucket, prune_before)
+            except Exception as e:
+                for code, n in self._flushing.items():
+                    self._pending[code] = self._pending.get(code, 0) + n
+                self._pending_total += total
+                log_event("VIEW_FLUSH_ERROR", logging.ERROR, codes=len(self._flushing), error=e)
+                raise
+            else:
+                # The flushed codes are the hot ones, so their cache entries
+                # are brought up to date rather than evicted. In-flight fills
+                # may have read the pre-flush count and are dropped instead.
+                catalog_cache.generation += 1
+                for code, n in self._flushing.items():
+                    movie = catalog_cache.peek(code)
+                    if movie is not None:
+                        movie["views"] = (movie["views"] or 0) + n
+                recommender.add_views(self._flushing)
+                if prune_before is not None:
+                    self._pruned_bucket = bucket
+                self.flushes += 1
+                self.flushed_views += total
+            finally:
+                self._flushing = {}
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        log_event("VIEW_COUNTER_STOPPED", flushes=self.flushes, views=self.flushed_views)
+
+    def stats(self) -> dict:
+        return {"pending": self._pending_total, "flushes": self.flushes, "flushed_views": self.flushed_views}
+
+view_counter = ViewCounter(VIEW_FLUSH_INTERVAL, VIEW_FLUSH_THRESHOLD)
 
 def increment_view(code: str):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE movies SET views = views + 1 WHERE code=?", (code,))
-    conn.commit()
-    conn.close()
-    print(f"[INCREMENT_VIEW] code={code}")
-
-def delete_movie(code: str):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM parts WHERE movie_code=?", (code,))
-    cur.execute("DELETE FROM movies WHERE code=?", (code,))
-    conn.commit()
-    conn.close()
-    print(f"[DELETE_MOVIE] code={code}")
-
-def delete_movie_part(code: str, part_index: int) -> Optional[dict]:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT id, title FROM parts WHERE movie_code=? ORDER BY id", (code,))
-    rows = cur.fetchall()
-    if part_index < 0 or part_index >= len(rows):
-        conn.close()
-        print(f"[DELETE_PART_FAIL] code={code} part_index={part_index} out_of_range")
+    view_counter.add(code)
+
+# --- Statistics ---
+STATS_TOP_N = int(os.getenv("STATS_TOP_N", "10"))
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", "30"))
+
+def _merge_top(rows: list[tuple], pending: dict[str, int], limit: int) -> list[tuple[str, str, int]]:
+    # Any movie in the true top-N is either in the stored top-N or has pending views,
+    # so merging those two sets is exact.
+    best: dict[str, tuple[str, int]] = {}
+    for code, title, views in rows:
+        if code not in best or (views or 0) > best[code][1]:
+            best[code] = (title, views or 0)
+    merged = [(code, title, views + pending.get(code, 0)) for code, (title, views) in best.items()]
+    return heapq.nlargest(limit, merged, key=lambda r: r[2])
+
+async def top_movies(limit: int = STATS_TOP_N) -> list[tuple[str, str, int]]:
+    pending = view_counter.pending_snapshot()
+    rows = await db_top_views(limit, list(pending))
+    return _merge_top(rows, pending, limit)
+
+async def trending_movies(hours: int, limit: int = STATS_TOP_N) -> list[tuple[str, str, int]]:
+    pending = view_counter.pending_snapshot()
+    since = current_view_bucket() - hours + 1
+    rows = await db_trending(since, limit, list(pending))
+    return [r for r in _merge_top(rows, pending, limit) if r[2] > 0]
+
+_stats_cache: Optional[tuple[float, str]] = None
+
+def invalidate_stats():
+    global _stats_cache
+    _stats_cache = None
+
+async def render_stats() -> Optional[str]:
+    global _stats_cache
+    if _stats_cache and _stats_cache[0] > time.monotonic():
+        return _stats_cache[1]
+    top, day, week = await asyncio.gather(top_movies(), trending_movies(24), trending_movies(24 * 7))
+    if not top:
         return None
-    part_id, part_title = rows[part_index]
-    cur.execute("DELETE FROM parts WHERE id=?", (part_id,))
-    conn.commit()
-    conn.close()
-    print(f"[DELETE_PART] code={code} part_index={part_index} title={part_title}")
-    return {"title": part_title}
-
-def update_part_video(code: str, part_index: Optional[int], video_file_id: str) -> bool:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM parts WHERE movie_code=? ORDER BY id", (code,))
-    rows = cur.fetchall()
-    if part_index is None:
+    lines = ["📊 Eng ko'p ko'rilgan kinolar:\n"]
+    for i, (code, title, views) in enumerate(top, start=1):
+        lines.append(f"{i}. {title or code} (Kod: {code}) — {views} marta")
+    for header, rows in (("🔥 So'nggi 24 soat:", day), ("📅 So'nggi 7 kun:", week)):
         if rows:
-            last_id = rows[-1][0]
-            cur.execute("UPDATE parts SET video=? WHERE id=?", (video_file_id, last_id))
-            print(f"[UPDATE_PART_VIDEO] code={code} updated_last_part_id={last_id}")
-        else:
-            cur.execute("INSERT OR IGNORE INTO movies (code, title, views) VALUES (?, ?, 0)", (code, code))
-            cur.execute("INSERT INTO parts (movie_code, title, description, video) VALUES (?, ?, ?, ?)",
-                        (code, code, "", video_file_id))
-            print(f"[UPDATE_PART_VIDEO] code={code} created_part_with_video")
-    else:
-        if 0 <= part_index < len(rows):
-            pid = rows[part_index][0]
-            cur.execute("UPDATE parts SET video=? WHERE id=?", (video_file_id, pid))
-            print(f"[UPDATE_PART_VIDEO] code={code} updated_part_index={part_index} id={pid}")
-        else:
-            conn.close()
-            print(f"[UPDATE_PART_VIDEO_FAIL] code={code} part_index={part_index} out_of_range")
-            return False
-    conn.commit()
-    conn.close()
-    return True
+            lines.append(f"\n{header}")
+            for i, (code, title, views) in enumerate(rows, start=1):
+                lines.append(f"{i}. {title or code} (Kod: {code}) — {views} marta")
+    text = "\n".join(lines)
+    _stats_cache = (time.monotonic() + STATS_CACHE_TTL, text)
+    return text
+
+# --- Recommendations ---
+RECOMMEND_POPULARITY = float(os.getenv("RECOMMEND_POPULARITY", "0.5"))
+RECOMMEND_RECENT = int(os.getenv("RECOMMEND_RECENT", "20"))
+RECOMMEND_MAX_USERS = int(os.getenv("RECOMMEND_MAX_USERS", "100000"))
+
+class RecommendationIndex:
+    """In-memory (code -> part ids) index with popularity-weighted sampling.
+
+    Each movie that has playable parts owns a slot in a Fenwick tree whose
+    weight is (views + 1) ** popularity, so picking a movie and updating a
+    weight both cost O(log n) and never touch the database. Recently sent
+    parts are remembered per user and skipped.
+    """
+
+    def __init__(self, popularity: float, recent: int, max_users: int):
+        self.popularity = popularity
+        self.recent = recent
+        self._codes: list[Optional[str]] = []
+        self._views: list[int] = []
+        self._weights: list[int] = []
+        self._tree: list[int] = [0]
+        self._slot_of: dict[str, int] = {}
+        self._parts: dict[str, list[int]] = {}
+        self._free: list[int] = []
+        self._recent = LRUCache(max_users)
+        self.loaded = False
+
+    def _weight(self, views: int) -> int:
+        return max(1, int(((views or 0) + 1) ** self.popularity * 1000))
+
+    def _tree_add(self, slot: int, delta: int):
+        i = slot + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _rebuild_tree(self, capacity: int):
+        tree = [0] * (capacity + 1)
+        for slot, w in enumerate(self._weights):
+            tree[slot + 1] = w
+        for i in range(1, capacity + 1):
+            parent = i + (i & -i)
+            if parent <= capacity:
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _set_weight(self, slot: int, weight: int):
+        self._tree_add(slot, weight - self._weights[slot])
+        self._weights[slot] = weight
 
-# --- JSON migration ---
-def migrate_json_to_sqlite(json_path: str = "movies.json"):
-    if has_migrated():
-        print("[MIGRATE] already migrated, skipping.")
-        return
-    if not os.path.exists(json_path):
-        print(f"[MIGRATE] {json_path} not found, skipping migration.")
-        set_migrated()
-        return
-    with open(json_path, "r", encoding="utf-8") as f:
-        try:
-            movies = json.load(f)
-        except Exception as e:
-            print(f"[MIGRATE_ERROR] failed to load json: {e}")
+    def _put(self, code: str, part_ids: list[int], views: int):
+        slot = self._slot_of.get(code)
+        if not part_ids:
+            if slot is not None:
+                self._set_weight(slot, 0)
+                self._codes[slot] = None
+                self._free.append(slot)
+                del self._slot_of[code]
+                self._parts.pop(code, None)
             return
-    conn = get_conn()
-    cur = conn.cursor()
-    for code, info in movies.items():
-        title = info.get("title", code)
-        views = info.get("views", 0)
-        cur.execute("INSERT OR IGNORE INTO movies (code, title, views) VALUES (?, ?, ?)", (code, title, views))
-        parts = info.get("parts", [])
-        if parts:
-            for part in parts:
-                p_title = part.get("title", title)
-                p_desc = part.get("description", "")
-                p_video = part.get("video", "")
-                if p_video:
-                    cur.execute("SELECT 1 FROM parts WHERE movie_code=? AND video=? LIMIT 1", (code, p_video))
-                    if cur.fetchone():
-                        print(f"[MIGRATE_SKIP] code={code} video_exists, skipping")
-                        continue
-                cur.execute("INSERT INTO parts (movie_code, title, description, video) VALUES (?, ?, ?, ?)",
-                            (code, p_title, p_desc, p_video))
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+                self._codes[slot] = code
+            else:
+                slot = len(self._codes)
+                self._codes.append(code)
+                self._views.append(0)
+                self._weights.append(0)
+                if slot + 1 >= len(self._tree):
+                    self._rebuild_tree(max(16, 2 * len(self._tree)))
+            self._slot_of[code] = slot
+        self._parts[code] = part_ids
+        self._views[slot] = views or 0
+        self._set_weight(slot, self._weight(views))
+
+    def _load_rows(self, rows: list[tuple]):
+        for code, group in itertools.groupby(rows, key=lambda r: r[0]):
+            group = list(group)
+            self._put(code, [r[1] for r in group], group[0][2])
+
+    async def load(self):
+        rows = await db_recommend_rows()
+        self._codes, self._views, self._weights = [], [], []
+        self._tree, self._slot_of, self._parts, self._free = [0], {}, {}, []
+        self._load_rows(rows)
+        self.loaded = True
+        log_event("RECOMMEND_INDEX_LOADED", movies=len(self._slot_of), parts=len(rows))
+
+    async def refresh(self, code: str):
+        if not self.loaded:
+            return
+        rows = await db_recommend_rows(code)
+        if rows:
+            self._load_rows(rows)
         else:
-            video = info.get("video", "")
-            desc = info.get("description", "")
-            if video:
-                cur.execute("SELECT 1 FROM parts WHERE movie_code=? AND video=? LIMIT 1", (code, video))
-                if not cur.fetchone():
-                    cur.execute("INSERT INTO parts (movie_code, title, description, video) VALUES (?, ?, ?, ?)",
-                                (code, title, desc, video))
-    conn.commit()
-    conn.close()
-    set_migrated()
-    print("[MIGRATE] migration finished.")
+            self._put(code, [], 0)
+
+    def add_views(self, deltas: dict[str, int]):
+        for code, n in deltas.items():
+            slot = self._slot_of.get(code)
+            if slot is not None:
+                self._views[slot] += n
+                self._set_weight(slot, self._weight(self._views[slot]))
+
+    def _sample_slot(self) -> Optional[int]:
+        total = self._tree_prefix(len(self._codes))
+        if total <= 0:
+            return None
+        target = random.randrange(total)
+        pos = 0
+        step = 1 << (len(self._tree) - 1).bit_length()
+        while step:
+            nxt = pos + step
+            if nxt < len(self._tree) and self._tree[nxt] <= target:
+                pos = nxt
+                target -= self._tree[nxt]
+            step >>= 1
+        return pos
+
+    def _tree_prefix(self, n: int) -> int:
+        total = 0
+        i = n
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def pick(self, user_id: int, attempts: int = 8) -> Optional[tuple[str, int]]:
+        seen = self._recent.get(user_id, None)
+        choice = None
+        for _ in range(attempts):
+            slot = self._sample_slot()
+            if slot is None:
+                return None
+            code = self._codes[slot]
+            parts = self._parts.get(code) or []
+            fresh = [pid for pid in parts if not seen or pid not in seen]
+            if fresh:
+                choice = (code, random.choice(fresh))
+                break
+            if choice is None and parts:
+                choice = (code, random.choice(parts))
+        if choice is None:
+            return None
+        if seen is None:
+            seen = collections.deque(maxlen=self.recent)
+            self._recent.put(user_id, seen)
+        seen.append(choice[1])
+        return choice
+
+    def stats(self) -> dict:
+        return {"movies": len(self._slot_of), "parts": sum(len(p) for p in self._parts.values())}
+
+recommender = RecommendationIndex(RECOMMEND_POPULARITY, RECOMMEND_RECENT, RECOMMEND_MAX_USERS)
 
 # --- Utilities ---
 def is_invite_link(s: str) -> bool:
@@ -292,13 +2729,96 @@ def normalize_channel_input(s: str) -> str:
         return s.rstrip("/")
     return "@" + s.lstrip("@")
 
-async def is_subscribed_all_diagnostic(user_id: int):
-    channels = get_channels()
+# --- Subscription checks ---
+SUB_CACHE_TTL = float(os.getenv("SUB_CACHE_TTL", "300"))
+SUB_CACHE_NEGATIVE_TTL = float(os.getenv("SUB_CACHE_NEGATIVE_TTL", "15"))
+SUB_CACHE_MAX_ENTRIES = int(os.getenv("SUB_CACHE_MAX_ENTRIES", "200000"))
+SUB_CHECK_CONCURRENCY = int(os.getenv("SUB_CHECK_CONCURRENCY", "8"))
+
+MEMBER_STATUSES = ("member", "administrator", "creator")
+
+class SubscriptionCache:
+    """Caches get_chat_member results per (user, channel).
+
+    Members are kept for `ttl` seconds, everything else (left, errors) for
+    `negative_ttl`, in LRU order: an expired entry is dropped when it is
+    read and a full cache evicts its least recently used entries. Misses
+    are fetched under a shared semaphore, and concurrent lookups of the same
+    pair await one in-flight request.
+    """
+
+    def __init__(self, ttl: float, negative_ttl: float, max_entries: int, concurrency: int):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._sem = asyncio.Semaphore(max(1, concurrency))
+        self._entries: OrderedDict = OrderedDict()  # (user, chat) -> (expires, status, error)
+        self._inflight: dict[tuple[int, str], asyncio.Task] = {}
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.joined = 0
+
+    async def check(self, user_id: int, chat_id: str) -> tuple[str, Optional[str]]:
+        key = (user_id, chat_id)
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1], entry[2]
+            del self._entries[key]
+        task = self._inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._fetch(key, self._generation))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _t, k=key: self._inflight.pop(k, None))
+        else:
+            self.joined += 1
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key: tuple[int, str], generation: int) -> tuple[str, Optional[str]]:
+        user_id, chat_id = key
+        async with self._sem:
+            try:
+                member = await bot.get_chat_member(chat_id=chat_id, user_id=user_id)
+                status, error = ("member" if member.status in MEMBER_STATUSES else "left"), None
+            except Exception as e:
+                status, error = "error", str(e)
+        if generation == self._generation:
+            ttl = self.ttl if status == "member" else self.negative_ttl
+            self._entries[key] = (time.monotonic() + ttl, status, error)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return status, error
+
+    def forget_negative(self, user_id: int, chat_ids: list[str]):
+        for chat_id in chat_ids:
+            entry = self._entries.get((user_id, chat_id))
+            if entry is not None and entry[1] != "member":
+                del self._entries[(user_id, chat_id)]
+
+    def clear(self):
+        self._entries.clear()
+        self._generation += 1
+        log_event("SUB_CACHE_CLEARED")
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses, "joined": self.joined}
+
+subscription_cache = SubscriptionCache(SUB_CACHE_TTL, SUB_CACHE_NEGATIVE_TTL, SUB_CACHE_MAX_ENTRIES, SUB_CHECK_CONCURRENCY)
+
+@timed
+async def is_subscribed_all_diagnostic(user_id: int, fresh: bool = False):
+    channels = await get_channels()
     if not channels:
         return True, {"not_subscribed": [], "inaccessible": [], "invite_only": []}
     not_subscribed = []
     inaccessible = []
     invite_only = []
+    checks = []
     for ch in channels:
         ch_str = ch.strip()
         if is_invite_link(ch_str):
@@ -308,13 +2828,15 @@ async def is_subscribed_all_diagnostic(user_id: int):
         if not name:
             inaccessible.append((ch_str, "Empty channel name"))
             continue
-        chat_id = f"@{name}"
-        try:
-            member = await bot.get_chat_member(chat_id=chat_id, user_id=user_id)
-            if member.status not in ("member", "administrator", "creator"):
-                not_subscribed.append(ch_str)
-        except Exception as e:
-            inaccessible.append((ch_str, str(e)))
+        checks.append((ch_str, f"@{name}"))
+    if fresh:
+        subscription_cache.forget_negative(user_id, [chat_id for _, chat_id in checks])
+    results = await asyncio.gather(*(subscription_cache.check(user_id, chat_id) for _, chat_id in checks))
+    for (ch_str, _), (status, error) in zip(checks, results):
+        if status == "error":
+            inaccessible.append((ch_str, error))
+        elif status != "member":
+            not_subscribed.append(ch_str)
     ok = (len(not_subscribed) == 0 and len(inaccessible) == 0)
     return ok, {"not_subscribed": not_subscribed, "inaccessible": inaccessible, "invite_only": invite_only}
 
@@ -331,15 +2853,22 @@ MAIN_BUTTONS_ADMIN = [
     [KeyboardButton(text="⚙️ Kanallarni boshqarish")],
     [KeyboardButton(text="🛠 Repair")],
     [KeyboardButton(text="🔁 Migratsiya")],
-    [KeyboardButton(text="🗑 Kino o'chirish")]
+    [KeyboardButton(text="🗑 Kino o'chirish")],
+    [KeyboardButton(text="📢 Xabar tarqatish")],
+    [KeyboardButton(text="💾 Zaxira nusxa")]
 ]
 
+# Telegram objects are frozen pydantic models, so one prebuilt keyboard can be
+# shared by every reply instead of being rebuilt and revalidated per update.
+MAIN_MENU = {
+    False: ReplyKeyboardMarkup(keyboard=MAIN_BUTTONS_USER, resize_keyboard=True),
+    True: ReplyKeyboardMarkup(keyboard=MAIN_BUTTONS_USER + MAIN_BUTTONS_ADMIN, resize_keyboard=True),
+}
+
 def main_menu(is_admin: bool = False) -> ReplyKeyboardMarkup:
-    buttons = [*MAIN_BUTTONS_USER]
-    if is_admin:
-        buttons.extend(MAIN_BUTTONS_ADMIN)
-    return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
+    return MAIN_MENU[bool(is_admin)]
 
+@functools.lru_cache(maxsize=128)
 def parts_menu(parts_count: int) -> ReplyKeyboardMarkup:
     rows = []
     row = []
@@ -354,6 +2883,10 @@ def parts_menu(parts_count: int) -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(keyboard=rows, resize_keyboard=True)
 
 def channels_panel_markup(channels: list[str]):
+    return _channels_panel_markup(tuple(channels))
+
+@functools.lru_cache(maxsize=8)
+def _channels_panel_markup(channels: tuple[str, ...]) -> InlineKeyboardMarkup:
     buttons = []
     for idx, ch in enumerate(channels, start=1):
         label = f"{idx}-kanal ↗"
@@ -365,8 +2898,36 @@ def channels_panel_markup(channels: list[str]):
     buttons.append([InlineKeyboardButton(text="✅ Tasdiqlash", callback_data="check_sub")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+def search_results_markup(rows: list[tuple], page: int, has_more: bool) -> InlineKeyboardMarkup:
+    buttons = []
+    for code, title in rows:
+        if len(code.encode()) > 59:  # callback_data is capped at 64 bytes
+            continue
+        label = title or code
+        if len(label) > 40:
+            label = label[:39] + "…"
+        buttons.append([InlineKeyboardButton(text=f"🎬 {label} ({code})", callback_data=f"open:{code}")])
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="◀️", callback_data=f"srch:{page - 1}"))
+    if has_more:
+        nav.append(InlineKeyboardButton(text="▶️", callback_data=f"srch:{page + 1}"))
+    if nav:
+        buttons.append(nav)
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+def catalog_page_markup(rows: list[tuple], has_prev: bool, has_next: bool) -> Optional[InlineKeyboardMarkup]:
+    # Pages are addressed by the first/last code shown, so a code longer than
+    # callback_data allows simply gets no arrow.
+    nav = []
+    if has_prev and len(rows[0][0].encode()) <= 59:
+        nav.append(InlineKeyboardButton(text="◀️", callback_data=f"cat:<{rows[0][0]}"))
+    if has_next and len(rows[-1][0].encode()) <= 59:
+        nav.append(InlineKeyboardButton(text="▶️", callback_data=f"cat:>{rows[-1][0]}"))
+    return InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None
+
 async def send_subscription_panel(to):
-    channels = get_channels()
+    channels = await get_channels()
     if not channels:
         return
     text = (
@@ -380,31 +2941,654 @@ async def send_subscription_panel(to):
     else:
         await to.message.answer(text, reply_markup=kb)
 
-def is_button_text(text: str) -> bool:
-    base = {
-        "🎬 Kino topish", "📊 Statistika", "📽 Kino tavsiyasi", "📩 Adminga murojaat",
-        "➕ Kino qo'shish", "📚 Barcha kinolar", "⚙️ Kanallarni boshqarish",
-        "🛠 Repair", "🔁 Migratsiya", "🔙 Asosiy menyu", "🗑 Kino o'chirish"
-    }
-    if text in base:
-        return True
-    if text.endswith("-qism") and text[:-5].isdigit():
-        return True
-    return False
-
 # --- Per-user state ---
-user_waiting_code: dict[int, bool] = {}
-user_waiting_part: dict[int, bool] = {}
-user_current_code: dict[int, str] = {}
-admin_repair_code: dict[int, str] = {}
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+STATE_TTL = float(os.getenv("STATE_TTL", "1800"))
+STATE_MAX_ENTRIES = int(os.getenv("STATE_MAX_ENTRIES", "100000"))
+STATE_PURGE_INTERVAL = float(os.getenv("STATE_PURGE_INTERVAL", "60"))
+
+class MemoryStateStore:
+    """(namespace, user_id) -> value with a per-entry TTL and a size cap.
+
+    Entries live in one OrderedDict in write order, so with the default TTL
+    the oldest entry is also the next to expire: eviction and purging pop
+    from the front, and every operation is O(1). Expired entries that were
+    not purged yet are dropped when read.
+    """
+
+    name = "memory"
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data: OrderedDict[tuple[str, int], tuple[float, object]] = OrderedDict()
+        self._task: Optional[asyncio.Task] = None
+        self.evicted = 0
+        self.expired = 0
+
+    async def get_many(self, user_id: int, namespaces: tuple) -> dict:
+        now = time.monotonic()
+        found = {}
+        for ns in namespaces:
+            entry = self._data.get((ns, user_id))
+            if entry is None:
+                continue
+            if entry[0] <= now:
+                del self._data[(ns, user_id)]
+                self.expired += 1
+                continue
+            found[ns] = entry[1]
+        return found
+
+    async def set(self, user_id: int, ns: str, value, ttl: Optional[float] = None):
+        key = (ns, user_id)
+        self._data.pop(key, None)
+        self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.evicted += 1
+
+    async def pop(self, user_id: int, ns: str):
+        entry = self._data.pop((ns, user_id), None)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1]
+
+    async def delete(self, user_id: int, namespaces: tuple):
+        for ns in namespaces:
+            self._data.pop((ns, user_id), None)
+
+    async def purge(self) -> int:
+        now = time.monotonic()
+        removed = 0
+        while self._data:
+            key, (expires_at, _) = next(iter(self._data.items()))
+            if expires_at > now:
+                break
+            del self._data[key]
+            removed += 1
+        self.expired += removed
+        return removed
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(STATE_PURGE_INTERVAL)
+            try:
+                await self.purge()
+            except Exception as e:
+                log_event("STATE_PURGE_ERROR", logging.ERROR, backend=self.name, error=e)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def stats(self) -> dict:
+        return {"backend": self.name, "size": len(self._data), "evicted": self.evicted, "expired": self.expired}
+
+class DBStateStore(MemoryStateStore):
+    """Same interface backed by the user_state table, so state survives
+    restarts and is shared by every process using the database. Expiry is
+    wall-clock time; the purge loop deletes expired rows and trims the
+    table to max_entries, oldest expiry first."""
+
+    name = "db"
+
+    async def get_many(self, user_id: int, namespaces: tuple) -> dict:
+        return await db_state_get(user_id, namespaces, time.time())
+
+    async def set(self, user_id: int, ns: str, value, ttl: Optional[float] = None):
+        await db_state_set(user_id, ns, value, time.time() + (ttl or self.ttl))
+
+    async def pop(self, user_id: int, ns: str):
+        return await db_state_pop(user_id, ns, time.time())
+
+    async def delete(self, user_id: int, namespaces: tuple):
+        await db_state_delete(user_id, namespaces)
+
+    async def purge(self) -> int:
+        removed = await db_state_purge(time.time(), self.max_entries)
+        self.expired += removed
+        return removed
+
+    async def stats(self) -> dict:
+        return {"backend": self.name, "size": await db_state_count(), "evicted": 0, "expired": self.expired}
+
+def create_state_store() -> MemoryStateStore:
+    if STATE_BACKEND == "memory" and WEB_WORKERS > 1:
+        log_event("STATE_BACKEND_FORCED", logging.WARNING, backend="db", workers=WEB_WORKERS)
+        return DBStateStore(STATE_TTL, STATE_MAX_ENTRIES)
+    if STATE_BACKEND in ("db", "database", "sqlite", "postgres"):
+        return DBStateStore(STATE_TTL, STATE_MAX_ENTRIES)
+    if STATE_BACKEND != "memory":
+        raise RuntimeError(f"Unknown STATE_BACKEND={STATE_BACKEND!r} (memory or db)")
+    return MemoryStateStore(STATE_TTL, STATE_MAX_ENTRIES)
+
+state_store = create_state_store()
+
+class StateField:
+    """One named piece of per-user conversation state in `state_store`."""
+
+    def __init__(self, ns: str):
+        self.ns = ns
+
+    async def get(self, user_id: int, default=None):
+        return (await state_store.get_many(user_id, (self.ns,))).get(self.ns, default)
+
+    async def set(self, user_id: int, value):
+        await state_store.set(user_id, self.ns, value)
+
+    async def pop(self, user_id: int, default=None):
+        value = await state_store.pop(user_id, self.ns)
+        return default if value is None else value
+
+async def get_state(user_id: int, *fields: StateField) -> dict:
+    """Read several fields in one round trip, keyed by namespace."""
+    return await state_store.get_many(user_id, tuple(f.ns for f in fields))
+
+async def clear_state(user_id: int, *fields: StateField):
+    await state_store.delete(user_id, tuple(f.ns for f in fields))
+
+user_waiting_code = StateField("waiting_code")
+user_waiting_part = StateField("waiting_part")
+user_current_code = StateField("current_code")
+admin_repair_code = StateField("repair")
+user_search_query = StateField("search")
+
+# --- Workers ---
+UPDATE_DEDUPE_SIZE = int(os.getenv("UPDATE_DEDUPE_SIZE", "50000"))
+UPDATE_DEDUPE_RETENTION = float(os.getenv("UPDATE_DEDUPE_RETENTION", "86400"))
+CACHE_SYNC_INTERVAL = float(os.getenv("CACHE_SYNC_INTERVAL", "2"))
+CATALOG_CHANGE_BATCH = 500
+# Ids are re-read this far back: PostgreSQL sequence values can commit out of order.
+CATALOG_CHANGE_RESCAN = 200
+
+class UpdateDeduplicator(BaseMiddleware):
+    """Outer update middleware that drops webhook redeliveries by update_id.
+
+    Recent ids are remembered in a per-process LRU. With several workers a
+    retry can land on another process, so the id is also claimed in the
+    processed_updates table and only the first claimer handles the update.
+    """
+
+    def __init__(self, size: int, shared: bool):
+        self.seen = LRUCache(size)
+        self.shared = shared
+        self.duplicates = 0
+
+    async def __call__(self, handler, event: Update, data: dict):
+        update_id = event.update_id
+        if self.seen.get(update_id) is not CACHE_MISS:
+            self.duplicates += 1
+            return None
+        self.seen.put(update_id, True)
+        if self.shared and not await db_claim_update(update_id, time.time()):
+            self.duplicates += 1
+            return None
+        return await handler(event, data)
+
+    def stats(self) -> dict:
+        return {"shared": self.shared, "duplicates": self.duplicates, **self.seen.stats()}
+
+class ClusterSync:
+    """Keeps per-process catalog caches coherent across workers.
+
+    Each catalog write appends its movie code to catalog_changes; every
+    worker polls the log, drops that code from its caches and refreshes it
+    in the recommendation index. Only a backlog larger than one batch falls
+    back to a full reload. The loop also prunes old processed_updates and
+    catalog_changes rows.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.last_id: Optional[int] = None
+        self._floor = 0  # everything up to here is reflected by a full load
+        self._applied = LRUCache(CATALOG_CHANGE_BATCH + CATALOG_CHANGE_RESCAN)
+        self._task: Optional[asyncio.Task] = None
+        self._pruned_at = 0.0
+        self.changes = 0
+        self.reloads = 0
+
+    async def publish(self, code: str):
+        if WEB_WORKERS <= 1:
+            return
+        # The writer already invalidated its own caches.
+        self._applied.put(await db_log_catalog_change(code, time.time()), True)
+
+    async def publish_many(self, codes: list[str]):
+        if WEB_WORKERS <= 1 or not codes:
+            return
+        # Not marked as applied: a bulk import shows up here as a backlog too,
+        # and the full reload that triggers is what an import needs anyway.
+        await db_log_catalog_changes(codes, time.time())
+
+    async def poll(self):
+        if self.last_id is None:
+            self.last_id = self._floor = await db_last_catalog_change()
+            return
+        rows = await db_catalog_changes(max(self._floor, self.last_id - CATALOG_CHANGE_RESCAN), CATALOG_CHANGE_BATCH)
+        fresh = [(change_id, code) for change_id, code in rows if self._applied.peek(change_id) is None]
+        if len(rows) == CATALOG_CHANGE_BATCH:
+            # Hundreds of changes behind: one full reload beats replaying them.
+            self.last_id = self._floor = await db_last_catalog_change()
+            invalidate_catalog()
+            await recommender.load()
+            self.reloads += 1
+        else:
+            for code in {code for _, code in fresh}:
+                invalidate_movie(code)
+                await recommender.refresh(code)
+            self.changes += len(fresh)
+        for change_id, _ in fresh:
+            self._applied.put(change_id, True)
+            self.last_id = max(self.last_id, change_id)
+        if time.monotonic() - self._pruned_at > 3600:
+            self._pruned_at = time.monotonic()
+            await db_purge_updates(time.time() - UPDATE_DEDUPE_RETENTION)
+            await db_purge_catalog_changes(time.time() - UPDATE_DEDUPE_RETENTION)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.poll()
+            except Exception as e:
+                log_event("CLUSTER_SYNC_ERROR", logging.ERROR, worker=WORKER_ID, error=e)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        return {"worker": WORKER_ID, "workers": WEB_WORKERS, "changes": self.changes, "reloads": self.reloads}
+
+update_deduplicator = UpdateDeduplicator(UPDATE_DEDUPE_SIZE, shared=WEB_WORKERS > 1)
+dp.update.outer_middleware(update_deduplicator)
+cluster_sync = ClusterSync(CACHE_SYNC_INTERVAL)
+
+# --- Users ---
+USER_FLUSH_INTERVAL = float(os.getenv("USER_FLUSH_INTERVAL", "5"))
+USER_FLUSH_THRESHOLD = int(os.getenv("USER_FLUSH_THRESHOLD", "500"))
+# A user seen again within this many seconds is not rewritten, so last_seen
+# is only this precise.
+USER_SEEN_WINDOW = float(os.getenv("USER_SEEN_WINDOW", "3600"))
+USER_SEEN_MAX = int(os.getenv("USER_SEEN_MAX", "200000"))
+
+class UserRegistry(BaseMiddleware):
+    """Write-behind users table, fed by every update.
+
+    As an outer update middleware it notes the update's user; users already
+    seen within USER_SEEN_WINDOW are skipped by an in-memory LRU, the rest
+    are buffered and upserted with one executemany per flush (every
+    `interval` seconds, or sooner once `threshold` users are pending).
+    Handlers never wait on a users write.
+    """
+
+    def __init__(self, interval: float, threshold: int, window: float, size: int):
+        self.interval = interval
+        self.threshold = threshold
+        self.window = window
+        self.seen = LRUCache(size)
+        self._pending: dict[int, tuple] = {}
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self.flushed_users = 0
+
+    async def __call__(self, handler, event: Update, data: dict):
+        user = data.get("event_from_user")
+        if user is not None and not user.is_bot:
+            self.record(user.id, user.first_name, user.username)
+        return await handler(event, data)
+
+    def record(self, user_id: int, first_name: str, username: Optional[str]):
+        now = time.time()
+        seen_at = self.seen.get(user_id)
+        if seen_at is not CACHE_MISS and now - seen_at < self.window:
+            return
+        self.seen.put(user_id, now)
+        self._pending[user_id] = (user_id, first_name, username, now)
+        if len(self._pending) >= self.threshold:
+            self._wakeup.set()
+
+    def forget(self, user_ids):
+        """Write these users on their next update (e.g. after marking them blocked)."""
+        for uid in user_ids:
+            self.seen.invalidate(uid)
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return
+            rows, self._pending = list(self._pending.values()), {}
+            try:
+                await db_upsert_users(rows)
+            except Exception as e:
+                for row in rows:
+                    self._pending.setdefault(row[0], row)
+                log_event("USER_FLUSH_ERROR", logging.ERROR, users=len(rows), error=e)
+                raise
+            self.flushes += 1
+            self.flushed_users += len(rows)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        log_event("USER_REGISTRY_STOPPED", flushes=self.flushes, users=self.flushed_users)
+
+    def stats(self) -> dict:
+        return {"pending": len(self._pending), "flushes": self.flushes, "flushed_users": self.flushed_users}
+
+user_registry = UserRegistry(USER_FLUSH_INTERVAL, USER_FLUSH_THRESHOLD, USER_SEEN_WINDOW, USER_SEEN_MAX)
+dp.update.outer_middleware(user_registry)
+
+# --- Broadcast ---
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "100"))
+BROADCAST_REPORT_INTERVAL = float(os.getenv("BROADCAST_REPORT_INTERVAL", "30"))
+# A running job nobody heartbeated for this long is taken over by any worker
+BROADCAST_LEASE = float(os.getenv("BROADCAST_LEASE", "60"))
+
+m_broadcast_sends = metrics.counter("broadcast_messages_total", "Broadcast deliveries", ("outcome",))
+
+class Broadcaster:
+    """Copies one admin message to every user who hasn't blocked the bot.
+
+    The job is a row in broadcasts. Users are walked in user_id order and
+    last_user_id with the counters is saved after every batch, so after a
+    restart the job continues where it stopped (at most
+    BROADCAST_CONCURRENCY users of a cut batch get it twice). The worker
+    running it heartbeats the row; any worker takes over a job whose
+    heartbeat is older than BROADCAST_LEASE. Sends use send_scheduler's
+    bulk lane, so replies to users keep priority.
+    """
+
+    def __init__(self):
+        self.job: Optional[dict] = None
+        self._job_task: Optional[asyncio.Task] = None
+        self._watch_task: Optional[asyncio.Task] = None
+
+    async def launch(self, from_chat_id: int, message_id: int) -> Optional[dict]:
+        job = await db_create_broadcast(from_chat_id, message_id, time.time())
+        if job is not None:
+            self._spawn(job)
+        return job
+
+    def _spawn(self, job: dict):
+        self.job = job
+        self._job_task = asyncio.create_task(self._run(job))
+
+    async def _deliver(self, job: dict, user_id: int) -> str:
+        try:
+            await bot.copy_message(chat_id=user_id, from_chat_id=job["from_chat_id"], message_id=job["message_id"])
+        except TelegramForbiddenError:
+            outcome = "blocked"
+        except TelegramAPIError as e:
+            log_event("BROADCAST_SEND_ERROR", logging.WARNING, sample=LOG_SAMPLE_RATE, user_id=user_id, error=e)
+            outcome = "failed"
+        else:
+            outcome = "sent"
+        m_broadcast_sends.inc(outcome)
+        return outcome
+
+    async def _send_batch(self, job: dict, user_ids: list[int]):
+        sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        outcomes: dict[int, str] = {}
+
+        async def one(user_id: int):
+            async with sem:
+                outcomes[user_id] = await self._deliver(job, user_id)
+
+        try:
+            await asyncio.gather(*(one(uid) for uid in user_ids))
+        finally:
+            # Only the finished prefix counts as done, also when cut short.
+            blocked = []
+            for uid in user_ids:
+                outcome = outcomes.get(uid)
+                if outcome is None:
+                    break
+                job[outcome] += 1
+                job["last_user_id"] = uid
+                if outcome == "blocked":
+                    blocked.append(uid)
+            if blocked:
+                await db_mark_users_blocked(blocked, time.time())
+                user_registry.forget(blocked)
+
+    async def _report(self, job: dict, started: float, done_before: int, status: str):
+        done = job["sent"] + job["blocked"] + job["failed"]
+        elapsed = time.monotonic() - started
+        rate = (done - done_before) / elapsed if elapsed > 0 else 0.0
+        log_event(
+            "BROADCAST_PROGRESS", id=job["id"], status=status, done=done, total=job["total"],
+            sent=job["sent"], blocked=job["blocked"], failed=job["failed"], rate=round(rate, 1)
+        )
+        try:
+            await bot.send_message(job["from_chat_id"], render_broadcast(job, status) + f"\nTezlik: {rate:.1f} xabar/s")
+        except TelegramAPIError as e:
+            log_event("BROADCAST_REPORT_ERROR", logging.WARNING, id=job["id"], error=e)
+
+    async def _run(self, job: dict):
+        send_lane.set(LANE_BULK)
+        started = last_report = time.monotonic()
+        done_before = job["sent"] + job["blocked"] + job["failed"]
+        log_event("BROADCAST_START", id=job["id"], total=job["total"], after_user_id=job["last_user_id"])
+        try:
+            status = "done"
+            while True:
+                user_ids = await db_users_after(job["last_user_id"], BROADCAST_BATCH)
+                if not user_ids:
+                    break
+                await self._send_batch(job, user_ids)
+                if not await db_save_broadcast(job, "running", time.time()):
+                    status = "cancelled"
+                    break
+                if time.monotonic() - last_report >= BROADCAST_REPORT_INTERVAL:
+                    last_report = time.monotonic()
+                    await self._report(job, started, done_before, "running")
+            if status == "done":
+                now = time.time()
+                await db_save_broadcast(job, "done", now, now)
+            await self._report(job, started, done_before, status)
+        except asyncio.CancelledError:
+            # Shutting down: keep the progress and drop the lease so the next
+            # start resumes right away.
+            await db_save_broadcast(job, "running", 0.0)
+            raise
+        except Exception as e:
+            # The row stays running; the lease runs out and the job is retried.
+            log_event("BROADCAST_ERROR", logging.ERROR, id=job["id"], error=e)
+        finally:
+            self.job = None
+            self._job_task = None
+
+    async def _watch(self):
+        while True:
+            try:
+                now = time.time()
+                if self.job is not None:
+                    await db_heartbeat_broadcast(self.job["id"], now)
+                else:
+                    job = await db_claim_broadcast(now, now - BROADCAST_LEASE)
+                    if job is not None:
+                        log_event("BROADCAST_RESUME", id=job["id"], after_user_id=job["last_user_id"])
+                        self._spawn(job)
+            except Exception as e:
+                log_event("BROADCAST_WATCH_ERROR", logging.WARNING, error=e)
+            await asyncio.sleep(BROADCAST_LEASE / 3)
+
+    def start(self):
+        if self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        for task in (self._watch_task, self._job_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._watch_task = None
+
+def render_broadcast(job: dict, status: str) -> str:
+    label = {"running": "davom etmoqda", "done": "yakunlandi", "cancelled": "to'xtatildi"}.get(status, status)
+    done = job["sent"] + job["blocked"] + job["failed"]
+    return (
+        f"📢 Tarqatish #{job['id']} — {label}\n"
+        f"Jarayon: {done}/{job['total']}\n"
+        f"Yuborildi: {job['sent']}, botni bloklagan: {job['blocked']}, xato: {job['failed']}"
+    )
+
+broadcaster = Broadcaster()
+
+# --- Routing ---
+class Router:
+    """Hash-table dispatch in front of aiogram's handler list.
+
+    aiogram tries handlers in order, so with one lambda filter per button a
+    typed movie code was checked against every one of them. Here exact button
+    texts, commands and callback prefixes are a single dict lookup; admin-only
+    routes cost an id comparison. The few predicate flows (admin videos and
+    admin states) are tried in order for the admin only, and any other text
+    goes to the free-text flow.
+    """
+
+    def __init__(self):
+        self.texts: dict[str, tuple] = {}
+        self.commands: dict[str, tuple] = {}
+        self.callbacks: dict[str, tuple] = {}
+        self.admin_flows: list = []
+        self.fallback = None
+
+    def text(self, *texts: str, admin: bool = False):
+        def register(fn):
+            for text in texts:
+                self.texts[text] = (fn, admin)
+            return fn
+        return register
+
+    def command(self, *names: str, admin: bool = False):
+        def register(fn):
+            for name in names:
+                self.commands[name] = (fn, admin)
+            return fn
+        return register
+
+    def callback(self, *prefixes: str, admin: bool = False):
+        """Route callback data equal to `prefix` or starting with `prefix:`."""
+        def register(fn):
+            for prefix in prefixes:
+                self.callbacks[prefix] = (fn, admin)
+            return fn
+        return register
+
+    def admin_flow(self, predicate):
+        def register(fn):
+            self.admin_flows.append((predicate, fn))
+            return fn
+        return register
+
+    def default(self, fn):
+        self.fallback = fn
+        return fn
+
+    async def _command(self, text: str):
+        """Route for "/name" or "/name@thisbot"; False for a command addressed to another bot."""
+        name, _, mention = text.split(maxsplit=1)[0][1:].partition("@")
+        if mention:
+            me = await bot.me()
+            if mention.lower() != (me.username or "").lower():
+                return False
+        return self.commands.get(name)
+
+    async def match_message(self, message: Message):
+        user = message.from_user
+        is_admin = user is not None and user.id == ADMIN_ID
+        text = message.text
+        if text:
+            route = self.texts.get(text)
+            if route is None and text[0] == "/":
+                route = await self._command(text)
+                if route is False:
+                    return False  # "/start@otherbot" in a group is not ours, nor a movie code
+            if route is not None:
+                fn, admin_only = route
+                return {"route": fn} if is_admin or not admin_only else False
+        if is_admin:
+            for predicate, fn in self.admin_flows:
+                if await predicate(message):
+                    return {"route": fn}
+        if text and self.fallback:
+            return {"route": self.fallback}
+        return False
+
+    async def match_callback(self, callback: CallbackQuery):
+        route = self.callbacks.get((callback.data or "").partition(":")[0])
+        if route is None:
+            return False
+        fn, admin_only = route
+        if admin_only and callback.from_user.id != ADMIN_ID:
+            return False
+        return {"route": fn}
+
+router = Router()
+
+@dp.message(router.match_message)
+async def route_message(message: Message, route):
+    await route(message)
+
+@dp.callback_query(router.match_callback)
+async def route_callback(callback: CallbackQuery, route):
+    await route(callback)
 
 # --- Handlers ---
-@dp.message(Command("start"))
+@router.command("start")
 async def cmd_start(message: Message):
     user_id = message.from_user.id
-    user_waiting_code.pop(user_id, None)
-    user_waiting_part.pop(user_id, None)
-    user_current_code.pop(user_id, None)
+    await clear_state(user_id, user_waiting_code, user_waiting_part, user_current_code)
     kb = main_menu(is_admin=(user_id == ADMIN_ID))
     ok, info = await is_subscribed_all_diagnostic(user_id)
     welcome_text = (
@@ -431,81 +3615,67 @@ async def cmd_start(message: Message):
         return
     await message.answer(welcome_text, reply_markup=kb)
 
-@dp.message(lambda m: m.text == "🎬 Kino topish")
+@router.text("🎬 Kino topish")
 async def btn_search(message: Message):
-    user_waiting_code[message.from_user.id] = True
-    user_waiting_part.pop(message.from_user.id, None)
-    user_current_code.pop(message.from_user.id, None)
-    await message.answer("Kino kodini kiriting:")
+    await clear_state(message.from_user.id, user_waiting_part, user_current_code)
+    await user_waiting_code.set(message.from_user.id, True)
+    await message.answer("Kino kodini yoki nomini kiriting:")
 
-@dp.message(lambda m: m.text == "📊 Statistika")
+@router.text("📊 Statistika")
 async def btn_stats(message: Message):
     ok, _ = await is_subscribed_all_diagnostic(message.from_user.id)
     if not ok:
         await send_subscription_panel(message)
         return
-    movies = get_all_movies()
-    if not movies:
+    text = await render_stats()
+    if not text:
         await message.answer("Hozircha statistikada kino yo'q.")
         return
-    top = sorted(movies.items(), key=lambda x: x[1].get("views", 0), reverse=True)
-    lines = ["📊 Eng ko'p ko'rilgan kinolar:\n"]
-    for i, (code, info) in enumerate(top, start=1):
-        lines.append(f"{i}. {info.get('title', code)} (Kod: {code}) — {info.get('views', 0)} marta")
-    await message.answer("\n".join(lines))
+    await message.answer(text)
 
-@dp.message(lambda m: m.text == "📽 Kino tavsiyasi")
+@router.text("📽 Kino tavsiyasi")
 async def btn_recommend(message: Message):
     ok, _ = await is_subscribed_all_diagnostic(message.from_user.id)
     if not ok:
         await send_subscription_panel(message)
         return
-    movies = get_all_movies()
-    if not movies:
+    pick = recommender.pick(message.from_user.id)
+    info = await get_movie(pick[0]) if pick else None
+    part = next((p for p in info["parts"] if p.get("id") == pick[1]), None) if info else None
+    if not part:
         await message.answer("Hozircha tavsiya uchun kinolar yo'q.")
         return
-    multi = [(code, info) for code, info in movies.items() if info.get("parts")]
-    if not multi:
-        await message.answer("Hozircha tavsiya uchun kinolar yo'q.")
-        return
-    code, info = random.choice(multi)
-    part = random.choice(info["parts"])
+    code = pick[0]
     video_id = part.get("video")
     if not video_id:
         await message.answer("❌ Tavsiya qilingan qism uchun video topilmadi.")
         return
     increment_view(code)
     try:
-        await message.answer_video(video=video_id, caption=f"🎬 {part.get('title','')}\n\n📝 {part.get('description','')}\n\n💡 Tavsiya qilindi")
+        await message.answer_video(video=video_id, caption=part_caption(part["title"], part["description"], "\n\n💡 Tavsiya qilindi"))
     except TelegramBadRequest:
         await message.answer("❌ Tavsiya qilingan qism uchun video yuborib bo'lmadi.")
 
-@dp.message(lambda m: m.text == "📩 Adminga murojaat")
+@router.text("📩 Adminga murojaat")
 async def btn_contact(message: Message):
     await message.answer("Adminga murojaat: https://t.me/forever_projects")
 
-@dp.message(lambda m: m.text == "🔙 Asosiy menyu")
+@router.text("🔙 Asosiy menyu")
 async def btn_back_to_main(message: Message):
     user_id = message.from_user.id
-    user_waiting_part.pop(user_id, None)
-    user_waiting_code.pop(user_id, None)
-    user_current_code.pop(user_id, None)
+    await clear_state(user_id, user_waiting_part, user_waiting_code, user_current_code)
     kb = main_menu(is_admin=(user_id == ADMIN_ID))
     await message.answer("Asosiy menyu.", reply_markup=kb)
 
 # --- Admin flows ---
-@dp.message(lambda m: m.text == "➕ Kino qo'shish" and m.from_user.id == ADMIN_ID)
+@router.text("➕ Kino qo'shish", admin=True)
 async def btn_add_movie(message: Message):
     await message.answer("Videoni yuboring, keyin matn yuboring: Kod | Qism nomi | Sharh")
 
-@dp.message(lambda m: m.video and m.from_user.id == ADMIN_ID)
-async def admin_receive_video(message: Message):
-    file_id = message.video.file_id
-    set_temp_video(message.from_user.id, file_id)
-    print(f"[ADMIN_VIDEO] admin_id={message.from_user.id} file_id={file_id} file_size={getattr(message.video, 'file_size', None)} mime_type={getattr(message.video, 'mime_type', None)}")
-    await message.answer("✅ Video qabul qilindi.\nEndi matn yuboring: Kod | Qism nomi | Sharh")
+async def is_admin_info(m: Message) -> bool:
+    return bool(m.text and "|" in m.text)
 
-@dp.message(lambda m: m.text and "|" in m.text and m.from_user.id == ADMIN_ID)
+@router.admin_flow(is_admin_info)
 async def admin_receive_info(message: Message):
     try:
         parts = message.text.split("|", maxsplit=2)
@@ -513,50 +3683,79 @@ async def admin_receive_info(message: Message):
             await message.answer("❌ Format noto'g'ri. To'g'ri format: Kod | Qism nomi | Sharh")
             return
         code, part_title, desc = map(lambda s: s.strip(), parts)
-        video_id = get_temp_video(message.from_user.id)
-        print(f"[ADMIN_INFO] admin_id={message.from_user.id} code={code} part_title={part_title} desc_len={len(desc)} video_id={video_id}")
+        video_id = await get_temp_video(message.from_user.id)
+        log_event("ADMIN_INFO", admin_id=message.from_user.id, code=code, part_title=part_title, desc_len=len(desc), video_id=video_id)
         if not video_id:
             await message.answer("❗ Avval video yuboring yoki /cancel bilan qayta urinib ko'ring.")
-            print(f"[ADMIN_INFO_ERROR] admin_id={message.from_user.id} no_temp_video_found")
+            log_event("ADMIN_INFO_ERROR", logging.WARNING, admin_id=message.from_user.id, reason="no_temp_video_found")
             return
-        add_movie_part(code, part_title, desc, video_id)
-        del_temp_video(message.from_user.id)
-        print(f"[ADMIN_INFO_SAVED] admin_id={message.from_user.id} code={code} video_saved={video_id}")
+        await add_movie_part(code, part_title, desc, video_id)
+        await del_temp_video(message.from_user.id)
+        log_event("ADMIN_INFO_SAVED", admin_id=message.from_user.id, code=code, video_saved=video_id)
         try:
-            await message.answer_video(video=video_id, caption=f"🎬 {part_title}\n\n📝 {desc}")
+            await message.answer_video(video=video_id, caption=part_caption(part_title, desc))
         except TelegramBadRequest as e:
-            print(f"[ADMIN_PREVIEW_ERROR] admin_id={message.from_user.id} code={code} error={e}")
+            log_event("ADMIN_PREVIEW_ERROR", logging.WARNING, admin_id=message.from_user.id, code=code, error=e)
             await message.answer("✅ Qism qo'shildi, lekin preview yuborilmadi (file_id muammosi).")
         await message.answer("✅ Qism qo'shildi.")
     except Exception as e:
-        print(f"[ADMIN_INFO_EXCEPTION] error={e}")
+        log_event("ADMIN_INFO_EXCEPTION", logging.WARNING, admin_id=message.from_user.id, error=e)
         await message.answer("❌ Format noto'g'ri. To'g'ri format: Kod | Qism nomi | Sharh")
 
-@dp.message(lambda m: m.text == "📚 Barcha kinolar" and m.from_user.id == ADMIN_ID)
+def render_catalog_page(rows: list[tuple]) -> str:
+    lines = [f"📚 Barcha kinolar (kod {rows[0][0]} – {rows[-1][0]}):\n"]
+    for code, title, parts in rows:
+        label = title or code
+        if len(label) > 60:
+            label = label[:59] + "…"
+        lines.append(f"🎬 {label} (Kod: {code}) — qismlar: {parts}")
+    return "\n".join(lines)
+
+@router.text("📚 Barcha kinolar", admin=True)
 async def btn_list_movies(message: Message):
-    movies = get_all_movies()
-    if not movies:
+    rows, has_prev, has_next = await catalog_page()
+    if not rows:
         await message.answer("Hozircha kino yo'q.")
         return
-    lines = ["📚 Barcha kinolar:\n"]
-    for code, info in movies.items():
-        lines.append(f"🎬 {info.get('title', code)} (Kod: {code}) — qismlar: {len(info.get('parts', []))}")
-    text = "\n".join(lines)
-    for i in range(0, len(text), 3500):
-        await message.answer(text[i:i+3500])
+    await message.answer(render_catalog_page(rows), reply_markup=catalog_page_markup(rows, has_prev, has_next))
+
+@router.callback("cat", admin=True)
+async def page_catalog(callback: CallbackQuery):
+    arg = callback.data.partition(":")[2]
+    direction, code = arg[:1], arg[1:]
+    await callback.answer()
+    if direction == "<":
+        rows, has_prev, has_next = await catalog_page(before=code)
+    else:
+        rows, has_prev, has_next = await catalog_page(after=code)
+    if not rows:
+        rows, has_prev, has_next = await catalog_page()
+    try:
+        await callback.message.edit_text(
+            render_catalog_page(rows) if rows else "Hozircha kino yo'q.",
+            reply_markup=catalog_page_markup(rows, has_prev, has_next) if rows else None,
+        )
+    except TelegramBadRequest:
+        pass  # same page clicked twice: "message is not modified"
 
-@dp.message(lambda m: m.text == "⚙️ Kanallarni boshqarish" and m.from_user.id == ADMIN_ID)
+@router.text("⚙️ Kanallarni boshqarish", admin=True)
 async def edit_channels_start(message: Message):
-    current = get_channels()
+    current = await get_channels()
     existing = "\n".join(f"{i+1}-kanal: {ch}" for i, ch in enumerate(current, start=1)) if current else "— Mavjud emas —"
     await message.answer(
         "Kanallar ro'yxatini yuboring (har birini alohida qatorda).\n"
         "Qabul qilinadi: @kanal yoki https://t.me/kanal yoki https://t.me/+invite_link\n\n"
         f"Hozirgi ro'yxat:\n{existing}"
     )
-    user_current_code[message.from_user.id] = "__editing_channels__"
+    await user_current_code.set(message.from_user.id, "__editing_channels__")
 
-@dp.message(lambda m: m.from_user.id == ADMIN_ID and m.text and m.text.strip() and user_current_code.get(m.from_user.id) == "__editing_channels__")
+async def is_editing_channels(m: Message) -> bool:
+    return bool(
+        m.text and m.text.strip()
+        and await user_current_code.get(m.from_user.id) == "__editing_channels__"
+    )
+
+@router.admin_flow(is_editing_channels)
 async def edit_channels_apply(message: Message):
     lines = [ln.strip() for ln in message.text.splitlines() if ln.strip()]
     channels = []
@@ -567,14 +3766,15 @@ async def edit_channels_apply(message: Message):
             ln = ln.lstrip("@").strip()
             if ln:
                 channels.append("@" + ln)
-    save_channels_list(channels)
-    user_current_code.pop(message.from_user.id, None)
+    await save_channels_list(channels)
+    subscription_cache.clear()
+    await clear_state(message.from_user.id, user_current_code)
     kb = channels_panel_markup(channels)
     await message.answer("✅ Kanallar yangilandi. Foydalanuvchilarga ko'rinishi:", reply_markup=kb)
 
-@dp.callback_query(lambda c: c.data == "check_sub")
+@router.callback("check_sub")
 async def check_subscription(callback: CallbackQuery):
-    ok, info = await is_subscribed_all_diagnostic(callback.from_user.id)
+    ok, info = await is_subscribed_all_diagnostic(callback.from_user.id, fresh=True)
     if ok:
         await callback.message.answer("✅ Obuna tasdiqlandi. /start ni bosing.")
         await cmd_start(callback.message)
@@ -596,14 +3796,12 @@ async def check_subscription(callback: CallbackQuery):
         await callback.message.answer(text)
         await send_subscription_panel(callback)
 
-@dp.message(lambda m: m.text == "🛠 Repair" and m.from_user.id == ADMIN_ID)
+@router.text("🛠 Repair", admin=True)
 async def btn_repair_help(message: Message):
     await message.answer("Foydalanish: /repair <KOD> yoki /repair <KOD> <QISM_RAQAMI>\nBuyruqdan so'ng yangi videoni yuboring.")
 
-@dp.message(Command("repair"))
+@router.command("repair", admin=True)
 async def cmd_repair(message: Message):
-    if message.from_user.id != ADMIN_ID:
-        return
     parts = message.text.split()
     if len(parts) < 2:
         await message.answer("Foydalanish: /repair <KOD> yoki /repair <KOD> <QISM_RAQAMI>")
@@ -612,44 +3810,66 @@ async def cmd_repair(message: Message):
     qism_index: Optional[int] = None
     if len(parts) >= 3 and parts[2].isdigit():
         qism_index = int(parts[2]) - 1
-    movie = get_movie(code)
+    movie = await get_movie(code)
     if not movie:
         await message.answer("Bunday kod topilmadi.")
         return
-    admin_repair_code[message.from_user.id] = json.dumps({"code": code, "part": qism_index})
+    await admin_repair_code.set(message.from_user.id, {"code": code, "part": qism_index})
     await message.answer(f"✅ Kod {code} uchun video qabul qilish rejimi yoqildi. Yangi videoni yuboring.")
 
-@dp.message(lambda m: m.video and m.from_user.id == ADMIN_ID and m.from_user.id in admin_repair_code)
+async def is_repairing(m: Message) -> bool:
+    return bool(m.video and await admin_repair_code.get(m.from_user.id) is not None)
+
+@router.admin_flow(is_repairing)
 async def admin_receive_repair_video(message: Message):
-    raw = admin_repair_code.pop(message.from_user.id, None)
-    if not raw:
+    data = await admin_repair_code.pop(message.from_user.id)
+    if not data:
         await message.answer("Repair rejimi topilmadi. /repair bilan qayta urinib ko'ring.")
         return
-    data = json.loads(raw)
     code = data.get("code")
     part_idx = data.get("part")
-    movie = get_movie(code)
+    movie = await get_movie(code)
     if not movie:
         await message.answer("Kod topilmadi, bekor qilindi.")
         return
-    ok = update_part_video(code, part_idx, message.video.file_id)
+    ok = await update_part_video(code, part_idx, message.video.file_id)
     if not ok:
         await message.answer("❌ Qism topilmadi. Repair bekor qilindi.")
         return
     await message.answer("✅ Video yangilandi va saqlandi.")
 
-@dp.message(lambda m: m.text == "🔁 Migratsiya" and m.from_user.id == ADMIN_ID)
+# Registered after the repair flow: a video sent after /repair replaces a part.
+async def is_plain_video(m: Message) -> bool:
+    return m.video is not None
+
+@router.admin_flow(is_plain_video)
+async def admin_receive_video(message: Message):
+    file_id = message.video.file_id
+    await set_temp_video(message.from_user.id, file_id)
+    log_event(
+        "ADMIN_VIDEO", admin_id=message.from_user.id, file_id=file_id,
+        file_size=message.video.file_size, mime_type=message.video.mime_type
+    )
+    await message.answer("✅ Video qabul qilindi.\nEndi matn yuboring: Kod | Qism nomi | Sharh")
+
+@router.text("🔁 Migratsiya", admin=True)
 async def btn_migrate_help(message: Message):
     await cmd_migrate(message)
 
-@dp.message(Command("migrate"))
+@router.command("migrate", admin=True)
 async def cmd_migrate(message: Message):
-    if message.from_user.id != ADMIN_ID:
+    parts = (message.text or "").split(maxsplit=1)
+    path = parts[1].strip() if len(parts) > 1 and parts[0].startswith("/") else IMPORT_PATH
+    if not catalog_importer.start(path, message.chat.id, force=True):
+        progress = catalog_importer.progress
+        await message.answer("❗ Import allaqachon davom etmoqda.\n" + (render_import(progress, "running") if progress else ""))
         return
-    migrate_json_to_sqlite()
-    await message.answer("✅ Migratsiya bajarildi (agar movies.json mavjud bo'lsa).")
+    await message.answer(
+        f"📥 {path} importi boshlandi. Mavjud kinolar va videolar o'tkazib yuboriladi; "
+        f"jarayon haqida har {IMPORT_REPORT_INTERVAL:g} soniyada xabar beraman."
+    )
 
-@dp.message(lambda m: m.text == "🗑 Kino o'chirish" and m.from_user.id == ADMIN_ID)
+@router.text("🗑 Kino o'chirish", admin=True)
 async def btn_delete_movie(message: Message):
     await message.answer(
         "🗑 O'chirish rejimi.\n\n"
@@ -659,10 +3879,8 @@ async def btn_delete_movie(message: Message):
         "Masalan:\n/delete A123\n/delete A123 2"
     )
 
-@dp.message(Command("delete"))
+@router.command("delete", admin=True)
 async def cmd_delete(message: Message):
-    if message.from_user.id != ADMIN_ID:
-        return
     parts = message.text.split()
     if len(parts) < 2:
         await message.answer("❌ Format noto'g'ri. Foydalanish: /delete <KOD> yoki /delete <KOD> <QISM_RAQAMI>")
@@ -671,28 +3889,286 @@ async def cmd_delete(message: Message):
     qism_index: Optional[int] = None
     if len(parts) >= 3 and parts[2].isdigit():
         qism_index = int(parts[2]) - 1
-    movie = get_movie(code)
+    movie = await get_movie(code)
     if not movie:
         await message.answer("❌ Bunday kod topilmadi.")
         return
     if qism_index is None:
-        delete_movie(code)
+        await delete_movie(code)
         await message.answer(f"✅ Kod {code} uchun butun kino o‘chirildi.")
     else:
-        res = delete_movie_part(code, qism_index)
+        res = await delete_movie_part(code, qism_index)
         if res:
             await message.answer(f"✅ Kod {code} uchun {qism_index+1}-qism o‘chirildi.\n🎬 {res.get('title','')}")
         else:
             await message.answer("❌ Bunday qism topilmadi.")
 
+@router.text("📢 Xabar tarqatish", admin=True)
+async def btn_broadcast_help(message: Message):
+    total, blocked = await db_user_counts()
+    await message.answer(
+        f"📢 Foydalanuvchilar: {total} (botni bloklagan: {blocked}).\n\n"
+        "Tarqatiladigan xabarni (matn yoki video) yuboring va unga javob tariqasida /broadcast yozing.\n"
+        "Holat: /broadcast status\nTo'xtatish: /broadcast stop"
+    )
+
+@router.command("broadcast", admin=True)
+async def cmd_broadcast(message: Message):
+    parts = message.text.split(maxsplit=1)
+    arg = parts[1].strip().lower() if len(parts) > 1 else ""
+    if arg == "stop":
+        stopped = await db_cancel_broadcast(time.time())
+        await message.answer(f"⏹ Tarqatish #{stopped} to'xtatildi." if stopped else "Hozir tarqatish yo'q.")
+        return
+    if arg == "status" or message.reply_to_message is None:
+        job = broadcaster.job or await db_last_broadcast()
+        if job is None:
+            await btn_broadcast_help(message)
+            return
+        await message.answer(render_broadcast(job, job["status"]))
+        return
+    job = await broadcaster.launch(message.chat.id, message.reply_to_message.message_id)
+    if job is None:
+        await message.answer("❗ Boshqa tarqatish davom etmoqda. /broadcast status yoki /broadcast stop")
+        return
+    await message.answer(f"📢 Tarqatish #{job['id']} boshlandi: {job['total']} foydalanuvchi.")
+
+@router.text("💾 Zaxira nusxa", admin=True)
+async def btn_backup_help(message: Message):
+    await message.answer(
+        "💾 /backup — butun bazaning siqilgan nusxasi (SQLite)\n"
+        "📤 /export — katalog JSONL.gz ko'rinishida (/migrate shu faylni qayta yuklay oladi)\n\n"
+        f"Fayllar {BACKUP_DIR}/ papkasida saqlanadi (har turidan oxirgi {BACKUP_KEEP} tasi); "
+        f"{BACKUP_SEND_MAX_MB:g} MB gacha bo'lganlari shu yerga yuboriladi."
+    )
+
+@router.command("backup", "export", admin=True)
+async def cmd_backup(message: Message):
+    kind = message.text.split(maxsplit=1)[0][1:].partition("@")[0]
+    if kind == "backup" and not storage.supports_backup:
+        await message.answer(f"❗ {storage.name} uchun /backup yo'q; bazaning o'z vositasidan foydalaning "
+                             "(PostgreSQL: pg_dump). Katalogni /export bilan olish mumkin.")
+        return
+    if not backup_runner.start(kind, message.chat.id):
+        await message.answer("❗ Boshqa nusxa olinmoqda.\n" + render_backup_progress(backup_runner.job))
+        return
+    await message.answer(f"💾 {kind} boshlandi, bot ishlashda davom etadi.")
+
+@router.command("perf", admin=True)
+async def cmd_perf(message: Message):
+    s = storage.stats()
+    sc = subscription_cache.stats()
+    cc = catalog_cache.stats()
+    mc = missing_codes.stats()
+    vc = view_counter.stats()
+    st = await state_store.stats()
+    ud = update_deduplicator.stats()
+    cs = cluster_sync.stats()
+    ss = send_scheduler.stats()
+    ur = user_registry.stats()
+    ir = inline_results.stats()
+    wr = webhook_replies.stats()
+    reply_mode = "yoqilgan" if wr["enabled"] else "o'chirilgan"
+    users, blocked = await db_user_counts()
+    await message.answer(
+        f"⏱ DB pool ({s['backend']}):\n"
+        f"So'rovlar: {s['calls']} (xato: {s['errors']})\n"
+        f"Navbat kutish: o'rtacha {s['wait_avg_ms']:.1f} ms, maks {s['wait_max_ms']:.1f} ms\n"
+        f"So'rov vaqti: o'rtacha {s['query_avg_ms']:.1f} ms, maks {s['query_max_ms']:.1f} ms\n\n"
+        f"Obuna keshi: {sc['entries']} yozuv, hit {sc['hits']}, miss {sc['misses']}, birlashtirilgan {sc['joined']}\n"
+        f"Kino keshi: {cc['size']} yozuv, hit {cc['hits']}, miss {cc['misses']} ({cc['hit_ratio']:.0%})\n"
+        f"Topilmagan kodlar keshi: {mc['size']} yozuv, hit {mc['hits']}\n"
+        f"Inline keshi: {ir['size']} so'rov, hit {ir['hits']}, miss {ir['misses']}, birlashtirilgan {ir['joined']}\n"
+        f"Ko'rishlar navbatda: {vc['pending']}, yozildi: {vc['flushed_views']} ({vc['flushes']} marta)\n"
+        f"Foydalanuvchilar: {users} (bloklagan {blocked}), navbatda {ur['pending']}, "
+        f"yozildi: {ur['flushed_users']} ({ur['flushes']} marta)\n"
+        f"Holatlar ({st['backend']}): {st['size']} yozuv, muddati o'tgan {st['expired']}, siqib chiqarilgan {st['evicted']}\n"
+        f"Worker {cs['worker'] + 1}/{cs['workers']}, takroriy update'lar: {ud['duplicates']}, "
+        f"boshqa worker o'zgarishlari: {cs['changes']}, to'liq qayta yuklash: {cs['reloads']}\n"
+        f"Yuborish navbati: interaktiv {ss['interactive']}, ommaviy {ss['bulk']}, "
+        f"429 qayta urinish {ss['retried']} (voz kechildi {ss['gave_up']})\n"
+        f"Webhook javobi: {reply_mode}, javobda {wr['responded']}, "
+        f"alohida yuborildi {wr['flushed']}"
+    )
+
+# --- Search results ---
+async def send_search_results(message: Message, user_id: int, query: str, page: int = 0, edit: bool = False) -> bool:
+    """Show one page of title search results; False when nothing matched."""
+    rows, has_more = await search_movies(query, page)
+    log_event("USER_SEARCH", sample=LOG_SAMPLE_RATE, user_id=user_id, query=query, page=page, results=len(rows))
+    if not rows:
+        return page > 0
+    await user_search_query.set(user_id, query)
+    first = page * SEARCH_PAGE_SIZE + 1
+    text = f"🔎 «{query[:64]}» bo'yicha topilganlar ({first}–{first + len(rows) - 1}):"
+    kb = search_results_markup(rows, page, has_more)
+    if not edit:
+        await message.answer(text, reply_markup=kb)
+        return True
+    try:
+        await message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        pass  # same page clicked twice: "message is not modified"
+    return True
+
+@router.callback("srch")
+async def page_search_results(callback: CallbackQuery):
+    user_id = callback.from_user.id
+    query = await user_search_query.get(user_id)
+    page = callback.data.partition(":")[2]
+    if not query or not page.isdigit():
+        await callback.answer("Qidiruv eskirgan, nomini qaytadan yozing.")
+        return
+    await callback.answer()
+    await send_search_results(callback.message, user_id, query, int(page), edit=True)
+
+@router.callback("open")
+async def open_search_result(callback: CallbackQuery):
+    user_id = callback.from_user.id
+    await callback.answer()
+    ok, _ = await is_subscribed_all_diagnostic(user_id)
+    if not ok:
+        await send_subscription_panel(callback)
+        return
+    code = callback.data.partition(":")[2]
+    movie = await get_movie(code)
+    if not movie:
+        await callback.message.answer("📥 Bunday kodli kino topilmadi.")
+        return
+    await send_movie(callback.message, user_id, code, movie)
+
+async def send_movie(message: Message, user_id: int, code: str, movie: dict):
+    """Send a single-part movie right away, or offer the parts keyboard."""
+    parts = movie.get("parts", [])
+    if parts:
+        if len(parts) == 1:
+            part = parts[0]
+            video_id = part.get("video")
+            log_event("USER_CODE_SINGLE_PART", sample=LOG_SAMPLE_RATE, user_id=user_id, code=code, video_id=video_id)
+            if not video_id:
+                await message.answer("❌ Ushbu qism uchun video topilmadi.")
+                return
+            increment_view(code)
+            try:
+                await message.answer_video(video=video_id, caption=part["caption"])
+            except TelegramBadRequest as e:
+                log_event("USER_CODE_SEND_ERROR", logging.WARNING, user_id=user_id, code=code, error=e)
+                await message.answer("❌ Video yuborib bo'lmadi.")
+            await clear_state(user_id, user_waiting_code)
+            kb = main_menu(is_admin=(user_id == ADMIN_ID))
+            await message.answer("Yana nima qilamiz?", reply_markup=kb)
+            return
+        kb = parts_menu(len(parts))
+        await user_current_code.set(user_id, code)
+        await user_waiting_part.set(user_id, True)
+        await message.answer(f"🎬 {movie.get('title', code)} qismlarini tanlang:", reply_markup=kb)
+        return
+    await message.answer("📥 Bu kodda kontent topilmadi.")
+
+# --- Inline mode ---
+INLINE_CACHE_SIZE = int(os.getenv("INLINE_CACHE_SIZE", "2000"))
+INLINE_MAX_RESULTS = int(os.getenv("INLINE_MAX_RESULTS", "200"))
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "300"))
+INLINE_PAGE_SIZE = 50  # Telegram's limit per answer
+
+def build_inline_results(rows: list[tuple]) -> tuple:
+    """Cached-video results for video_parts rows; runs on a worker thread."""
+    results = []
+    for code, movie_title, part_id, title, description, video in rows:
+        heading = movie_title or title or code
+        if title and title != heading:
+            heading = title if title.startswith(heading) else f"{heading} — {title}"
+        results.append(InlineQueryResultCachedVideo(
+            id=str(part_id),
+            video_file_id=video,
+            title=heading,
+            description=f"Kod: {code}" + (f" · {description}" if description else ""),
+            caption=part_caption(title, description),
+        ))
+    return tuple(results)
+
+class InlineResults:
+    """Prebuilt answers to inline queries, one entry per query text.
+
+    The first time a query is seen its whole result set (up to `max_results`
+    parts) is built: search, one parts lookup, then the result objects on a
+    worker thread. Repeats and later pages are slices of the cached tuple.
+    Concurrent misses for the same query await one build, and any catalog
+    write clears the cache.
+    """
+
+    def __init__(self, size: int, max_results: int):
+        self.cache = LRUCache(size)
+        self.max_results = max_results
+        self._inflight: dict[str, asyncio.Task] = {}
+        self.joined = 0
+
+    async def get(self, query: str) -> tuple:
+        key = " ".join(query.split())
+        results = self.cache.get(key)
+        if results is not CACHE_MISS:
+            return results
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._build(key, self.cache.generation))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _t, k=key: self._inflight.pop(k, None))
+        else:
+            self.joined += 1
+        return await asyncio.shield(task)
+
+    async def _build(self, query: str, generation: int) -> tuple:
+        if query:
+            codes = [code for code, _ in await db_search(query, self.max_results, 0, SEARCH_WINDOW)]
+            # A typed movie code goes first, whatever its title.
+            if " " not in query and query not in codes and await get_movie(query):
+                codes.insert(0, query)
+        else:
+            codes = [code for code, _, _ in await top_movies(INLINE_PAGE_SIZE)]
+        order = {code: i for i, code in enumerate(codes)}
+        rows = sorted(await db_video_parts(codes), key=lambda r: order[r[0]])
+        results = await asyncio.get_running_loop().run_in_executor(
+            None, build_inline_results, rows[:self.max_results]
+        )
+        if generation == self.cache.generation:
+            self.cache.put(query, results)
+        return results
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self) -> dict:
+        return {**self.cache.stats(), "joined": self.joined}
+
+inline_results = InlineResults(INLINE_CACHE_SIZE, INLINE_MAX_RESULTS)
+
+@dp.inline_query()
+async def inline_search(query: InlineQuery):
+    user_id = query.from_user.id
+    ok, _ = await is_subscribed_all_diagnostic(user_id)
+    if not ok:
+        button = InlineQueryResultsButton(text="📢 Avval kanallarga obuna bo'ling", start_parameter="subscribe")
+        await query.answer([], cache_time=0, is_personal=True, button=button)
+        return
+    results = await inline_results.get(query.query)
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    end = offset + INLINE_PAGE_SIZE
+    log_event("USER_INLINE", sample=LOG_SAMPLE_RATE, user_id=user_id, query=query.query, offset=offset, results=len(results))
+    # Personal, because the subscription gate above is per user.
+    await query.answer(
+        list(results[offset:end]), cache_time=INLINE_CACHE_TIME, is_personal=True,
+        next_offset=str(end) if end < len(results) else "",
+    )
+
 # --- Text flow handler ---
-@dp.message(lambda m: m.text and not is_button_text(m.text))
+@router.default
 async def handle_text_flow(message: Message):
     text = message.text.strip()
     user_id = message.from_user.id
+    state = await get_state(user_id, user_waiting_part, user_current_code, user_waiting_code)
 
-    if user_waiting_part.get(user_id):
-        print(f"[USER_PART_SELECT] user_id={user_id} text={text} waiting_part=True current_code={user_current_code.get(user_id)}")
+    if state.get(user_waiting_part.ns):
+        log_event("USER_PART_SELECT", sample=LOG_SAMPLE_RATE, user_id=user_id, text=text, current_code=state.get(user_current_code.ns))
         if text.endswith("-qism") and text[:-5].isdigit():
             idx = int(text[:-5]) - 1
         elif text.isdigit():
@@ -700,12 +4176,11 @@ async def handle_text_flow(message: Message):
         else:
             await message.answer("Qism raqamini tanlang (masalan: 1-qism) yoki 🔙 Asosiy menyuga qayting.")
             return
-        code = user_current_code.get(user_id)
-        movie = get_movie(code) if code else None
+        code = state.get(user_current_code.ns)
+        movie = await get_movie(code) if code else None
         if not code or not movie:
             await message.answer("❌ Qism tanlash konteksti yo'qoldi. Iltimos, '🎬 Kino topish'dan qayta urinib ko'ring.")
-            user_waiting_part.pop(user_id, None)
-            user_current_code.pop(user_id, None)
+            await clear_state(user_id, user_waiting_part, user_current_code)
             return
         parts = movie.get("parts", [])
         if idx < 0 or idx >= len(parts):
@@ -713,88 +4188,192 @@ async def handle_text_flow(message: Message):
             return
         part = parts[idx]
         video_id = part.get("video")
-        print(f"[USER_PART_RESOLVE] user_id={user_id} code={code} idx={idx} part_video={video_id}")
+        log_event("USER_PART_RESOLVE", sample=LOG_SAMPLE_RATE, user_id=user_id, code=code, idx=idx, part_video=video_id)
         if not video_id:
             await message.answer("❌ Ushbu qism uchun video topilmadi.")
             return
         increment_view(code)
         try:
-            await message.answer_video(video=video_id, caption=f"🎬 {part.get('title','')}\n\n📝 {part.get('description','')}")
+            await message.answer_video(video=video_id, caption=part["caption"])
         except TelegramBadRequest as e:
-            print(f"[USER_PART_SEND_ERROR] user_id={user_id} code={code} idx={idx} error={e}")
+            log_event("USER_PART_SEND_ERROR", logging.WARNING, user_id=user_id, code=code, idx=idx, error=e)
             await message.answer("❌ Ushbu qism uchun video yuborib bo'lmadi.")
-        user_waiting_part.pop(user_id, None)
-        user_current_code.pop(user_id, None)
+        await clear_state(user_id, user_waiting_part, user_current_code)
         kb = main_menu(is_admin=(user_id == ADMIN_ID))
         await message.answer("Yana nima qilamiz?", reply_markup=kb)
         return
 
-    if user_waiting_code.get(user_id):
-        print(f"[USER_CODE_ENTER] user_id={user_id} code_entered={text}")
+    if state.get(user_waiting_code.ns):
+        log_event("USER_CODE_ENTER", sample=LOG_SAMPLE_RATE, user_id=user_id, code_entered=text)
         ok, _ = await is_subscribed_all_diagnostic(user_id)
         if not ok:
             await send_subscription_panel(message)
             return
         code = text
-        movie = get_movie(code)
-        print(f"[USER_CODE_MOVIE] user_id={user_id} movie_found={bool(movie)}")
+        movie = await get_movie(code)
+        log_event("USER_CODE_MOVIE", sample=LOG_SAMPLE_RATE, user_id=user_id, movie_found=bool(movie))
         if not movie:
-            await message.answer("📥 Bunday kodli kino topilmadi.")
-            return
-        parts = movie.get("parts", [])
-        if parts:
-            if len(parts) == 1:
-                part = parts[0]
-                video_id = part.get("video")
-                print(f"[USER_CODE_SINGLE_PART] user_id={user_id} code={code} video_id={video_id}")
-                if not video_id:
-                    await message.answer("❌ Ushbu qism uchun video topilmadi.")
-                    return
-                increment_view(code)
-                try:
-                    await message.answer_video(video=video_id, caption=f"🎬 {part.get('title','')}\n\n📝 {part.get('description','')}")
-                except TelegramBadRequest as e:
-                    print(f"[USER_CODE_SEND_ERROR] user_id={user_id} code={code} error={e}")
-                    await message.answer("❌ Video yuborib bo'lmadi.")
-                user_waiting_code.pop(user_id, None)
-                kb = main_menu(is_admin=(user_id == ADMIN_ID))
-                await message.answer("Yana nima qilamiz?", reply_markup=kb)
-                return
-            kb = parts_menu(len(parts))
-            user_current_code[user_id] = code
-            user_waiting_part[user_id] = True
-            await message.answer(f"🎬 {movie.get('title', code)} qismlarini tanlang:", reply_markup=kb)
+            if not await send_search_results(message, user_id, text):
+                await message.answer("📥 Bunday kodli kino topilmadi.")
             return
-        await message.answer("📥 Bu kodda kontent topilmadi.")
+        await send_movie(message, user_id, code, movie)
         return
 
     await message.answer("Iltimos, menyudan biror tugmani tanlang yoki /start ni bosing.")
 
+# --- Metrics endpoint ---
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+
+def _cache_counts() -> dict:
+    counts = {}
+    for name, st in (
+        ("catalog", catalog_cache.stats()),
+        ("missing_codes", missing_codes.stats()),
+        ("subscription", subscription_cache.stats()),
+        ("update_dedupe", update_deduplicator.seen.stats()),
+        ("user_seen", user_registry.seen.stats()),
+        ("inline", inline_results.stats()),
+    ):
+        counts[(name, "hit")] = st["hits"]
+        counts[(name, "miss")] = st["misses"]
+    return counts
+
+def _cache_hit_ratios() -> dict:
+    counts = _cache_counts()
+    ratios = {}
+    for (name, kind), n in counts.items():
+        if kind == "hit":
+            total = n + counts[(name, "miss")]
+            ratios[(name,)] = n / total if total else 0.0
+    return ratios
+
+metrics.gauge("cache_requests_total", "Cache lookups by result", ("cache", "result"), _cache_counts, kind="counter")
+metrics.gauge("cache_hit_ratio", "Cache hit ratio since start", ("cache",), _cache_hit_ratios)
+metrics.gauge("view_counter_pending", "Views waiting to be flushed", (), lambda: {(): view_counter.stats()["pending"]})
+metrics.gauge("user_registry_pending", "Users waiting to be written", (), lambda: {(): user_registry.stats()["pending"]})
+metrics.gauge("db_pool_size", "Pooled database connections", (), lambda: {(): storage.pool.size})
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Worker": str(WORKER_ID)})
+
 # --- Webhook lifecycle ---
-async def on_startup(app: web.Application):
-    init_db()
-    migrate_json_to_sqlite()
+async def ensure_webhook():
     webhook_info = await bot.get_webhook_info()
     if webhook_info.url != WEBHOOK_URL:
         await bot.set_webhook(url=WEBHOOK_URL)
-        print(f"✅ Webhook set: {WEBHOOK_URL}")
+        log_event("WEBHOOK_SET", url=WEBHOOK_URL)
+    else:
+        log_event("WEBHOOK_ALREADY_SET", url=WEBHOOK_URL)
+
+async def on_startup(app: web.Application):
+    storage.open()
+    await init_db()
+    if WEB_WORKERS > 1:
+        # The supervisor already migrated and set the webhook (see bootstrap).
+        await cluster_sync.poll()
+        await recommender.load()
+        cluster_sync.start()
     else:
-        print(f"ℹ️ Webhook already set: {WEBHOOK_URL}")
+        await ensure_search_index()
+        await recommender.load()
+        catalog_importer.start(IMPORT_PATH)
+    view_counter.start()
+    state_store.start()
+    user_registry.start()
+    broadcaster.start()
+    if WEB_WORKERS == 1:
+        await ensure_webhook()
 
 async def on_shutdown(app: web.Application):
-    await bot.session.close()
-    print("🛑 Bot session closed")
+    # Every step runs even if an earlier one fails: a view flush that errors
+    # must not cost the user registry its pending rows or leave the DB open.
+    steps = (
+        ("catalog_importer", catalog_importer.stop),
+        ("backup_runner", backup_runner.stop),
+        ("broadcaster", broadcaster.stop),
+        ("bot_session", bot.session.close),
+        ("cluster_sync", cluster_sync.stop),
+        ("view_counter", view_counter.stop),
+        ("user_registry", user_registry.stop),
+        ("state_store", state_store.stop),
+    )
+    for name, stop in steps:
+        try:
+            await stop()
+        except Exception as e:
+            log_event("SHUTDOWN_STEP_ERROR", logging.ERROR, step=name, error=e)
+    log_event("BOT_SESSION_CLOSED")
+    storage.close()
 
-def main():
-    print("🚀 Bot starting...")
-    print(f"🌐 Server: {WEB_SERVER_HOST}:{WEB_SERVER_PORT}")
-    print(f"🔗 Webhook URL: {WEBHOOK_URL}")
+def create_app() -> web.Application:
     app = web.Application()
-    webhook_handler = SimpleRequestHandler(dispatcher=dp, bot=bot)
+    webhook_handler = SimpleRequestHandler(dispatcher=dp, bot=bot, handle_in_background=not WEBHOOK_REPLY)
     webhook_handler.register(app, path=WEBHOOK_PATH)
+    app.router.add_get(METRICS_PATH, metrics_handler)
     app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown)
-    web.run_app(app, host=WEB_SERVER_HOST, port=WEB_SERVER_PORT)
+    return app
+
+async def bootstrap():
+    """One-time setup the supervisor runs before forking workers."""
+    storage.open()
+    try:
+        await init_db()
+        await ensure_search_index()
+        await catalog_importer.run(IMPORT_PATH)
+        await ensure_webhook()
+    finally:
+        await bot.session.close()
+        storage.close()
+
+def run_worker(worker_id: int):
+    global WORKER_ID
+    WORKER_ID = worker_id
+    log_event("WORKER_STARTED", worker=worker_id, pid=os.getpid())
+    web.run_app(create_app(), host=WEB_SERVER_HOST, port=WEB_SERVER_PORT, reuse_port=True, print=None)
+
+def run_supervisor():
+    """Start WEB_WORKERS processes on one port and restart any that die."""
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise RuntimeError("WEB_WORKERS > 1 needs SO_REUSEPORT (Linux/BSD); set WEB_WORKERS=1")
+    asyncio.run(bootstrap())
+    ctx = multiprocessing.get_context("spawn")
+    workers: dict[int, multiprocessing.Process] = {}
+    stopping = False
+
+    def spawn(worker_id: int):
+        proc = ctx.Process(target=run_worker, args=(worker_id,), name=f"worker-{worker_id}")
+        proc.start()
+        workers[worker_id] = proc
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for worker_id in range(WEB_WORKERS):
+        spawn(worker_id)
+    while not stopping:
+        time.sleep(1)
+        for worker_id, proc in list(workers.items()):
+            if not stopping and not proc.is_alive():
+                log_event("WORKER_RESTART", logging.WARNING, worker=worker_id, exitcode=proc.exitcode)
+                spawn(worker_id)
+    for proc in workers.values():
+        if proc.is_alive():
+            proc.terminate()
+    for proc in workers.values():
+        proc.join(timeout=30)
+    log_event("WORKERS_STOPPED")
+
+def main():
+    log_event("BOT_STARTING", host=WEB_SERVER_HOST, port=WEB_SERVER_PORT, webhook_url=WEBHOOK_URL, workers=WEB_WORKERS)
+    if WEB_WORKERS > 1:
+        run_supervisor()
+    else:
+        web.run_app(create_app(), host=WEB_SERVER_HOST, port=WEB_SERVER_PORT)
 
 if __name__ == "__main__":
     main()